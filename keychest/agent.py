@@ -5,9 +5,25 @@
 Monitoring Agent
 """
 
+import base64
+import collections
+import json
+import logging
+import os
+import threading
 import time
+import zlib
 from past.builtins import cmp
 
+from . import util
+
+
+__author__ = 'dusanklinec'
+logger = logging.getLogger(__name__)
+
+
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
 
 class AgentResultPush(object):
     def __init__(self):
@@ -38,3 +54,186 @@ class AgentResultPush(object):
     def __repr__(self):
         return '<AgentResultPush(added_at=%r, new_scan=%r, job=%r)>' % (self.added_at, self.new_scan, self.job)
 
+
+def encode_results_payload(results):
+    """
+    Serializes the new_results request to the gzip compressed JSON
+    :param results: {scans: [...]}
+    :return: bytes
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, GZIP_WBITS)
+    data = util.to_bytes(json.dumps(results))
+    return compressor.compress(data) + compressor.flush()
+
+
+def decode_results_payload(request):
+    """
+    Parses the new_results request body.
+    Accepts the legacy plain JSON form and the gzip compressed batch form (Content-Encoding: gzip).
+    :param request: flask request
+    :return:
+    """
+    if util.lower(request.headers.get('Content-Encoding', '')) == 'gzip':
+        data = zlib.decompress(request.get_data(), GZIP_WBITS)
+        return json.loads(util.to_string(data))
+    return request.json
+
+
+class AgentResultSpool(object):
+    """
+    Append-only spool file of the result batches waiting for the publish to the master.
+
+    Line per record, JSON:
+     - {t: b, id: batch id, data: base64 gzip payload} - new batch
+     - {t: a, id: batch id} - batch acknowledged by the master
+
+    Batches without the ack record are pending, loaded again after the restart.
+    The file is truncated when there is nothing pending, rewritten with pending batches only when too big.
+    """
+    COMPACT_SIZE = 16 * 1024 * 1024
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.RLock()
+        self.pending = collections.OrderedDict()  # batch id -> (offset, length)
+        self.last_id = 0
+        self.size = 0
+        self.fh = None
+
+    def open(self):
+        """
+        Opens the spool, loads pending batches
+        :return:
+        """
+        with self.lock:
+            if os.path.exists(self.path):
+                self._load()
+            self.fh = open(self.path, 'ab+')
+            self.fh.seek(0, os.SEEK_END)
+            self.size = self.fh.tell()
+            if len(self.pending) > 0:
+                logger.info('Agent spool %s: %s pending batches' % (self.path, len(self.pending)))
+
+    def close(self):
+        with self.lock:
+            util.silent_close(self.fh)
+            self.fh = None
+
+    def _load(self):
+        """
+        Replays the spool file. Torn last record (crash during the write) is cut off.
+        :return:
+        """
+        offset = 0
+        with open(self.path, 'rb') as fh:
+            for line in fh:
+                try:
+                    if not line.endswith(b'\n'):
+                        raise ValueError('Incomplete record')
+                    rec = json.loads(util.to_string(line))
+                except ValueError as e:
+                    logger.warning('Agent spool %s corrupted at %s, truncating: %s' % (self.path, offset, e))
+                    break
+
+                self.last_id = max(self.last_id, rec['id'])
+                if rec['t'] == 'b':
+                    self.pending[rec['id']] = (offset, len(line))
+                else:
+                    self.pending.pop(rec['id'], None)
+                offset += len(line)
+
+        if offset < os.path.getsize(self.path):
+            with open(self.path, 'ab') as fh:
+                fh.truncate(offset)
+
+    def _write(self, rec, sync=True):
+        line = util.to_bytes(json.dumps(rec)) + b'\n'
+        offset = self.size
+        self.fh.write(line)
+        self.fh.flush()
+        if sync:
+            os.fsync(self.fh.fileno())
+        self.size += len(line)
+        return offset, len(line)
+
+    def append(self, payload):
+        """
+        Persists a new batch
+        :param payload: encoded batch
+        :return: batch id
+        """
+        with self.lock:
+            self.last_id += 1
+            rec = {'t': 'b', 'id': self.last_id, 'data': util.to_string(base64.b64encode(payload))}
+            self.pending[self.last_id] = self._write(rec)
+            return self.last_id
+
+    def read(self, batch_id):
+        """
+        Loads pending batch payload
+        :param batch_id:
+        :return:
+        """
+        with self.lock:
+            offset, length = self.pending[batch_id]
+            with open(self.path, 'rb') as fh:
+                fh.seek(offset)
+                rec = json.loads(util.to_string(fh.read(length)))
+            return base64.b64decode(rec['data'])
+
+    def ack(self, batch_id):
+        """
+        Marks the batch as delivered.
+        Not synced, the master ignores already processed scans if the batch is sent again.
+        :param batch_id:
+        :return:
+        """
+        with self.lock:
+            if self.pending.pop(batch_id, None) is None:
+                return
+
+            if len(self.pending) == 0:
+                self.fh.truncate(0)
+                self.size = 0
+            else:
+                self._write({'t': 'a', 'id': batch_id}, sync=False)
+                if self.size > self.COMPACT_SIZE:
+                    self.compact()
+
+    def compact(self):
+        """
+        Rewrites the spool with the pending batches only
+        :return:
+        """
+        with self.lock:
+            tmp_path = '%s.tmp' % self.path
+            pending = collections.OrderedDict()
+            offset = 0
+            with open(self.path, 'rb') as src, open(tmp_path, 'wb') as dst:
+                for batch_id, (rec_offset, length) in self.pending.items():
+                    src.seek(rec_offset)
+                    dst.write(src.read(length))
+                    pending[batch_id] = (offset, length)
+                    offset += length
+                dst.flush()
+                os.fsync(dst.fileno())
+
+            self.fh.close()
+            os.rename(tmp_path, self.path)
+            self.pending = pending
+            self.fh = open(self.path, 'ab+')
+            self.size = offset
+
+    def pending_ids(self):
+        with self.lock:
+            return list(self.pending.keys())
+
+    def __len__(self):
+        return len(self.pending)
+
+    def stats_str(self):
+        """
+        Simple state dump, returns string
+        :return:
+        """
+        return 'pending batches: %s, spool size: %s' % (len(self.pending), self.size)
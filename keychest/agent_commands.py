@@ -0,0 +1,212 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Agent command registry - long poll support for the agent wait_command API.
+
+Commands are pushed per agent, waiting requests block until a command arrives or the deadline passes.
+A waiter blocks on its own lock acquire without a timeout, deadlines are handled by a single timer
+thread, so waiting requests do not poll (timed waits poll on Python 2).
+
+The threading module is pluggable, the REST API uses green eventlet threading.
+Commands from other threads / processes are delivered via Redis pub/sub (see listen_redis()).
+"""
+
+import heapq
+import json
+import logging
+import threading
+import time
+
+from . import util
+
+
+__author__ = 'dusanklinec'
+logger = logging.getLogger(__name__)
+
+
+AGENT_COMMANDS_CHANNEL = 'keychest:agent-commands'
+
+
+class AgentCommandWaiter(object):
+    """
+    Waiting request
+    """
+    __slots__ = ('agent_id', 'deadline', 'lock', 'released')
+
+    def __init__(self, agent_id, deadline, lock):
+        self.agent_id = agent_id
+        self.deadline = deadline
+        self.lock = lock  # acquired, released on a command or the deadline
+        self.released = False
+
+    def release(self):
+        if not self.released:
+            self.released = True
+            self.lock.release()
+
+    def __lt__(self, other):
+        return self.deadline < other.deadline
+
+
+class AgentCommandRegistry(object):
+    """
+    Per agent command queues with blocking waits
+    """
+    def __init__(self, threading_module=None, max_pending=100):
+        """
+        :param threading_module: threading implementation, e.g., eventlet.green.threading
+        :param max_pending: max number of queued commands per agent, the oldest are dropped
+        """
+        self.threading = util.defval(threading_module, threading)
+        self.max_pending = max_pending
+        self.lock = self.threading.Lock()
+        self.timer_cond = self.threading.Condition(self.lock)
+        self.timer_thread = None
+        self.running = True
+
+        self.pending = {}  # agent id -> list of commands
+        self.waiters = {}  # agent id -> list of waiters
+        self.deadlines = []  # heap of waiters
+
+        self.num_commands = 0
+        self.num_waits = 0
+        self.num_timeouts = 0
+
+    def push(self, agent_id, command):
+        """
+        Enqueues command for the agent, wakes up waiting requests
+        :param agent_id:
+        :param command:
+        :return:
+        """
+        with self.lock:
+            self.num_commands += 1
+            cmds = self.pending.setdefault(agent_id, [])
+            cmds.append(command)
+            if len(cmds) > self.max_pending:
+                del cmds[:len(cmds) - self.max_pending]
+
+            for waiter in self.waiters.pop(agent_id, []):
+                waiter.release()
+
+    def wait(self, agent_id, timeout=10.0):
+        """
+        Returns pending commands of the agent, blocks until some arrive or timeout passes
+        :param agent_id:
+        :param timeout:
+        :return: list of commands, empty on timeout
+        """
+        with self.lock:
+            self.num_waits += 1
+            cmds = self.pending.pop(agent_id, None)
+            if cmds or timeout <= 0 or not self.running:
+                return util.defval(cmds, [])
+
+            lock = self.threading.Lock()
+            lock.acquire()
+            waiter = AgentCommandWaiter(agent_id, time.time() + timeout, lock)
+            self.waiters.setdefault(agent_id, []).append(waiter)
+            heapq.heappush(self.deadlines, waiter)
+            self._ensure_timer()
+            if self.deadlines[0] is waiter:
+                self.timer_cond.notify()
+
+        lock.acquire()
+
+        with self.lock:
+            waiters = self.waiters.get(agent_id)
+            if waiters is not None and waiter in waiters:
+                waiters.remove(waiter)
+                if not waiters:
+                    del self.waiters[agent_id]
+
+            cmds = self.pending.pop(agent_id, None)
+            if not cmds:
+                self.num_timeouts += 1
+            return util.defval(cmds, [])
+
+    def num_waiters(self):
+        with self.lock:
+            return sum([len(x) for x in self.waiters.values()])
+
+    def _ensure_timer(self):
+        if self.timer_thread is None:
+            self.timer_thread = self.threading.Thread(target=self._timer_main, args=())
+            self.timer_thread.setDaemon(True)
+            self.timer_thread.start()
+
+    def _timer_main(self):
+        """
+        Releases waiters after the deadline
+        :return:
+        """
+        with self.lock:
+            while self.running:
+                now = time.time()
+                while self.deadlines and (self.deadlines[0].deadline <= now or self.deadlines[0].released):
+                    heapq.heappop(self.deadlines).release()
+
+                timeout = self.deadlines[0].deadline - now if self.deadlines else None
+                self.timer_cond.wait(timeout)
+
+            for waiter in self.deadlines:
+                waiter.release()
+            self.deadlines = []
+
+    def shutdown(self):
+        """
+        Releases all waiters
+        :return:
+        """
+        with self.lock:
+            self.running = False
+            self.timer_cond.notify()
+            for waiter in self.deadlines:
+                waiter.release()
+
+    def listen_redis(self, redis_client, channel=AGENT_COMMANDS_CHANNEL):
+        """
+        Blocking Redis pub/sub listener, pushes received commands.
+        Message: {agent_id: id, command: command}
+        :param redis_client:
+        :param channel:
+        :return:
+        """
+        pubsub = redis_client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(channel)
+        try:
+            for msg in pubsub.listen():
+                if not self.running:
+                    break
+                if msg is None or msg['type'] != 'message':
+                    continue
+                try:
+                    js = json.loads(util.to_string(msg['data']))
+                    self.push(js['agent_id'], js['command'])
+                except Exception as e:
+                    logger.warning('Invalid agent command message: %s' % e)
+        finally:
+            util.silent_close(pubsub)
+
+    def stats_str(self):
+        """
+        Simple state dump, returns string
+        :return:
+        """
+        with self.lock:
+            return 'waiters: %s, pending agents: %s, commands: %s, waits: %s, timeouts: %s' \
+                   % (sum([len(x) for x in self.waiters.values()]), len(self.pending), self.num_commands,
+                      self.num_waits, self.num_timeouts)
+
+
+def publish_agent_command(redis_client, agent_id, command, channel=AGENT_COMMANDS_CHANNEL):
+    """
+    Publishes the command for the agent to the REST API processes via Redis pub/sub
+    :param redis_client:
+    :param agent_id:
+    :param command:
+    :param channel:
+    :return: number of subscribers received the message
+    """
+    return redis_client.publish(channel, json.dumps({'agent_id': agent_id, 'command': command}))
@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Compiled subdomain scan blacklist.
+
+The blacklist rules are compiled to the index once on reload so the lookup does not
+depend on the number of rules:
+
+ - SUFFIX rules go to the trie keyed by the reversed domain labels.
+   The rule is a plain string suffix, i.e., the leftmost rule label may match only a tail
+   of the domain label (rule `le.com` matches `google.com`). The leftmost rule label is thus
+   stored in the node as a partial label and matched against all tails of the domain label.
+ - MATCH rules go to the dict.
+ - CIDR rules (IP address or network) go to the sorted list of disjoint IP intervals,
+   looked up by bisection.
+
+If more rules match, the first one in the rule list wins, the same as with the linear scan.
+"""
+
+import bisect
+import logging
+
+from IPy import IP
+
+from .consts import BlacklistRuleType
+from .tls_domain_tools import TlsDomainTools
+
+
+__author__ = 'dusanklinec'
+logger = logging.getLogger(__name__)
+
+
+class BlacklistTrieNode(object):
+    """
+    Suffix trie node, children are keyed by the label
+    """
+    __slots__ = ('children', 'partials')
+
+    def __init__(self):
+        self.children = {}
+        self.partials = None  # partial leftmost label -> rule index
+
+    def child(self, label):
+        node = self.children.get(label)
+        if node is None:
+            node = BlacklistTrieNode()
+            self.children[label] = node
+        return node
+
+    def add_partial(self, label, idx):
+        if self.partials is None:
+            self.partials = {}
+        if label not in self.partials:
+            self.partials[label] = idx
+
+
+class BlacklistIpIndex(object):
+    """
+    Disjoint sorted IP intervals for one IP version.
+    """
+    def __init__(self):
+        self.intervals = []  # (start, end, rule index)
+        self.starts = []
+        self.ends = []
+        self.idxs = []
+
+    def add(self, start, end, idx):
+        self.intervals.append((start, end, idx))
+
+    def build(self):
+        """
+        Flattens the intervals to the disjoint segments, each holding the first matching rule.
+        CIDR ranges are either nested or disjoint so the nesting stack is enough.
+        :return:
+        """
+        self.starts, self.ends, self.idxs = [], [], []
+        stack = []  # (end, best rule index)
+        cur = None
+
+        def emit(start, end, idx):
+            if start <= end:
+                self.starts.append(start)
+                self.ends.append(end)
+                self.idxs.append(idx)
+
+        for start, end, idx in sorted(self.intervals, key=lambda x: (x[0], -x[1], x[2])):
+            while stack and stack[-1][0] < start:
+                top = stack.pop()
+                emit(cur, top[0], top[1])
+                cur = top[0] + 1
+
+            if stack:
+                emit(cur, start - 1, stack[-1][1])
+                idx = min(idx, stack[-1][1])
+
+            cur = start
+            stack.append((end, idx))
+
+        while stack:
+            top = stack.pop()
+            emit(cur, top[0], top[1])
+            cur = top[0] + 1
+
+        self.intervals = []
+
+    def find(self, ip_int):
+        """
+        Rule index of the segment containing the IP or None
+        :param ip_int:
+        :return:
+        """
+        pos = bisect.bisect_right(self.starts, ip_int) - 1
+        if pos >= 0 and self.ends[pos] >= ip_int:
+            return self.idxs[pos]
+        return None
+
+
+class BlacklistIndex(object):
+    """
+    Compiled blacklist, immutable after the build so it can be swapped and shared by threads without locking
+    """
+    def __init__(self, rules=None):
+        """
+        :param rules: list of DbSubdomainScanBlacklist, or objects with rule, rule_type
+        """
+        self.rules = []
+        self.root = BlacklistTrieNode()
+        self.matches = {}
+        self.ip_indices = {4: BlacklistIpIndex(), 6: BlacklistIpIndex()}
+        self.num_ip_rules = 0
+        self.build(rules if rules is not None else [])
+
+    def __len__(self):
+        return len(self.rules)
+
+    def build(self, rules):
+        """
+        Compiles the rules
+        :param rules:
+        :return:
+        """
+        self.rules = list(rules)
+        for idx, rule in enumerate(self.rules):
+            if rule.rule is None:
+                continue
+
+            if rule.rule_type == BlacklistRuleType.SUFFIX:
+                self.add_suffix(rule.rule, idx)
+
+            elif rule.rule_type == BlacklistRuleType.MATCH:
+                if rule.rule not in self.matches:
+                    self.matches[rule.rule] = idx
+
+            elif rule.rule_type == BlacklistRuleType.CIDR:
+                self.add_cidr(rule.rule, idx)
+
+        for ip_index in self.ip_indices.values():
+            ip_index.build()
+
+    def add_suffix(self, suffix, idx):
+        """
+        Adds suffix rule to the trie
+        :param suffix:
+        :param idx:
+        :return:
+        """
+        labels = suffix.split('.')
+        node = self.root
+        for label in reversed(labels[1:]):
+            node = node.child(label)
+        node.add_partial(labels[0], idx)
+
+    def add_cidr(self, cidr, idx):
+        """
+        Adds IP / CIDR rule to the interval index
+        :param cidr:
+        :param idx:
+        :return:
+        """
+        try:
+            net = IP(cidr, make_net=True)
+            self.ip_indices[net.version()].add(net.int(), net.int() + net.len() - 1, idx)
+            self.num_ip_rules += 1
+
+        except Exception as e:
+            logger.warning('Invalid blacklist CIDR rule %s: %s' % (cidr, e))
+
+    def find_suffix(self, domain):
+        """
+        Index of the first suffix rule matching the domain
+        :param domain:
+        :return:
+        """
+        best = None
+        labels = domain.split('.')
+        node = self.root
+        for label in reversed(labels):
+            if node.partials is not None:
+                for pos in range(len(label) + 1):
+                    idx = node.partials.get(label[pos:])
+                    if idx is not None and (best is None or idx < best):
+                        best = idx
+
+            node = node.children.get(label)
+            if node is None:
+                break
+
+        return best
+
+    def find_ip(self, domain):
+        """
+        Index of the first CIDR rule matching the IP address
+        :param domain:
+        :return:
+        """
+        if self.num_ip_rules == 0 or not TlsDomainTools.is_ip(domain):
+            return None
+        try:
+            ip = IP(domain)
+            return self.ip_indices[ip.version()].find(ip.int())
+        except ValueError:
+            return None
+
+    def find(self, domain):
+        """
+        Returns the first rule matching the domain or None
+        :param domain:
+        :return:
+        """
+        if domain is None or len(self.rules) == 0:
+            return None
+
+        candidates = [self.matches.get(domain), self.find_suffix(domain), self.find_ip(domain)]
+        candidates = [x for x in candidates if x is not None]
+        return self.rules[min(candidates)] if candidates else None
+
+    def stats_str(self):
+        """
+        Simple state dump, returns string
+        :return:
+        """
+        return 'rules: %s, exact: %s, ip segments: %s' \
+               % (len(self.rules), len(self.matches), sum([len(x.starts) for x in self.ip_indices.values()]))
@@ -0,0 +1,122 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Parsed certificate cache.
+
+The same certificates (mostly intermediates) are parsed over and over in handshake scans,
+crt.sh downloads and path validation. The cache maps SHA1 of the DER to the parsed
+cryptography / pyOpenSSL objects and the derived Certificate DB field values.
+"""
+
+import hashlib
+import logging
+import threading
+
+import pylru
+from OpenSSL.crypto import load_certificate, FILETYPE_ASN1
+
+from . import util
+
+
+__author__ = 'dusanklinec'
+logger = logging.getLogger(__name__)
+
+
+CERT_CACHE_SIZE = 2048
+
+
+class ParsedCertificate(object):
+    """
+    Parsed certificate, cache entry. Treat as read-only, shared between threads.
+    """
+    def __init__(self, der, fprint_sha1=None):
+        self.der = der
+        self.fprint_sha1 = fprint_sha1 if fprint_sha1 is not None else hashlib.sha1(der).hexdigest()
+        self.crypt = util.load_x509_der(der)
+        self.fields = None  # derived Certificate column values, set by the CertificateManager
+        self._ossl = None
+        self._is_ca = None
+        self._fprint_sha256 = None
+
+    @property
+    def ossl(self):
+        """
+        pyOpenSSL certificate, loaded on demand (path validation only)
+        :return:
+        """
+        if self._ossl is None:
+            self._ossl = load_certificate(FILETYPE_ASN1, self.der)
+        return self._ossl
+
+    @property
+    def is_ca(self):
+        if self._is_ca is None:
+            self._is_ca = util.try_is_ca(self.crypt)
+        return self._is_ca
+
+    @property
+    def fprint_sha256(self):
+        if self._fprint_sha256 is None:
+            self._fprint_sha256 = util.try_get_fprint_sha256(self.crypt)
+        return self._fprint_sha256
+
+    def __repr__(self):
+        return '<ParsedCertificate(fprint_sha1=%r)>' % self.fprint_sha1
+
+
+class CertParseCache(object):
+    """
+    Bounded thread-safe LRU: DER SHA1 -> ParsedCertificate
+    """
+    def __init__(self, size=CERT_CACHE_SIZE):
+        self.cache = pylru.lrucache(size)
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, der):
+        """
+        Returns parsed certificate, parses on cache miss.
+        Parsing is done outside the lock, parse errors are propagated and not cached.
+        :param der:
+        :return:
+        :rtype: ParsedCertificate
+        """
+        der = util.to_bytes(der)
+        fprint = hashlib.sha1(der).hexdigest()
+        with self.lock:
+            if fprint in self.cache:
+                self.hits += 1
+                return self.cache[fprint]
+            self.misses += 1
+
+        parsed = ParsedCertificate(der, fprint)
+        with self.lock:
+            self.cache[fprint] = parsed
+        return parsed
+
+    def get_pem(self, pem):
+        """
+        Returns parsed certificate from the PEM
+        :param pem:
+        :return:
+        :rtype: ParsedCertificate
+        """
+        return self.get(util.pem_to_der(util.to_string(pem)))
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        return self.hits / float(total) if total else 0
+
+    def stats_str(self):
+        """
+        Simple state dump, returns string
+        :return:
+        """
+        return 'size: %s, hits: %s, misses: %s, ratio: %.3f' \
+               % (len(self.cache), self.hits, self.misses, self.hit_ratio())
@@ -7,10 +7,14 @@ import logging
 import time
 import requests
 import datetime
+import threading
 import traceback
 
+import pylru
+
 from . import errors
 from . import util
+from .cert_cache import CertParseCache
 from .trace_logger import Tracelogger
 
 
@@ -99,11 +103,27 @@ class PathValidator(object):
     """
     Validates trust path for certificates
     """
-    def __init__(self):
+    VERDICT_CACHE_SIZE = 4096
+    VERDICT_TTL = 60 * 60
+    STORE_CACHE_SIZE = 128
+
+    def __init__(self, cert_cache=None):
         self.roots = None
         self.root_store = X509Store()
         self.root_certs = []
         self.root_fprints = set()  # sha256 root fingerprints
+        self.cert_cache = cert_cache if cert_cache is not None else CertParseCache()
+
+        # (intermediate fprint, issuer fprint) -> time of the successful verification
+        self.verdict_cache = pylru.lrucache(self.VERDICT_CACHE_SIZE)
+        self.verdict_ttl = self.VERDICT_TTL
+
+        # sorted intermediate fprints -> root store with the verified intermediates
+        self.store_cache = pylru.lrucache(self.STORE_CACHE_SIZE)
+        self.cache_lock = threading.Lock()
+
+        self.num_verifications = 0
+        self.num_verdict_hits = 0
 
         self.trace_logger = Tracelogger(logger)
 
@@ -167,23 +187,82 @@ class PathValidator(object):
             cur_store.add_cert(crt)
         return cur_store
 
+    def _get_ossl_store(self, context):
+        """
+        Returns the root store layered with intermediates verified in the context.
+        The base root store is built once, stores with intermediates are cached by the intermediate set.
+        Returned stores are shared, must not be modified.
+        :param context:
+        :type context: ValidationOsslContext
+        :return:
+        """
+        if len(context.verified_certs) == 0:
+            return self.root_store
+
+        key = tuple(sorted([x[3] for x in context.verified_certs]))
+        with self.cache_lock:
+            if key in self.store_cache:
+                cur_store, created = self.store_cache[key]
+                if created + self.verdict_ttl > time.time():
+                    return cur_store
+
+        cur_store = self._new_ossl_store()
+        for crt in context.verified_certs:
+            cur_store.add_cert(crt[0])
+
+        with self.cache_lock:
+            self.store_cache[key] = (cur_store, time.time())
+        return cur_store
+
+    def _find_issuer_fprint(self, to_verify, context):
+        """
+        Fingerprint of the issuing intermediate verified in the context, None if issued by a root
+        :param to_verify:
+        :param context:
+        :type context: ValidationOsslContext
+        :return:
+        """
+        issuer = to_verify[1].issuer
+        for crt in context.verified_certs:
+            if crt[1].subject == issuer:
+                return crt[3]
+        return None
+
+    def _is_verdict_cached(self, key, to_verify):
+        """
+        True if the intermediate was successfully verified recently and is not expired now
+        :param key:
+        :param to_verify:
+        :return:
+        """
+        with self.cache_lock:
+            if key not in self.verdict_cache:
+                return False
+            verified_at = self.verdict_cache[key]
+
+        if verified_at + self.verdict_ttl <= time.time():
+            return False
+
+        try:
+            return to_verify[1].not_valid_after > datetime.datetime.utcnow()
+        except Exception:
+            return False
+
+    def _cache_verdict(self, key):
+        with self.cache_lock:
+            self.verdict_cache[key] = time.time()
+
     def _load_chain(self, chain, is_der=False):
         """
-        Parses certificates from the chain by cryptography and openssl
+        Parses certificates from the chain by cryptography and openssl, uses the parsed cert cache
         :param chain:
         :param is_der:
-        :return: [(ossl, crypt), ...]
+        :return: [(ossl, crypt, is_ca, fprint_sha256), ...]
         """
         chain_loaded = []
         for crt in chain:
-            if is_der:
-                crt_ossl = load_certificate(FILETYPE_ASN1, crt)
-                crt_cryp = util.load_x509_der(crt)
-                chain_loaded.append((crt_ossl, crt_cryp))
-            else:
-                crt_ossl = load_certificate(FILETYPE_PEM, crt)
-                crt_cryp = util.load_x509(crt)
-                chain_loaded.append((crt_ossl, crt_cryp))
+            parsed = self.cert_cache.get(crt) if is_der else self.cert_cache.get_pem(crt)
+            chain_loaded.append((parsed.ossl, parsed.crypt, parsed.is_ca, parsed.fprint_sha256))
         return chain_loaded
 
     def validate(self, chain, is_der=False):
@@ -198,12 +277,12 @@ class PathValidator(object):
         if not isinstance(chain, list):
             chain = [chain]
 
-        # parse chain certs to [(ossl certificate, cryptography certificate), ...]
+        # parse chain certs to [(ossl certificate, cryptography certificate, is_ca, fprint), ...]
         chain_loaded = self._load_chain(chain, is_der)
 
         # Sort certs to CA and non-CA certificates
         for idx, rec in enumerate(chain_loaded):
-            if util.try_is_ca(rec[1]):
+            if rec[2]:
                 result.ca_certs.append(rec[1])
             else:
                 result.leaf_certs.append(rec[1])
@@ -251,8 +330,8 @@ class PathValidator(object):
                     continue
 
                 to_verify = chain_loaded[idx]
-                is_ca_crt = util.try_is_ca(to_verify[1])
-                fprint = util.try_get_fprint_sha256(to_verify[1])
+                is_ca_crt = to_verify[2]
+                fprint = to_verify[3]
 
                 # in the intermediate mode require only CA certs
                 if interm_mode != is_ca_crt:
@@ -303,16 +382,29 @@ class PathValidator(object):
         :param context:
         :return:
         """
+        verdict_key = None
+        if interm_mode:
+            # intermediate verified before with the same issuer - skip the verification
+            verdict_key = (fprint, self._find_issuer_fprint(to_verify, context))
+            if self._is_verdict_cached(verdict_key, to_verify):
+                self.num_verdict_hits += 1
+                if fprint not in self.root_fprints and fprint not in context.verified_fprints:
+                    context.verified_certs.append(to_verify)
+                    context.verified_fprints.add(fprint)
+                return
+
         try:
             # current trust store with previously validated intermediate certificates
-            cur_store = self._new_ossl_store()
-            for crt in context.verified_certs:
-                cur_store.add_cert(crt[0])
+            cur_store = self._get_ossl_store(context)
 
             # OSSL Verification w.r.t. base store
+            self.num_verifications += 1
             store_ctx = X509StoreContext(cur_store, to_verify[0])
             store_ctx.verify_certificate()
 
+            if verdict_key is not None:
+                self._cache_verdict(verdict_key)
+
             # Add valid intermediate to the verified registers
             if interm_mode and fprint not in self.root_fprints and fprint not in context.verified_fprints:
                 context.verified_certs.append(to_verify)
@@ -9,6 +9,7 @@ from past.builtins import cmp
 from future.utils import iteritems
 
 import base64
+import collections
 import json
 import hashlib
 import logging
@@ -18,10 +19,11 @@ from cryptography.x509 import Certificate as X509Certificate
 import sqlalchemy as salch
 
 from . import util, util_cert
+from .cert_cache import CertParseCache
 from .errors import Error
 from .tls_domain_tools import TlsDomainTools
 from .consts import CertSigAlg
-from .dbutil import Certificate, CertificateAltName, DbHandshakeScanJobResult
+from .dbutil import Certificate, CertificateAltName, DbHandshakeScanJobResult, DbHelper
 from .database_manager import DatabaseManager
 from .trace_logger import Tracelogger
 
@@ -33,11 +35,13 @@ class CertificateManager(object):
     """
     Base certificate manager for certificate related tasks
     """
+    BULK_SIZE = 200
 
     def __init__(self):
         self.db = None
         self.config = None
         self.db_manager = None  # type: DatabaseManager
+        self.cert_cache = CertParseCache()
         self.trace_logger = Tracelogger(logger)
 
     def init(self, **kwargs):
@@ -54,6 +58,8 @@ class CertificateManager(object):
             self.trace_logger = kwargs.get('trace_logger')
         if 'db_manager' in kwargs:
             self.db_manager = kwargs.get('db_manager')
+        if 'cert_cache' in kwargs:
+            self.cert_cache = kwargs.get('cert_cache')
 
     #
     # Base certificate processing
@@ -61,63 +67,80 @@ class CertificateManager(object):
 
     def parse_certificate(self, cert_db, pem=None, der=None, **kwargs):
         """
-        Parses the certificate, returns the parsed cert
+        Parses the certificate, returns the parsed cert.
+        Parsed certificates and derived fields are cached by the DER fingerprint.
         :param cert_db:
         :param pem:
         :param der:
         :return: (cryptography cert)
         :rtype: X509Certificate
         """
-        cert = None  # type: X509Certificate
         if pem is not None:
-            cert = util.load_x509_der(util.pem_to_der(pem))
-        elif der is not None:
-            cert = util.load_x509_der(der)
-        elif cert_db is not None and cert_db.pem is not None:
-            cert = util.load_x509_der(util.pem_to_der(cert_db.pem))
-        else:
+            der = util.pem_to_der(pem)
+        elif der is None and cert_db is not None and cert_db.pem is not None:
+            der = util.pem_to_der(cert_db.pem)
+        elif der is None:
             raise ValueError('No certificate provided')
 
-        alt_names = [util.utf8ize(x) for x in util.try_get_san(cert)]
-
-        cert_db.cname = util.utf8ize(util.try_get_cname(cert))
-        cert_db.fprint_sha1 = util.lower(util.try_get_fprint_sha1(cert))
-        cert_db.fprint_sha256 = util.lower(util.try_get_fprint_sha256(cert))
-        cert_db.valid_from = util.dt_norm(cert.not_valid_before)
-        cert_db.valid_to = util.dt_norm(cert.not_valid_after)
-        cert_db.subject = util.utf8ize(util.get_dn_string(cert.subject))
-        cert_db.issuer = util.utf8ize(util.get_dn_string(cert.issuer))
-        cert_db.is_ca = util.try_is_ca(cert)
-        cert_db.is_precert = util.try_is_precert(cert)
-        cert_db.is_precert_ca = util.try_is_precert_ca(cert)
-        cert_db.is_self_signed = util.try_is_self_signed(cert)
-        cert_db.is_le = 'Let\'s Encrypt' in cert_db.issuer
-
-        cert_db.sig_alg = CertSigAlg.oid_to_const(cert.signature_algorithm_oid)
-        cert_db.key_type = util_cert.try_get_key_type(cert.public_key())
-        cert_db.key_bit_size = util_cert.try_get_pubkey_size(cert.public_key())
-
-        cert_db.subject_key_info = util.take(util.lower(util.b16encode(
-            util.try_get_subject_key_identifier(cert))), 64)
-        cert_db.authority_key_info = util.take(util.lower(util.b16encode(
-            util.try_get_authority_key_identifier(cert))), 64)
-
-        cert_db.is_ev = util_cert.try_cert_is_ev(cert)
-        cert_db.is_ov = not util.is_empty(util.try_get_org_name(cert))
-        cert_db.is_cn_wildcard = util_cert.is_cname_wildcard(cert_db.cname)
-        cert_db.is_alt_wildcard = util_cert.num_wildcard_alts(alt_names) > 0
-        cert_db.issuer_o = util.take(util.utf8ize(util.try_get_issuer_org(cert)), 64)
+        parsed = self.cert_cache.get(der)
+        if parsed.fields is None:
+            parsed.fields = self._get_cert_fields(parsed.crypt)
 
-        alt_name_test = list(alt_names)
-        if not util.is_empty(cert_db.cname):
-            alt_name_test.append(cert_db.cname)
+        for key, val in iteritems(parsed.fields):
+            setattr(cert_db, key, val)
+        cert_db.alt_names_arr = list(parsed.fields['alt_names_arr'])
+        return parsed.crypt
 
-        cert_db.is_cloudflare = len(util_cert.cloudflare_altnames(alt_name_test)) > 0
-        cert_db.alt_names_arr = alt_names
-        cert_db.alt_names = json.dumps(alt_names)
-        cert_db.alt_names_cnt = len(alt_names)
+    def _get_cert_fields(self, cert):
+        """
+        Computes Certificate model fields from the parsed certificate
+        :param cert:
+        :type cert: X509Certificate
+        :return: field name -> value
+        :rtype: dict
+        """
+        alt_names = [util.utf8ize(x) for x in util.try_get_san(cert)]
+        cname = util.utf8ize(util.try_get_cname(cert))
+        issuer = util.utf8ize(util.get_dn_string(cert.issuer))
 
-        return cert
+        alt_name_test = list(alt_names)
+        if not util.is_empty(cname):
+            alt_name_test.append(cname)
+
+        return {
+            'cname': cname,
+            'fprint_sha1': util.lower(util.try_get_fprint_sha1(cert)),
+            'fprint_sha256': util.lower(util.try_get_fprint_sha256(cert)),
+            'valid_from': util.dt_norm(cert.not_valid_before),
+            'valid_to': util.dt_norm(cert.not_valid_after),
+            'subject': util.utf8ize(util.get_dn_string(cert.subject)),
+            'issuer': issuer,
+            'is_ca': util.try_is_ca(cert),
+            'is_precert': util.try_is_precert(cert),
+            'is_precert_ca': util.try_is_precert_ca(cert),
+            'is_self_signed': util.try_is_self_signed(cert),
+            'is_le': 'Let\'s Encrypt' in issuer,
+
+            'sig_alg': CertSigAlg.oid_to_const(cert.signature_algorithm_oid),
+            'key_type': util_cert.try_get_key_type(cert.public_key()),
+            'key_bit_size': util_cert.try_get_pubkey_size(cert.public_key()),
+
+            'subject_key_info': util.take(util.lower(util.b16encode(
+                util.try_get_subject_key_identifier(cert))), 64),
+            'authority_key_info': util.take(util.lower(util.b16encode(
+                util.try_get_authority_key_identifier(cert))), 64),
+
+            'is_ev': util_cert.try_cert_is_ev(cert),
+            'is_ov': not util.is_empty(util.try_get_org_name(cert)),
+            'is_cn_wildcard': util_cert.is_cname_wildcard(cname),
+            'is_alt_wildcard': util_cert.num_wildcard_alts(alt_names) > 0,
+            'issuer_o': util.take(util.utf8ize(util.try_get_issuer_org(cert)), 64),
+
+            'is_cloudflare': len(util_cert.cloudflare_altnames(alt_name_test)) > 0,
+            'alt_names_arr': tuple(alt_names),
+            'alt_names': json.dumps(alt_names),
+            'alt_names_cnt': len(alt_names),
+        }
 
     @staticmethod
     def pem_chain_to_array(pem_file):
@@ -298,6 +321,116 @@ class CertificateManager(object):
         _close_s()
         raise Error('Could not store / load certificate')
 
+    def add_certs_bulk(self, s, certs, fetch_first=True, add_alts=True):
+        """
+        Stores many parsed certificates at once, certificates are deduplicated by the SHA1 fingerprint.
+        Certificates, alt names and domain names are inserted with multi-row INSERT IGNORE,
+        certificates are then loaded with one query. Commits the transaction.
+        Falls back to add_cert_or_fetch() per certificate if the bulk insert fails.
+        Certificates in an insert chunk partially inserted by a concurrent worker are reported as existing.
+        :param s:
+        :param certs:
+        :type certs: list[Certificate]
+        :param fetch_first: loads existing certificates first, inserts only the missing ones
+        :param add_alts:
+        :return: fprint_sha1 -> stored certificate, trans_is_new set
+        :rtype: dict[string -> Certificate]
+        """
+        uniq = collections.OrderedDict()
+        for cert_db in certs:
+            if cert_db is None or util.is_empty(cert_db.fprint_sha1):
+                continue
+            fprint = util.lower(cert_db.fprint_sha1)
+            if fprint not in uniq:
+                uniq[fprint] = cert_db
+
+        if len(uniq) == 0:
+            return {}
+
+        ret = self.cert_load_fprints(s, list(uniq.keys())) if fetch_first else {}
+        for cert in ret.values():
+            cert.trans_is_new = 0
+
+        to_insert = [x for x in uniq.keys() if x not in ret]
+        if len(to_insert) == 0:
+            return ret
+
+        try:
+            new_fprints = set()
+            for sub in util.chunk(to_insert, self.BULK_SIZE):
+                rows = [self._cert_row(uniq[x]) for x in sub]
+                res = s.execute(DbHelper.insert_ignore(Certificate.__table__).values(rows))
+
+                # rows inserted meanwhile by a concurrent worker are skipped by INSERT IGNORE,
+                # the chunk is new only if all its rows were inserted
+                if res.rowcount == len(sub):
+                    new_fprints.update(sub)
+                else:
+                    logger.debug('Concurrent certificate insert, %s of %s inserted' % (res.rowcount, len(sub)))
+
+            inserted = self.cert_load_fprints(s, to_insert)
+            for fprint, cert in inserted.items():
+                cert.trans_is_new = 1 if fprint in new_fprints else 0
+
+            if add_alts:
+                self._add_alt_names_bulk(s, [(inserted[x].id, uniq[x].alt_names_arr)
+                                             for x in to_insert if x in inserted])
+            s.commit()
+            ret.update(inserted)
+
+        except Exception as e:
+            self.trace_logger.log(e, custom_msg='Bulk certificate insert failed')
+            s.rollback()
+            for fprint in to_insert:
+                try:
+                    cert, is_new = self.add_cert_or_fetch(s, uniq[fprint], fetch_first=True, add_alts=add_alts)
+                    cert.trans_is_new = is_new
+                    ret[fprint] = cert
+
+                except Exception as e:
+                    logger.error('Exception when storing a certificate %s: %s' % (fprint, e))
+                    self.trace_logger.log(e)
+
+        return ret
+
+    def _cert_row(self, cert_db):
+        """
+        Certificate insert row
+        :param cert_db:
+        :type cert_db: Certificate
+        :return:
+        """
+        row = DbHelper.to_dict(cert_db)
+        del row['id']
+        row['fprint_sha1'] = util.lower(row['fprint_sha1'])
+        if row['created_at'] is None:
+            row['created_at'] = salch.func.now()
+        if row['updated_at'] is None:
+            row['updated_at'] = salch.func.now()
+        return row
+
+    def _add_alt_names_bulk(self, s, certs_alts):
+        """
+        Inserts alt names of the certificates and the alt name domains. Does not commit.
+        :param s:
+        :param certs_alts: list of (cert id, alt names)
+        :return:
+        """
+        rows = []
+        domain_names = []
+        for cert_id, alt_names in certs_alts:
+            for alt_name in util.stable_uniq(util.compact(alt_names)):
+                is_wildcard = TlsDomainTools.has_wildcard(alt_name)
+                rows.append({'cert_id': cert_id, 'alt_name': alt_name, 'is_wildcard': is_wildcard})
+                if not is_wildcard:
+                    domain_names.append(alt_name)
+
+        for sub in util.chunk(rows, self.BULK_SIZE * 5):
+            s.execute(DbHelper.insert_ignore(CertificateAltName.__table__).values(sub))
+
+        # Live migration to domain database
+        self.db_manager.load_domain_names_bulk(s, domain_names)
+
     #
     # Cert processing
     #
@@ -376,28 +509,30 @@ class CertificateManager(object):
         cert_existing = self.cert_load_fprints(s, list(fprints_handshake))
         leaf_cert_id = None
         all_cert_ids = set()
-        num_new_results = 0
         prev_id = None
         all_certs = []
 
-        # store non-existing certificates from the chain to the database
+        # store non-existing certificates from the chain to the database at once
+        for cert_db, cert, alt_names, der in local_db:
+            cert_db.created_at = salch.func.now()
+            cert_db.pem = base64.b64encode(der)
+            cert_db.source = kwargs.get('source', 'handshake')
+
+        cert_stored = self.add_certs_bulk(s, [x[0] for x in local_db if x[0].fprint_sha1 not in cert_existing],
+                                          fetch_first=False, add_alts=True)
+        num_new_results = len([x for x in cert_stored.values() if x.trans_is_new])
+
         for endb in reversed(local_db):
             cert_db, cert, alt_names, der = endb
             fprint = cert_db.fprint_sha1
 
             try:
-                cert_db.created_at = salch.func.now()
-                cert_db.pem = base64.b64encode(der)
-                cert_db.source = kwargs.get('source', 'handshake')
-
-                # new certificate - add
-                # lockfree - add, if exception on add, try fetch, then again add,
-                if fprint not in cert_existing:
-                    cert_db, is_new_cert = self.add_cert_or_fetch(s, cert_db, add_alts=True)  # type: tuple[Certificate, bool]
-                    if is_new_cert:
-                        num_new_results += 1
-                else:
+                if fprint in cert_existing:
                     cert_db = cert_existing[fprint]
+                elif fprint in cert_stored:
+                    cert_db = cert_stored[fprint]
+                else:
+                    continue
 
                 if cert_db.parent_id is None:
                     cert_db.parent_id = prev_id
@@ -137,6 +137,141 @@ class Config(object):
     def periodic_workers(self, val):
         self.set_config('periodic_workers', val)
 
+    # Workers for concurrent network scans within periodic jobs
+    @property
+    def periodic_scan_workers(self):
+        return self.get_config('periodic_scan_workers', 32)
+
+    @periodic_scan_workers.setter
+    def periodic_scan_workers(self, val):
+        self.set_config('periodic_scan_workers', val)
+
+    # Workers for the IP range sweep
+    @property
+    def ip_scan_workers(self):
+        return self.get_config('ip_scan_workers', 16)
+
+    @ip_scan_workers.setter
+    def ip_scan_workers(self, val):
+        self.set_config('ip_scan_workers', val)
+
+    # TCP connect pre-probe in the IP range sweep
+    @property
+    def ip_scan_pre_probe(self):
+        return self.get_config('ip_scan_pre_probe', True)
+
+    @ip_scan_pre_probe.setter
+    def ip_scan_pre_probe(self, val):
+        self.set_config('ip_scan_pre_probe', val)
+
+    # DB connection pool size
+    @property
+    def db_pool_size(self):
+        return self.get_config('db_pool_size', 200)
+
+    @db_pool_size.setter
+    def db_pool_size(self, val):
+        self.set_config('db_pool_size', val)
+
+    # DB connection pool overflow
+    @property
+    def db_max_overflow(self):
+        return self.get_config('db_max_overflow', 32)
+
+    @db_max_overflow.setter
+    def db_max_overflow(self, val):
+        self.set_config('db_max_overflow', val)
+
+    # DB connection checkout timeout
+    @property
+    def db_pool_timeout(self):
+        return self.get_config('db_pool_timeout', 30)
+
+    @db_pool_timeout.setter
+    def db_pool_timeout(self, val):
+        self.set_config('db_pool_timeout', val)
+
+    # Per-subsystem DB connection quotas, subsystem -> max connections. None for defaults
+    @property
+    def db_pool_quotas(self):
+        return self.get_config('db_pool_quotas', None)
+
+    @db_pool_quotas.setter
+    def db_pool_quotas(self, val):
+        self.set_config('db_pool_quotas', val)
+
+    # Warn if DB connection is held for longer than this number of seconds
+    @property
+    def db_session_warn_time(self):
+        return self.get_config('db_session_warn_time', 30)
+
+    @db_session_warn_time.setter
+    def db_session_warn_time(self, val):
+        self.set_config('db_session_warn_time', val)
+
+    # crt.sh requests per second, shared by all workers
+    @property
+    def crtsh_rate(self):
+        return self.get_config('crtsh_rate', 8)
+
+    @crtsh_rate.setter
+    def crtsh_rate(self, val):
+        self.set_config('crtsh_rate', val)
+
+    # Concurrent crt.sh certificate downloads per query
+    @property
+    def crtsh_download_workers(self):
+        return self.get_config('crtsh_download_workers', 8)
+
+    @crtsh_download_workers.setter
+    def crtsh_download_workers(self, val):
+        self.set_config('crtsh_download_workers', val)
+
+    # crt.sh index queries in the JSON output mode instead of the HTML page
+    @property
+    def crtsh_json(self):
+        return self.get_config('crtsh_json', False)
+
+    @crtsh_json.setter
+    def crtsh_json(self, val):
+        self.set_config('crtsh_json', val)
+
+    # Deadline in seconds for one connect analysis HTTP probe, counted from the probe start
+    @property
+    def probe_deadline(self):
+        return self.get_config('probe_deadline', 20)
+
+    @probe_deadline.setter
+    def probe_deadline(self, val):
+        self.set_config('probe_deadline', val)
+
+    # In-process DNS cache for the scans and HTTP probes
+    @property
+    def dns_cache(self):
+        return self.get_config('dns_cache', True)
+
+    @dns_cache.setter
+    def dns_cache(self, val):
+        self.set_config('dns_cache', val)
+
+    # Max number of jobs reserved in one Redis queue pop
+    @property
+    def redis_pop_batch(self):
+        return self.get_config('redis_pop_batch', 50)
+
+    @redis_pop_batch.setter
+    def redis_pop_batch(self, val):
+        self.set_config('redis_pop_batch', val)
+
+    # Reuse keep-alive connections for the target HTTP probes (fresh connection per probe by default)
+    @property
+    def probe_keepalive(self):
+        return self.get_config('probe_keepalive', False)
+
+    @probe_keepalive.setter
+    def probe_keepalive(self, val):
+        self.set_config('probe_keepalive', val)
+
     # Max servers per user
     @property
     def keychest_max_servers(self):
@@ -182,6 +317,33 @@ class Config(object):
     def master_apikey(self, val):
         self.set_config('master_apikey', val)
 
+    # Agent: max number of scans in one published batch
+    @property
+    def agent_publish_batch(self):
+        return self.get_config('agent_publish_batch', 50)
+
+    @agent_publish_batch.setter
+    def agent_publish_batch(self, val):
+        self.set_config('agent_publish_batch', val)
+
+    # Agent: max time in milliseconds a scan waits for the batch to fill up
+    @property
+    def agent_publish_delay(self):
+        return self.get_config('agent_publish_delay', 500)
+
+    @agent_publish_delay.setter
+    def agent_publish_delay(self, val):
+        self.set_config('agent_publish_delay', val)
+
+    # Agent: spool file with batches not yet delivered to the master, in the config dir by default
+    @property
+    def agent_spool(self):
+        return self.get_config('agent_spool', None)
+
+    @agent_spool.setter
+    def agent_spool(self, val):
+        self.set_config('agent_spool', val)
+
     # Workers - key test scanner
     @property
     def workers_roca(self):
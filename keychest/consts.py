@@ -67,6 +67,7 @@ class DbScanType(object):
 class BlacklistRuleType(object):
     SUFFIX = 0
     MATCH = 1
+    CIDR = 2
 
 
 class CrtshInputType(object):
@@ -3,15 +3,18 @@
 
 import json
 import logging
+import threading
 import time
-import requests
-from lxml import html
+from lxml import html, etree
 import datetime
 import re
 import traceback
 
+import concurrent.futures
+
 from . import util
 from . import errors
+from .http_pool import HttpSessionPool
 
 import requests.exceptions as rex
 
@@ -164,21 +167,233 @@ class CrtShRevocation(object):
                % (self.mechanism, self.provider, self.status, self.revoked_by, self.revoked_at)
 
 
+#
+# Parsers
+#
+
+
+class CrtShIndexParser(object):
+    """
+    Streaming crt.sh index page parser.
+    Page is fed in chunks, records are yielded as soon as the row is parsed and the parsed rows are
+    dropped, the whole DOM is never built. Same semantics as the former DOM + XPath parser:
+    rows of the first nested table, header row skipped.
+    """
+    def __init__(self, encoding=None):
+        self.parser = etree.HTMLPullParser(events=('start', 'end'), tag=('table', 'tr'), encoding=encoding)
+        self.table_depth = 0
+        self.in_results = False
+        self.results_done = False
+        self.row_idx = 0
+        self.days = {}  # date parsing cache, dates repeat a lot on the page
+
+    def parse(self, chunks):
+        """
+        Parses the page chunks, generator of CrtShIndexRecord
+        :param chunks: iterable of page data chunks
+        :return:
+        """
+        for chunk in chunks:
+            if not chunk:
+                continue
+            self.parser.feed(chunk)
+            for rec in self._read_events():
+                yield rec
+
+        self.parser.close()
+        for rec in self._read_events():
+            yield rec
+
+    def _read_events(self):
+        """
+        Processes the parser events collected so far
+        :return:
+        """
+        for event, elem in self.parser.read_events():
+            if elem.tag == 'table':
+                if event == 'start':
+                    self.table_depth += 1
+                    if self.table_depth == 2 and not self.results_done:
+                        self.in_results = True
+                else:
+                    if self.table_depth == 2 and self.in_results:
+                        self.in_results = False
+                        self.results_done = True
+                    self.table_depth -= 1
+                continue
+
+            if event != 'end' or not self.in_results or self.table_depth != 2:
+                continue
+
+            rec = self.parse_row(elem) if self.row_idx > 0 else None
+            self.row_idx += 1
+
+            # drop processed rows so the tree does not grow
+            elem.clear()
+            parent = elem.getparent()
+            if parent is not None:
+                parent.remove(elem)
+
+            if rec is not None:
+                yield rec
+
+    def parse_row(self, row):
+        """
+        Parses one result table row
+        :param row:
+        :return:
+        :rtype: CrtShIndexRecord
+        """
+        cells = list(row)
+        col_cnt = len(cells)
+
+        cur_res = CrtShIndexRecord()
+        cur_res.id = self._text(cells[0])
+        cur_res.logged_at = self.parse_day(self._text(cells[1]))
+        cur_res.not_before = self.parse_day(self._text(cells[2]))
+
+        ca_offset = 0
+        if col_cnt >= 5:
+            cur_res.identity = self._text(cells[3])
+            ca_offset += 1
+
+        cur_res.ca_dn = self._text(cells[3 + ca_offset])
+        try:
+            ca_href = util.strip(cells[3 + ca_offset][0].get('href'))
+            if not util.is_empty(ca_href):
+                cur_res.ca_id = int(ca_href.rsplit('=', 1)[1])
+        except:
+            pass
+
+        return cur_res
+
+    def parse_day(self, txt):
+        """
+        Parses YYYY-MM-DD to the unix time, cached
+        :param txt:
+        :return:
+        """
+        ts = self.days.get(txt)
+        if ts is None:
+            ts = util.unix_time(datetime.datetime.strptime(txt, '%Y-%m-%d'))
+            self.days[txt] = ts
+        return ts
+
+    def parse_json(self, data):
+        """
+        Parses the JSON index output (output=json), generator of CrtShIndexRecord.
+        Certificates listed multiple times (one entry per name) are reported once.
+        :param data:
+        :return:
+        """
+        seen = set()
+        for js in json.loads(data) or []:
+            crt_id = util.defval(js.get('id'), js.get('min_cert_id'))
+            if crt_id is None or crt_id in seen:
+                continue
+            seen.add(crt_id)
+
+            cur_res = CrtShIndexRecord(crtid='%s' % crt_id)
+            logged_at = util.defval(js.get('entry_timestamp'), js.get('min_entry_timestamp'))
+            if logged_at is not None:
+                cur_res.logged_at = self.parse_day(logged_at[:10])
+            if js.get('not_before') is not None:
+                cur_res.not_before = self.parse_day(js.get('not_before')[:10])
+
+            cur_res.identity = util.strip(js.get('name_value'))
+            cur_res.ca_dn = util.strip(js.get('issuer_name'))
+            if js.get('issuer_ca_id') is not None:
+                cur_res.ca_id = int(js.get('issuer_ca_id'))
+            yield cur_res
+
+    def _text(self, elem):
+        """
+        text_content() equivalent, fast path for the typical cells: plain text or a single link
+        :param elem:
+        :return:
+        """
+        if len(elem) == 0:
+            return util.strip(elem.text or '')
+
+        child = elem[0]
+        if len(elem) == 1 and len(child) == 0 and not util.strip(elem.text) and not util.strip(child.tail):
+            return util.strip(child.text or '')
+
+        return util.strip(''.join(elem.itertext()))
+
+
 #
 # Processor
 #
 
 
+class RateLimiter(object):
+    """
+    Token bucket rate limiter, thread-safe
+    """
+    def __init__(self, rate=None, burst=None):
+        """
+        :param rate: requests per second, None or 0 disables the limit
+        :param burst: bucket size
+        """
+        self.rate = rate
+        self.burst = burst
+        self.tokens = None
+        self.last = time.time()
+        self.lock = threading.Lock()
+        self.num_waits = 0
+
+    def _burst(self):
+        return self.burst if self.burst is not None else max(1.0, float(self.rate))
+
+    def acquire(self):
+        """
+        Blocks until the request is allowed
+        :return: time waited
+        """
+        waited = 0
+        while True:
+            with self.lock:
+                if not self.rate:
+                    return waited
+
+                now = time.time()
+                burst = self._burst()
+                tokens = burst if self.tokens is None else self.tokens
+                self.tokens = min(burst, tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return waited
+
+                to_wait = (1 - self.tokens) / float(self.rate)
+                self.num_waits += 1
+
+            time.sleep(to_wait)
+            waited += to_wait
+
+
 class CrtProcessor(object):
     """
     crt.sh parser
     """
 
     BASE_URL = 'https://crt.sh/'
+    DEFAULT_RATE = 8
+    DEFAULT_DOWNLOAD_WORKERS = 8
+    STREAM_CHUNK = 64 * 1024
+
+    # crt.sh request rate limit shared by all processors
+    rate_limiter = RateLimiter(rate=DEFAULT_RATE)
 
-    def __init__(self, timeout=3, attempts=2):
+    def __init__(self, timeout=3, attempts=2, download_workers=None, output_json=False):
         self.timeout = timeout
         self.attempts = attempts
+        self.download_workers = util.defval(download_workers, self.DEFAULT_DOWNLOAD_WORKERS)
+        self.output_json = output_json  # index query in the JSON output mode
+
+        # keep-alive connections to crt.sh, shared by the download workers
+        self.http_pool = HttpSessionPool(pool_connections=1, pool_maxsize=max(4, self.download_workers))
 
     def download_crt(self, crt_id, **kwargs):
         """
@@ -193,7 +408,8 @@ class CrtProcessor(object):
         timeout = kwargs.get('timeout', self.timeout)
         for attempt in range(attempts):
             try:
-                res = requests.get(self.BASE_URL, params={'d': crt_id}, timeout=timeout)
+                self.rate_limiter.acquire()
+                res = self.http_pool.get(self.BASE_URL, params={'d': crt_id}, timeout=timeout)
                 res.raise_for_status()
 
                 ret.attempts = attempt
@@ -218,6 +434,44 @@ class CrtProcessor(object):
 
         return None
 
+    def download_crts(self, crt_ids, workers=None, **kwargs):
+        """
+        Downloads certificates concurrently over the keep-alive connections.
+        Generator, yields (crt_id, CrtShCertResponse) as the downloads finish so the caller
+        can process the certificates while the rest is being downloaded.
+        Failed downloads yield the unsuccessful response.
+        :param crt_ids:
+        :param workers: number of concurrent downloads
+        :param kwargs: download_crt() arguments
+        :return:
+        """
+        crt_ids = list(crt_ids)
+        if len(crt_ids) == 0:
+            return
+
+        workers = max(1, min(len(crt_ids), util.defval(workers, self.download_workers)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            futures = dict([(executor.submit(self._try_download_crt, crt_id, **kwargs), crt_id)
+                            for crt_id in crt_ids])
+            for future in concurrent.futures.as_completed(futures):
+                yield futures[future], future.result()
+
+    def _try_download_crt(self, crt_id, **kwargs):
+        """
+        download_crt() returning unsuccessful response on the failure
+        :param crt_id:
+        :param kwargs:
+        :return:
+        :rtype: CrtShCertResponse
+        """
+        try:
+            ret = self.download_crt(crt_id, **kwargs)
+            return ret if ret is not None else CrtShCertResponse(crtid=crt_id)
+
+        except CrtShException as e:
+            logger.debug('Download of %s failed: %s' % (crt_id, e))
+            return e.scan_result if e.scan_result is not None else CrtShCertResponse(crtid=crt_id)
+
     def query(self, query=None, **kwargs):
         """
         Query domain on crt.sh
@@ -228,6 +482,7 @@ class CrtProcessor(object):
         attempts = kwargs.get('attempts', self.attempts)
         timeout = kwargs.get('timeout', self.timeout)
         expect_detail = kwargs.get('expect_detail', False)
+        output_json = kwargs.get('output_json', self.output_json)
         sha256 = kwargs.get('sha256', None)
         sha1 = kwargs.get('sha1', None)
         ret = None
@@ -246,19 +501,32 @@ class CrtProcessor(object):
             ret = CrtShIndexResponse(query=query)
 
         svc_query = re.sub(r'\\*_', '\\_', query)
+        params = {'q': svc_query}
+        if output_json and not expect_detail:
+            params['output'] = 'json'
+
+        # HTML index page is parsed while being downloaded
+        stream = not expect_detail and not output_json
         for attempt in range(attempts):
             try:
-                res = requests.get(self.BASE_URL, params={'q': svc_query}, timeout=timeout)
-                res.raise_for_status()
-                data = res.text
+                self.rate_limiter.acquire()
+                res = self.http_pool.get(self.BASE_URL, params=params, timeout=timeout, stream=stream)
+                try:
+                    res.raise_for_status()
+                    ret.attempts = attempt
+                    if expect_detail:
+                        self.parse_detail(ret, res.text)
+                    elif output_json:
+                        ret.results = []
+                        self.parse_index_json(ret, res.text)
+                    else:
+                        ret.results = []
+                        self.parse_index_stream(ret, res)
 
-                ret.attempts = attempt
-                ret.time_end = time.time()
-                if expect_detail:
-                    self.parse_detail(ret, data)
-                else:
-                    self.parse_index_page(ret, data)
+                finally:
+                    res.close()
 
+                ret.time_end = time.time()
                 ret.success = True
                 return ret
 
@@ -285,42 +553,31 @@ class CrtProcessor(object):
         :param data: 
         :return: 
         """
-        tree = html.fromstring(data)
-        res_table = tree.xpath('//table//table')
-        if util.is_empty(res_table):
-            return ret
-
-        res_table = res_table[0]
-        if len(res_table) <= 1:
-            return ret
-
-        rows = res_table[1:]
-        for row in rows:
-            col_cnt = len(row)
-
-            cur_res = CrtShIndexRecord()
-            cur_res.id = util.strip(row[0].text_content())
-
-            cur_res.logged_at = util.unix_time(datetime.datetime.strptime(
-                util.strip(row[1].text_content()), '%Y-%m-%d'))
-            cur_res.not_before = util.unix_time(datetime.datetime.strptime(
-                util.strip(row[2].text_content()), '%Y-%m-%d'))
-
-            ca_offset = 0
-            if col_cnt >= 5:
-                cur_res.identity = util.strip(row[3].text_content())
-                ca_offset += 1
-
-            cur_res.ca_dn = util.strip(row[3 + ca_offset].text_content())
-            try:
-                ca_href = util.strip(row[3 + ca_offset][0].attrib['href'])
-                if not util.is_empty(ca_href):
-                    cur_res.ca_id = int(ca_href.rsplit('=', 1)[1])
-            except:
-                pass
+        for rec in CrtShIndexParser().parse([data]):
+            ret.add(rec)
+        return ret
 
-            ret.add(cur_res)
+    def parse_index_stream(self, ret, res):
+        """
+        Parses index page from the streamed response
+        :param ret:
+        :param res: requests response with stream=True
+        :return:
+        """
+        parser = CrtShIndexParser(encoding=res.encoding or 'utf-8')
+        for rec in parser.parse(res.iter_content(chunk_size=self.STREAM_CHUNK)):
+            ret.add(rec)
+        return ret
 
+    def parse_index_json(self, ret, data):
+        """
+        Parses index in the JSON output mode
+        :param ret:
+        :param data:
+        :return:
+        """
+        for rec in CrtShIndexParser().parse_json(data):
+            ret.add(rec)
         return ret
 
     def detail(self, crt_id):
@@ -332,7 +589,8 @@ class CrtProcessor(object):
         ret = CrtShDetailResponse(crtid=crt_id)
         for attempt in range(self.attempts):
             try:
-                res = requests.get(self.BASE_URL, params={'id': crt_id}, timeout=self.timeout)
+                self.rate_limiter.acquire()
+                res = self.http_pool.get(self.BASE_URL, params={'id': crt_id}, timeout=self.timeout)
                 res.raise_for_status()
                 data = res.text
 
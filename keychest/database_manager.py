@@ -81,6 +81,40 @@ class DatabaseManager(object):
                             log_message='domain name fetch/save error: %s' % domain_name)
         return ret
 
+    def load_domain_names_bulk(self, s, domain_names, batch_size=500):
+        """
+        Inserts missing domain names and their top domains with multi-row INSERT IGNORE.
+        Existing records are left intact. Does not commit.
+        :param s:
+        :param domain_names:
+        :param batch_size:
+        :return: number of domain names processed
+        """
+        domain_names = util.stable_uniq(util.compact(domain_names))
+        if len(domain_names) == 0:
+            return 0
+
+        domain_tops = {}
+        for domain_name in domain_names:
+            try:
+                domain_tops[domain_name] = TlsDomainTools.get_top_domain(TlsDomainTools.parse_fqdn(domain_name))
+            except Exception:
+                domain_tops[domain_name] = None
+
+        # top domains, one follow-up select for ids
+        top_domains = util.stable_uniq([x for x in domain_tops.values() if not util.is_empty(x)])
+        top_ids = {}
+        for sub in util.chunk(top_domains, batch_size):
+            s.execute(DbHelper.insert_ignore(DbBaseDomain.__table__).values([{'domain_name': x} for x in sub]))
+            for rec in s.query(DbBaseDomain.id, DbBaseDomain.domain_name)\
+                    .filter(DbBaseDomain.domain_name.in_(sub)).all():
+                top_ids[rec.domain_name] = rec.id
+
+        for sub in util.chunk(domain_names, batch_size):
+            rows = [{'domain_name': x, 'top_domain_id': top_ids.get(domain_tops[x])} for x in sub]
+            s.execute(DbHelper.insert_ignore(DbDomainName.__table__).values(rows))
+        return len(domain_names)
+
     def try_load_top_domain(self, s, domain):
         """
         Determines top domain & loads / inserts it to the DB
@@ -297,6 +331,18 @@ class DatabaseManager(object):
             .values(last_scan_at=salch.func.now())
         s.execute(stmt)
 
+    def update_watch_next_scan_at(self, s, updates):
+        """
+        Bulk update of the next scan time for the watch targets
+        :param s:
+        :param updates: list of dicts {b_id: watch_id, b_next_scan_at: datetime}
+        :return:
+        """
+        stmt = salch.update(DbWatchTarget) \
+            .where(DbWatchTarget.id == salch.bindparam('b_id')) \
+            .values(next_scan_at=salch.bindparam('b_next_scan_at'))
+        s.execute(stmt, updates)
+
     def update_watch_ip_type(self, s, target, domain=None):
         """
         Fixes IP type for new watches
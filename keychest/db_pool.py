@@ -0,0 +1,272 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Instrumented SQLAlchemy connection pool with per-subsystem connection quotas.
+
+Threads are tagged with the subsystem they belong to (periodic workers, redis workers, API, ...),
+a connection checkout in the thread counts against the subsystem quota.
+Pool metrics: checkout wait time, in-use connections, overflow events, long held connections.
+"""
+
+import logging
+import threading
+import time
+
+from sqlalchemy import exc as sa_exc
+from sqlalchemy.pool import QueuePool
+
+
+__author__ = 'dusanklinec'
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_SUBSYSTEM = 'other'
+
+# Default per-subsystem quotas, subsystems not listed are unlimited (pool bound only)
+DEFAULT_QUOTAS = {
+    'periodic': 120,
+    'redis': 40,
+    'feeder': 4,
+    'agent': 8,
+    'api': 16,
+    'modules': 16,
+}
+
+_thread_local = threading.local()
+
+
+def set_subsystem(name):
+    """
+    Tags the current thread with the subsystem name for DB connection quotas
+    :param name:
+    :return:
+    """
+    _thread_local.subsystem = name
+
+
+def get_subsystem():
+    """
+    Returns subsystem the current thread belongs to
+    :return:
+    """
+    return getattr(_thread_local, 'subsystem', None) or DEFAULT_SUBSYSTEM
+
+
+class DbQuota(object):
+    """
+    Counting quota with timeouted acquire, Python 2 compatible
+    """
+    def __init__(self, limit=None):
+        self.limit = limit
+        self.used = 0
+        self.cond = threading.Condition(threading.Lock())
+
+    def acquire(self, timeout=None):
+        """
+        Acquires one connection slot
+        :param timeout:
+        :return: True if acquired
+        """
+        with self.cond:
+            if self.limit is None:
+                self.used += 1
+                return True
+
+            deadline = None if timeout is None else time.time() + timeout
+            while self.used >= self.limit:
+                remaining = None if deadline is None else deadline - time.time()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self.cond.wait(remaining)
+
+            self.used += 1
+            return True
+
+    def release(self):
+        """
+        Releases the slot
+        :return:
+        """
+        with self.cond:
+            self.used -= 1
+            self.cond.notify()
+
+
+class DbPoolQuotas(object):
+    """
+    Per-subsystem connection quotas
+    """
+    def __init__(self, quotas=None):
+        self.lock = threading.Lock()
+        self.quotas = {}
+        self.limits = dict(quotas) if quotas else {}
+
+    def get(self, subsystem):
+        """
+        Returns quota for the subsystem, creates on demand
+        :param subsystem:
+        :return:
+        :rtype DbQuota
+        """
+        with self.lock:
+            if subsystem not in self.quotas:
+                self.quotas[subsystem] = DbQuota(self.limits.get(subsystem))
+            return self.quotas[subsystem]
+
+    def acquire(self, subsystem, timeout=None):
+        return self.get(subsystem).acquire(timeout=timeout)
+
+    def release(self, subsystem):
+        self.get(subsystem).release()
+
+    def usage(self):
+        """
+        Subsystem -> used connections
+        :return:
+        """
+        with self.lock:
+            return dict([(k, self.quotas[k].used) for k in self.quotas])
+
+
+class DbPoolMetrics(object):
+    """
+    Pool instrumentation
+    """
+    def __init__(self, held_warn_time=30.0):
+        self.lock = threading.Lock()
+        self.held_warn_time = held_warn_time
+
+        self.num_checkouts = 0
+        self.num_overflows = 0  # checkouts over the pool_size
+        self.num_timeouts = 0  # pool exhausted
+        self.num_quota_timeouts = 0  # subsystem quota exhausted
+        self.num_long_held = 0
+        self.wait_total = 0
+        self.wait_max = 0
+        self.held_max = 0
+        self.active = {}  # id(record) -> (subsystem, thread name, checkout time)
+
+    def on_checkout(self, key, subsystem, wait, overflow=False):
+        with self.lock:
+            self.num_checkouts += 1
+            self.num_overflows += 1 if overflow else 0
+            self.wait_total += wait
+            self.wait_max = max(self.wait_max, wait)
+            self.active[key] = (subsystem, threading.current_thread().name, time.time())
+
+    def on_checkin(self, key):
+        """
+        Connection returned to the pool, warns if held for too long
+        :param key:
+        :return: subsystem of the connection checkout
+        """
+        with self.lock:
+            rec = self.active.pop(key, None)
+            if rec is None:
+                return None
+
+            held = time.time() - rec[2]
+            self.held_max = max(self.held_max, held)
+            if self.held_warn_time is None or held < self.held_warn_time:
+                return rec[0]
+            self.num_long_held += 1
+
+        logger.warning('DB connection held for %.2f s by %s [%s]' % (held, rec[1], rec[0]))
+        return rec[0]
+
+    def on_timeout(self, quota=False):
+        with self.lock:
+            if quota:
+                self.num_quota_timeouts += 1
+            else:
+                self.num_timeouts += 1
+
+    def long_held(self, threshold=None):
+        """
+        Connections currently checked out longer than the threshold
+        :param threshold:
+        :return: list of (subsystem, thread name, held time)
+        """
+        threshold = threshold if threshold is not None else self.held_warn_time
+        if threshold is None:
+            return []
+
+        now = time.time()
+        with self.lock:
+            return [(x[0], x[1], now - x[2]) for x in self.active.values() if now - x[2] >= threshold]
+
+    def wait_avg(self):
+        return self.wait_total / float(self.num_checkouts) if self.num_checkouts else 0
+
+
+class InstrumentedQueuePool(QueuePool):
+    """
+    QueuePool with subsystem quotas and metrics.
+    Quota is acquired before the pool checkout, released on the connection return.
+    """
+
+    def __init__(self, creator, **kw):
+        super(InstrumentedQueuePool, self).__init__(creator, **kw)
+        self.quotas = DbPoolQuotas()
+        self.metrics = DbPoolMetrics()
+        self._get_local = threading.local()
+
+    def _do_get(self):
+        # QueuePool._do_get recurses on overflow races, account only the outer call
+        if getattr(self._get_local, 'active', False):
+            return super(InstrumentedQueuePool, self)._do_get()
+
+        subsystem = get_subsystem()
+        time_start = time.time()
+        if not self.quotas.acquire(subsystem, timeout=self._timeout):
+            self.metrics.on_timeout(quota=True)
+            raise sa_exc.TimeoutError('DB connection quota of %s reached, limit %s, timeout %s'
+                                      % (subsystem, self.quotas.get(subsystem).limit, self._timeout))
+
+        self._get_local.active = True
+        try:
+            rec = super(InstrumentedQueuePool, self)._do_get()
+
+        except sa_exc.TimeoutError:
+            self.quotas.release(subsystem)
+            self.metrics.on_timeout()
+            raise
+
+        except Exception:
+            self.quotas.release(subsystem)
+            raise
+
+        finally:
+            self._get_local.active = False
+
+        self.metrics.on_checkout(id(rec), subsystem, time.time() - time_start, overflow=self.checkedout() > self.size())
+        return rec
+
+    def _do_return_conn(self, conn):
+        try:
+            super(InstrumentedQueuePool, self)._do_return_conn(conn)
+
+        finally:
+            subsystem = self.metrics.on_checkin(id(conn))
+            if subsystem is not None:
+                self.quotas.release(subsystem)
+
+    def recreate(self):
+        pool = super(InstrumentedQueuePool, self).recreate()
+        pool.quotas = self.quotas
+        pool.metrics = self.metrics
+        return pool
+
+    def state(self):
+        """
+        Simple state dump, returns string
+        :return:
+        """
+        m = self.metrics
+        usage = self.quotas.usage()
+        return 'in_use=%s|overflow=%s|checkouts=%s|overflows=%s|timeouts=%s|quota_timeouts=%s|long_held=%s|' \
+               'wait_avg=%.4f|wait_max=%.4f|held_max=%.2f|%s' \
+               % (self.checkedout(), max(0, self.overflow()), m.num_checkouts, m.num_overflows, m.num_timeouts,
+                  m.num_quota_timeouts, m.num_long_held, m.wait_avg(), m.wait_max, m.held_max,
+                  '|'.join(['%s=%s' % (k, usage[k]) for k in sorted(usage.keys())]))
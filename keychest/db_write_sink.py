@@ -0,0 +1,369 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Write-behind sink for high volume, low priority DB writes - scan history, last scan cache.
+Buffers rows from all workers and flushes them in multi-row batches.
+When the database is unavailable the rows stay buffered and the flush is retried with a backoff.
+"""
+
+import logging
+import threading
+import time
+from datetime import datetime
+
+import sqlalchemy.exc as sa_exc
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+
+from . import db_pool
+from . import util
+from .dbutil import DbScanHistory, DbLastScanCache, ResultModelUpdater
+from .trace_logger import Tracelogger
+
+
+logger = logging.getLogger(__name__)
+
+
+class DbWriteSinkStats(object):
+    """
+    Sink statistics
+    """
+    def __init__(self):
+        self.num_flushes = 0
+        self.num_rows = 0
+        self.num_failed_rows = 0
+        self.num_retries = 0
+        self.last_latency = 0
+        self.max_latency = 0
+        self.avg_latency = 0
+
+    def on_flush(self, num_rows, latency):
+        self.num_flushes += 1
+        self.num_rows += num_rows
+        self.last_latency = latency
+        self.max_latency = max(self.max_latency, latency)
+        self.avg_latency = latency if self.num_flushes == 1 else 0.9 * self.avg_latency + 0.1 * latency
+
+    def __repr__(self):
+        return '<DbWriteSinkStats(num_flushes=%r, num_rows=%r, num_failed_rows=%r, num_retries=%r, ' \
+               'last_latency=%.4f, max_latency=%.4f, avg_latency=%.4f)>' \
+               % (self.num_flushes, self.num_rows, self.num_failed_rows, self.num_retries, self.last_latency,
+                  self.max_latency, self.avg_latency)
+
+
+class DbWriteSink(object):
+    """
+    Batched asynchronous writer of the scan history and last scan cache.
+    Flushed when buffer size reaches batch_size or after flush_interval seconds, drained on shutdown.
+
+    Last scan cache is upserted with INSERT ... ON DUPLICATE KEY UPDATE on the unique cache key.
+    Rows failing on the database unavailability (connection errors) are returned to the buffer,
+    only rows rejected by the database (integrity, data errors) are dropped.
+    """
+
+    RETRY_BACKOFF_MIN = 1.0
+    RETRY_BACKOFF_MAX = 60.0
+
+    def __init__(self, batch_size=500, flush_interval=1.0):
+        self.db = None
+        self.config = None
+        self.trace_logger = Tracelogger(logger)
+
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self.history = []
+        self.caches = {}  # unique cache key -> row dict, last write wins
+        self.lock = threading.RLock()
+        self.flush_lock = threading.Lock()
+        self.flush_event = threading.Event()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.stats = DbWriteSinkStats()
+
+        self.retry_backoff = 0  # current backoff, 0 if the last flush succeeded
+        self.retry_at = 0  # time of the next flush attempt after the failure
+
+    def init(self, **kwargs):
+        """
+        Initializes the sink
+        :param kwargs:
+        :return:
+        """
+        if 'db' in kwargs:
+            self.db = kwargs.get('db')
+        if 'config' in kwargs:
+            self.config = kwargs.get('config')
+        if 'trace_logger' in kwargs:
+            self.trace_logger = kwargs.get('trace_logger')
+
+    def start(self):
+        """
+        Starts the flushing thread
+        :return:
+        """
+        self.thread = threading.Thread(target=self.flush_main, args=())
+        self.thread.setDaemon(True)
+        self.thread.start()
+
+    def shutdown(self):
+        """
+        Stops the flushing thread, drains the buffers
+        :return:
+        """
+        self.stop_event.set()
+        self.flush_event.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(timeout=30)
+        self.flush(force=True)
+        if self.backlog() > 0:
+            logger.warning('DB write sink shutdown, %s rows not written' % self.backlog())
+
+    def backlog(self):
+        """
+        Number of rows waiting for the flush
+        :return:
+        """
+        with self.lock:
+            return len(self.history) + len(self.caches)
+
+    def stats_str(self):
+        """
+        Simple state dump, returns string
+        :return:
+        """
+        return 'backlog: %s, %s' % (self.backlog(), self.stats)
+
+    #
+    # Producers
+    #
+
+    def add_history(self, watch_id, scan_type, scan_code=0):
+        """
+        Adds scan history record
+        :param watch_id:
+        :param scan_type:
+        :param scan_code:
+        :return:
+        """
+        row = {
+            'watch_id': watch_id,
+            'scan_type': scan_type,
+            'scan_code': scan_code,
+            'created_at': datetime.now(),
+        }
+        with self.lock:
+            self.history.append(row)
+            self._check_size()
+
+    def update_cache(self, new_scan, sub_type=0, cache_type=0):
+        """
+        Enqueues last scan cache update for the new scan
+        :param new_scan:
+        :param sub_type:
+        :param cache_type:
+        :return:
+        """
+        cache = ResultModelUpdater.build_cache(new_scan, sub_type=sub_type, cache_type=cache_type)
+        self.add_cache(cache)
+
+    def add_cache(self, cache):
+        """
+        Enqueues last scan cache upsert
+        :param cache:
+        :type cache: DbLastScanCache
+        :return:
+        """
+        now = datetime.now()
+        row = {
+            'cache_type': cache.cache_type,
+            'obj_id': cache.obj_id,
+            'scan_type': cache.scan_type,
+            'scan_sub_type': cache.scan_sub_type,
+            'aux_key': util.defval(cache.aux_key, ''),
+            'scan_id': cache.scan_id,
+            'scan_aux': cache.scan_aux,
+            'created_at': now,
+            'updated_at': now,
+        }
+        with self.lock:
+            self.caches[self._cache_key(row)] = row
+            self._check_size()
+
+    def _cache_key(self, row):
+        return row['cache_type'], row['obj_id'], row['scan_type'], row['scan_sub_type'], row['aux_key']
+
+    def _check_size(self):
+        """
+        Triggers flush when the batch is full. Called with lock held.
+        :return:
+        """
+        if len(self.history) + len(self.caches) >= self.batch_size:
+            self.flush_event.set()
+
+    #
+    # Flushing
+    #
+
+    def flush_main(self):
+        """
+        Flushing thread main method
+        :return:
+        """
+        logger.info('DB write sink thread started %s' % threading.current_thread())
+        db_pool.set_subsystem('sink')
+        while not self.stop_event.is_set():
+            try:
+                self.flush_event.wait(self.flush_interval)
+                self.flush_event.clear()
+                self.flush()
+
+            except Exception as e:
+                logger.error('Exception in DB write sink: %s' % e)
+                self.trace_logger.log(e)
+                time.sleep(1)
+
+        logger.info('DB write sink loop terminated')
+
+    def flush(self, force=False):
+        """
+        Flushes buffered rows to the database.
+        After the database failure the flush is postponed by the retry backoff.
+        :param force: ignores the retry backoff
+        :return: number of rows flushed
+        """
+        with self.flush_lock:
+            if not force and time.time() < self.retry_at:
+                return 0
+
+            with self.lock:
+                history, self.history = self.history, []
+                caches, self.caches = list(self.caches.values()), {}
+
+            if len(history) == 0 and len(caches) == 0:
+                return 0
+
+            batches = [(self._history_stmt, self._requeue_history, x) for x in util.chunk(history, self.batch_size)]
+            batches += [(self._cache_stmt, self._requeue_caches, x) for x in util.chunk(caches, self.batch_size)]
+
+            time_start = time.time()
+            num_rows = 0
+            for idx, (stmt_fnc, requeue_fnc, rows) in enumerate(batches):
+                num_stored, unsent = self._flush_rows(stmt_fnc, rows)
+                num_rows += num_stored
+                if len(unsent) == 0:
+                    continue
+
+                # database unavailable, keep the rest for the next attempt
+                requeue_fnc(unsent)
+                for _, cur_requeue_fnc, cur_rows in batches[idx + 1:]:
+                    cur_requeue_fnc(cur_rows)
+                self._on_unavailable()
+                break
+
+            else:
+                self.retry_backoff = 0
+                self.retry_at = 0
+
+            self.stats.on_flush(num_rows, time.time() - time_start)
+            return num_rows
+
+    def _on_unavailable(self):
+        """
+        Database unavailable, postpones the next flush
+        :return:
+        """
+        self.stats.num_retries += 1
+        self.retry_backoff = min(self.RETRY_BACKOFF_MAX, max(self.RETRY_BACKOFF_MIN, self.retry_backoff * 2))
+        self.retry_at = time.time() + self.retry_backoff
+        logger.warning('DB write sink: database unavailable, %s rows buffered, retry in %.1f s'
+                       % (self.backlog(), self.retry_backoff))
+
+    def _requeue_history(self, rows):
+        with self.lock:
+            self.history = rows + self.history
+
+    def _requeue_caches(self, rows):
+        with self.lock:
+            for row in rows:
+                self.caches.setdefault(self._cache_key(row), row)  # newer update wins
+
+    def _is_unavailable(self, e):
+        """
+        Returns true if the exception signals the database is not available - connection errors
+        :param e:
+        :return:
+        """
+        if isinstance(e, sa_exc.DBAPIError) and e.connection_invalidated:
+            return True
+        return isinstance(e, (sa_exc.OperationalError, sa_exc.InterfaceError, sa_exc.DisconnectionError,
+                              sa_exc.TimeoutError))
+
+    def _history_stmt(self, rows):
+        """
+        Multi-row insert of the scan history
+        :param rows:
+        :return:
+        """
+        return DbScanHistory.__table__.insert().values(rows)
+
+    def _cache_stmt(self, rows):
+        """
+        Multi-row upsert of the last scan cache
+        :param rows:
+        :return:
+        """
+        stmt = mysql_insert(DbLastScanCache.__table__).values(rows)
+        return stmt.on_duplicate_key_update(
+            scan_id=stmt.inserted.scan_id,
+            scan_aux=stmt.inserted.scan_aux,
+            updated_at=stmt.inserted.updated_at)
+
+    def _flush_rows(self, stmt_fnc, rows):
+        """
+        Executes the multi-row statement with the rows in one batch.
+        If the batch fails, rows are inserted one by one, rows rejected by the database are dropped.
+        Writing stops when the database is unavailable, the rest of the rows is returned.
+        :param stmt_fnc: rows -> statement
+        :param rows:
+        :return: (number of rows stored, rows not written due to the database unavailability)
+        """
+        s = None
+        try:
+            s = self.db.get_session()
+            s.execute(stmt_fnc(rows))
+            s.commit()
+            return len(rows), []
+
+        except Exception as e:
+            util.silent_rollback(s)
+            if self._is_unavailable(e):
+                logger.warning('Batch write of %s rows failed, database unavailable: %s' % (len(rows), e))
+                return 0, rows
+            logger.warning('Batch write of %s rows failed, writing one by one: %s' % (len(rows), e))
+
+        finally:
+            util.silent_close(s)
+
+        num_rows = 0
+        for idx, row in enumerate(rows):
+            s = None
+            try:
+                s = self.db.get_session()
+                s.execute(stmt_fnc([row]))
+                s.commit()
+                num_rows += 1
+
+            except Exception as e:
+                util.silent_rollback(s)
+                if self._is_unavailable(e):
+                    logger.warning('Write of the row failed, database unavailable: %s' % e)
+                    return num_rows, rows[idx:]
+
+                self.stats.num_failed_rows += 1
+                logger.warning('Write of the row failed, dropped: %s, %s' % (row, e))
+
+            finally:
+                util.silent_close(s)
+
+        return num_rows, []
@@ -12,6 +12,7 @@ from pymysql.err import Warning as MySQLWarning
 
 from . import errors
 from . import util
+from . import db_pool
 from .consts import DbScanType
 
 pymysql.install_as_MySQLdb()
@@ -456,6 +457,7 @@ class DbWatchTarget(Base):
     updated_at = Column(DateTime, default=func.now())
     last_scan_at = Column(DateTime, default=None)  # last watcher processing of this entity (can do more indiv. scans)
     last_scan_state = Column(SmallInteger, default=0, nullable=False)  # watcher scanning running / finished
+    next_scan_at = Column(DateTime, default=None, index=True)  # nearest time some of the sub-scans is due (feeder)
 
     # denormalization - optimized query
     last_dns_scan_id = Column(ForeignKey('scan_dns.id', name='wt_scan_dns_id', ondelete='SET NULL'),
@@ -2368,6 +2370,17 @@ class DbHelper(object):
             ret[col.name] = val
         return ret
 
+    @staticmethod
+    def insert_ignore(table):
+        """
+        INSERT IGNORE statement for the table, rows violating unique constraints are skipped.
+        :param table:
+        :return:
+        """
+        return table.insert()\
+            .prefix_with('IGNORE', dialect='mysql')\
+            .prefix_with('OR IGNORE', dialect='sqlite')
+
     @staticmethod
     def try_unpack_column(val, col):
         """
@@ -2491,6 +2504,25 @@ class DbHelper(object):
 
         return rec_detach(obj)
 
+    @staticmethod
+    def release_session(s, detach=False):
+        """
+        Ends the current transaction so the DB connection returns to the pool, e.g., before a long network I/O.
+        Pending changes are flushed and committed. The session can be used further, a new transaction
+        is started on the next query.
+
+        :param s:
+        :param detach: if true, loaded objects are detached first so they keep their loaded state
+                       (usable without the session, merge back to persist). Otherwise they expire as on commit.
+        :return:
+        """
+        if s is None:
+            return
+        s.flush()
+        if detach:
+            s.expunge_all()
+        s.commit()
+
 
 class DbException(errors.Error):
     """Generic DB exception"""
@@ -2629,6 +2661,19 @@ class ResultModelUpdater(object):
         :param skip_search:
         :return:
         """
+        cache = ResultModelUpdater.build_cache(new_scan, sub_type=sub_type, cache_type=cache_type)
+        ResultModelUpdater.update_cache_raw(s, cache, skip_search)
+
+    @staticmethod
+    def build_cache(new_scan, sub_type=0, cache_type=0):
+        """
+        Builds last scan cache record for the scan
+        :param new_scan:
+        :param sub_type:
+        :param cache_type:
+        :return:
+        :rtype: DbLastScanCache
+        """
         cache = DbLastScanCache()
         cache.cache_type = cache_type
         cache.scan_sub_type = sub_type
@@ -2665,7 +2710,7 @@ class ResultModelUpdater(object):
         else:
             raise ValueError('Unrecognized scan result, cannot persist')
 
-        ResultModelUpdater.update_cache_raw(s, cache, skip_search)
+        return cache
 
     @staticmethod
     def update_cache_raw(s, cache, skip_search=False):
@@ -2772,7 +2817,16 @@ class MySQL(object):
             if con_str is None:
                 con_str = self.get_connstring()
 
-            engine = create_engine(con_str, pool_size=200, max_overflow=32, pool_recycle=3600)
+            cfg = self.config
+            engine = create_engine(con_str, poolclass=db_pool.InstrumentedQueuePool,
+                                   pool_size=cfg.db_pool_size if cfg else 200,
+                                   max_overflow=cfg.db_max_overflow if cfg else 32,
+                                   pool_timeout=cfg.db_pool_timeout if cfg else 30,
+                                   pool_recycle=3600)
+
+            quotas = cfg.db_pool_quotas if cfg else None
+            engine.pool.quotas = db_pool.DbPoolQuotas(quotas if quotas is not None else db_pool.DEFAULT_QUOTAS)
+            engine.pool.metrics.held_warn_time = cfg.db_session_warn_time if cfg else 30
             if store_as_main:
                 self.engine = engine
 
@@ -2808,6 +2862,38 @@ class MySQL(object):
         """
         return self.engine
 
+    def set_subsystem(self, name):
+        """
+        Tags the current thread with the subsystem for DB connection quotas
+        :param name:
+        :return:
+        """
+        db_pool.set_subsystem(name)
+
+    def pool_state(self):
+        """
+        Simple state dump of the connection pool, returns string
+        :return:
+        """
+        pool = self.engine.pool if self.engine is not None else None
+        if not isinstance(pool, db_pool.InstrumentedQueuePool):
+            return 'n/a'
+        return pool.state()
+
+    def check_held_connections(self):
+        """
+        Warns about connections currently held for too long
+        :return: list of (subsystem, thread name, held time)
+        """
+        pool = self.engine.pool if self.engine is not None else None
+        if not isinstance(pool, db_pool.InstrumentedQueuePool):
+            return []
+
+        held = pool.metrics.long_held()
+        for rec in held:
+            logger.warning('DB connection held for %.2f s so far by %s [%s]' % (rec[2], rec[1], rec[0]))
+        return held
+
     def execute_sql(self, sql=None, engine=None, user='root', ignore_fail=False):
         """
         Executes SQL query on the engine, logs the query
@@ -0,0 +1,432 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+In-process DNS cache shared by the scanners.
+
+Watch targets (auto-filled subdomains mostly) share CNAME targets and IP addresses,
+the same names are resolved over and over. DnsCache keeps one shared resolver
+(resolv.conf is read once) and a size bounded LRU of the answers:
+
+ - A / AAAA / CNAME answers are cached for the answer TTL, clipped to [min_ttl, max_ttl]
+ - NXDOMAIN and empty answers are cached for the SOA negative TTL
+ - system resolver results (getaddrinfo, gethostbyaddr) carry no TTL, cached for sys_ttl
+
+A / AAAA (and CNAME) queries of one name are sent concurrently.
+Timeouts and other resolver failures are not cached.
+"""
+
+import logging
+import socket
+import threading
+import time
+
+import concurrent.futures
+import dns.exception
+import dns.rdatatype
+import dns.resolver
+import pylru
+
+from . import util
+
+
+__author__ = 'dusanklinec'
+logger = logging.getLogger(__name__)
+
+
+DNS_CACHE_SIZE = 16384
+
+# h_errno of socket.herror, TRY_AGAIN and the others are transient
+HERROR_HOST_NOT_FOUND = 1
+
+
+class DnsCache(object):
+    """
+    Thread-safe TTL respecting DNS cache with negative caching
+    """
+    def __init__(self, size=DNS_CACHE_SIZE, timeout=4, min_ttl=30, max_ttl=3600, negative_ttl=300, sys_ttl=300,
+                 workers=16, nameservers=None, port=None, enabled=True):
+        """
+        :param size: max number of cached answers
+        :param timeout: resolver timeout
+        :param min_ttl: lower bound of the TTL
+        :param max_ttl: upper bound of the TTL
+        :param negative_ttl: negative caching TTL if the answer has no SOA record
+        :param sys_ttl: TTL for system resolver results
+        :param workers: number of concurrent lookups in query_many() and resolve_many()
+        :param nameservers: resolver nameservers, resolv.conf by default
+        :param port: resolver port
+        :param enabled: if false, nothing is cached
+        """
+        self.timeout = timeout
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.negative_ttl = negative_ttl
+        self.sys_ttl = sys_ttl
+        self.workers = workers
+        self.nameservers = nameservers
+        self.port = port
+        self.enabled = enabled
+
+        self.cache = pylru.lrucache(size)
+        self.lock = threading.Lock()
+        self.resolver = None
+        self.executor = None
+
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+
+    def get_resolver(self):
+        """
+        Shared resolver, created on the first use
+        :return:
+        :rtype: dns.resolver.Resolver
+        """
+        with self.lock:
+            if self.resolver is None:
+                resolver = dns.resolver.Resolver(configure=self.nameservers is None)
+                if self.nameservers is not None:
+                    resolver.nameservers = list(self.nameservers)
+                if self.port is not None:
+                    resolver.port = self.port
+                resolver.timeout = self.timeout
+                resolver.lifetime = self.timeout * 2
+                self.resolver = resolver
+            return self.resolver
+
+    def get_executor(self):
+        """
+        Executor for the concurrent queries, created on the first use
+        :return:
+        """
+        with self.lock:
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers)
+            return self.executor
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=False)
+                self.executor = None
+
+    #
+    # Cache
+    #
+
+    def _cache_get(self, key):
+        """
+        Returns live cache entry (value, error) or None.
+        Cached error is raised.
+        :param key:
+        :return:
+        """
+        if not self.enabled:
+            return None
+
+        with self.lock:
+            entry = self.cache.get(key)
+            if entry is None or entry[0] < time.time():
+                self.misses += 1
+                return None
+
+            if entry[2] is not None:
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+
+        if entry[2] is not None:
+            raise entry[2]
+        return entry[1]
+
+    def _cache_put(self, key, value, ttl, error=None):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.cache[key] = (time.time() + ttl, value, error)
+
+    def _clip_ttl(self, ttl):
+        return max(self.min_ttl, min(self.max_ttl, ttl))
+
+    def _negative_ttl(self, responses):
+        """
+        Negative caching TTL from the SOA record in the authority section (RFC 2308)
+        :param responses:
+        :return:
+        """
+        ttls = []
+        for response in [x for x in responses if x is not None]:
+            for rrset in response.authority:
+                if rrset.rdtype != dns.rdatatype.SOA:
+                    continue
+                ttls += [min(rrset.ttl, x.minimum) for x in rrset]
+
+        return self._clip_ttl(min(ttls)) if ttls else self.negative_ttl
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+
+    #
+    # Resolution
+    #
+
+    def query(self, name, rdtype='A'):
+        """
+        DNS query, cached. NXDOMAIN and NoAnswer are raised, also from the cache.
+        :param name:
+        :param rdtype:
+        :return: list of the answer records in the text form
+        """
+        key = ('q', util.lower(name), rdtype)
+        ret = self._cache_get(key)
+        if ret is not None:
+            return ret
+
+        # scanned names are fully qualified, no search domain queries
+        qname = name if name.endswith('.') else '%s.' % name
+        try:
+            answer = self.get_resolver().query(qname, rdtype)
+
+        except dns.resolver.NXDOMAIN as e:
+            self._cache_put(key, None, self._negative_ttl(list(e.kwargs.get('responses', {}).values())), error=e)
+            raise
+
+        except dns.resolver.NoAnswer as e:
+            self._cache_put(key, None, self._negative_ttl([e.kwargs.get('response')]), error=e)
+            raise
+
+        ret = [x.to_text() for x in answer]
+        ttl = min([x.ttl for x in answer.response.answer]) if answer.response.answer else self.min_ttl
+        self._cache_put(key, ret, self._clip_ttl(ttl))
+        return ret
+
+    def query_many(self, name, rdtypes):
+        """
+        Queries of the name for all record types, concurrently.
+        The first query runs in the calling thread, the rest in the executor.
+        :param name:
+        :param rdtypes:
+        :return: dict rdtype -> list of the answer records or exception
+        """
+        def lookup(rdtype):
+            try:
+                return self.query(name, rdtype)
+            except Exception as e:
+                return e
+
+        executor = self.get_executor() if len(rdtypes) > 1 else None
+        futures = [executor.submit(lookup, x) for x in rdtypes[1:]]
+        ret = {rdtypes[0]: lookup(rdtypes[0])}
+        for rdtype, future in zip(rdtypes[1:], futures):
+            ret[rdtype] = future.result()
+        return ret
+
+    def cname(self, name):
+        """
+        CNAME of the name, None if there is none
+        :param name:
+        :return:
+        """
+        return self._cname_answer(self.query_many(name, ['CNAME'])['CNAME'])
+
+    def _cname_answer(self, answer):
+        """
+        CNAME from the query answer, None if there is none
+        :param answer: list of records or exception
+        :return:
+        """
+        if isinstance(answer, (dns.resolver.NoAnswer, dns.resolver.NXDOMAIN)):
+            return None
+        if isinstance(answer, Exception):
+            raise answer
+        return util.remove_trailing_char(answer[0], '.') if len(answer) > 0 else None
+
+    def resolve_addrs(self, name):
+        """
+        Resolves IPv4 and IPv6 addresses of the name via concurrent A and AAAA queries.
+        Falls back to the system resolver if the DNS query fails (timeout, no nameservers).
+        :param name:
+        :return: list of (family, address), getaddrinfo compatible
+        """
+        return self._addrs_answer(name, self.query_many(name, ['A', 'AAAA']))
+
+    def resolve_host(self, name):
+        """
+        Addresses and CNAME of the name, A, AAAA and CNAME queried concurrently
+        :param name:
+        :return: (list of (family, address) or exception, CNAME or exception)
+        """
+        answers = self.query_many(name, ['A', 'AAAA', 'CNAME'])
+        try:
+            addrs = self._addrs_answer(name, answers)
+        except Exception as e:
+            addrs = e
+
+        try:
+            cname = self._cname_answer(answers['CNAME'])
+        except Exception as e:
+            cname = e
+        return addrs, cname
+
+    def _addrs_answer(self, name, answers):
+        """
+        Addresses from the A and AAAA query answers, system resolver if a query failed
+        :param name:
+        :param answers: dict rdtype -> list of records or exception
+        :return: list of (family, address)
+        """
+        ret = []
+        num_nx = 0
+        for rdtype, family in [('A', socket.AF_INET), ('AAAA', socket.AF_INET6)]:
+            answer = answers[rdtype]
+            if isinstance(answer, dns.resolver.NoAnswer):
+                continue
+
+            if isinstance(answer, dns.resolver.NXDOMAIN):
+                num_nx += 1
+                break
+
+            if isinstance(answer, dns.exception.DNSException):
+                logger.debug('DNS query failed for %s, system resolver used: %s' % (name, answer))
+                results = self.getaddrinfo(name, 443, 0, socket.SOCK_STREAM, socket.IPPROTO_TCP)
+                return [(x[0], x[4][0]) for x in results]
+
+            if isinstance(answer, Exception):
+                raise answer
+
+            ret += [(family, x) for x in answer]
+
+        if len(ret) == 0:
+            raise socket.gaierror(socket.EAI_NONAME, 'Name or service not known' if num_nx else 'No address')
+        return ret
+
+    def getaddrinfo(self, host, port, family=0, socktype=0, proto=0, flags=0):
+        """
+        socket.getaddrinfo, cached. Name not found errors are cached.
+        :return:
+        """
+        key = ('gai', util.lower(host), port, family, socktype, proto, flags)
+        ret = self._cache_get(key)
+        if ret is not None:
+            return ret
+
+        try:
+            ret = socket.getaddrinfo(host, port, family, socktype, proto, flags)
+
+        except socket.gaierror as e:
+            if e.args and e.args[0] == socket.EAI_NONAME:
+                self._cache_put(key, None, self.negative_ttl, error=e)
+            raise
+
+        self._cache_put(key, ret, self.sys_ttl)
+        return ret
+
+    def gethostbyaddr(self, ip):
+        """
+        socket.gethostbyaddr, cached. Host not found errors are cached, transient ones (TRY_AGAIN) are not.
+        :param ip:
+        :return:
+        """
+        key = ('ptr', ip)
+        ret = self._cache_get(key)
+        if ret is not None:
+            return ret
+
+        try:
+            ret = socket.gethostbyaddr(ip)
+
+        except socket.herror as e:
+            if e.args and e.args[0] == HERROR_HOST_NOT_FOUND:
+                self._cache_put(key, None, self.negative_ttl, error=e)
+            raise
+
+        self._cache_put(key, ret, self.sys_ttl)
+        return ret
+
+    def resolve_many(self, names, fnc=None, workers=None):
+        """
+        Concurrent lookups, warms up the cache
+        :param names:
+        :param fnc: lookup function, resolve_addrs by default
+        :param workers:
+        :return: dict name -> result or exception
+        """
+        names = list(set(names))
+        fnc = util.defval(fnc, self.resolve_addrs)
+        if len(names) == 0:
+            return {}
+
+        def lookup(name):
+            try:
+                return fnc(name)
+            except Exception as e:
+                return e
+
+        workers = max(1, min(len(names), util.defval(workers, self.workers)))
+        with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+            return dict(zip(names, executor.map(lookup, names)))
+
+    #
+    # HTTP requests
+    #
+
+    def create_connection(self, address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, source_address=None,
+                          socket_options=None):
+        """
+        urllib3.util.connection.create_connection resolving over the cache
+        :return:
+        """
+        from urllib3.util import connection
+
+        host, port = address
+        if host.startswith('['):
+            host = host.strip('[]')
+
+        err = None
+        family = connection.allowed_gai_family()
+        for res in self.getaddrinfo(host, port, family, socket.SOCK_STREAM):
+            af, socktype, proto, canonname, sa = res
+            sock = None
+            try:
+                sock = socket.socket(af, socktype, proto)
+                if socket_options:
+                    for opt in socket_options:
+                        sock.setsockopt(*opt)
+
+                if timeout is not socket._GLOBAL_DEFAULT_TIMEOUT:
+                    sock.settimeout(timeout)
+                if source_address:
+                    sock.bind(source_address)
+                sock.connect(sa)
+                return sock
+
+            except socket.error as e:
+                err = e
+                if sock is not None:
+                    sock.close()
+
+        if err is not None:
+            raise err
+        raise socket.error('getaddrinfo returns an empty list')
+
+    def install_urllib3(self):
+        """
+        Makes urllib3 (requests) connections resolve over this cache, process wide
+        :return:
+        """
+        from urllib3.util import connection
+        connection.create_connection = self.create_connection
+
+    def hit_ratio(self):
+        total = self.hits + self.negative_hits + self.misses
+        return (self.hits + self.negative_hits) / float(total) if total else 0
+
+    def stats_str(self):
+        """
+        Simple state dump, returns string
+        :return:
+        """
+        return 'size: %s, hits: %s, negative hits: %s, misses: %s, ratio: %.3f' \
+               % (len(self.cache), self.hits, self.negative_hits, self.misses, self.hit_ratio())
@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Persistent HTTP connection pooling for fixed upstreams (crt.sh, ...).
+
+requests.get() builds a new connection pool for each call, so every request pays
+the TCP and TLS setup. HttpSessionPool keeps shared or thread-local requests.Session
+objects with keep-alive connection pools and reports the connection reuse.
+"""
+
+import logging
+import threading
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+__author__ = 'dusanklinec'
+logger = logging.getLogger(__name__)
+
+
+class HttpSessionPool(object):
+    """
+    Shared or thread-local requests sessions with tuned connection pools.
+    If disabled, each request opens a fresh connection (requests.get).
+    """
+    def __init__(self, pool_connections=4, pool_maxsize=16, thread_local=False, enabled=True):
+        """
+        :param pool_connections: number of hosts to keep connection pools for
+        :param pool_maxsize: max connections kept per host
+        :param thread_local: session per thread, otherwise one shared thread-safe session
+        :param enabled: if false, no connections are reused
+        """
+        self.pool_connections = pool_connections
+        self.pool_maxsize = pool_maxsize
+        self.thread_local = thread_local
+        self.enabled = enabled
+
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.session = None
+        self.adapters = []  # all adapters created, for stats
+        self.num_requests = 0
+
+    def _new_session(self):
+        """
+        Creates a new session with keep-alive adapters
+        :return:
+        """
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=self.pool_connections, pool_maxsize=self.pool_maxsize)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        with self.lock:
+            self.adapters.append(adapter)
+        return session
+
+    def get_session(self):
+        """
+        Returns the session for the current thread
+        :return:
+        :rtype: requests.Session
+        """
+        if self.thread_local:
+            session = getattr(self.local, 'session', None)
+            if session is None:
+                session = self._new_session()
+                self.local.session = session
+            return session
+
+        with self.lock:
+            if self.session is not None:
+                return self.session
+
+        session = self._new_session()
+        with self.lock:
+            if self.session is None:
+                self.session = session
+            return self.session
+
+    def request(self, method, url, **kwargs):
+        """
+        Performs the request, over the pooled connection if enabled
+        :param method:
+        :param url:
+        :param kwargs: requests arguments
+        :return:
+        :rtype: requests.Response
+        """
+        with self.lock:
+            self.num_requests += 1
+
+        if not self.enabled:
+            return requests.request(method, url, **kwargs)
+        return self.get_session().request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        kwargs.setdefault('allow_redirects', True)
+        return self.request('GET', url, **kwargs)
+
+    def close(self):
+        """
+        Closes the shared session and all pooled connections
+        :return:
+        """
+        with self.lock:
+            adapters, self.adapters = self.adapters, []
+            self.session = None
+        self.local = threading.local()
+        for adapter in adapters:
+            adapter.close()
+
+    def stats(self):
+        """
+        Connection reuse statistics of the live connection pools
+        :return: (requests, connections opened, connections reused)
+        """
+        num_requests, num_connections = 0, 0
+        with self.lock:
+            adapters = list(self.adapters)
+
+        for adapter in adapters:
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is None:
+                    continue
+                num_requests += pool.num_requests
+                num_connections += pool.num_connections
+        return num_requests, num_connections, max(0, num_requests - num_connections)
+
+    def stats_str(self):
+        """
+        Simple state dump, returns string
+        :return:
+        """
+        num_requests, num_connections, num_reused = self.stats()
+        return 'enabled: %s, requests: %s, pooled requests: %s, connections: %s, reused: %s' \
+               % (self.enabled, self.num_requests, num_requests, num_connections, num_reused)
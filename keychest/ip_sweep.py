@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+IP range sweep engine.
+
+Splits the IP range into chunks, scans chunks concurrently with bounded concurrency.
+Optional cheap TCP connect pre-probe is performed before the full scan so only live ports get a full TLS hello.
+"""
+
+import logging
+import socket
+import threading
+import time
+import concurrent.futures
+
+from .trace_logger import Tracelogger
+
+
+__author__ = 'dusanklinec'
+logger = logging.getLogger(__name__)
+
+
+class IpSweepResult(object):
+    """
+    Result of the IP range sweep
+    """
+    def __init__(self):
+        self.results = []  # list of (ip, scan result) for IPs passing the pre-probe
+        self.num_ips = 0
+        self.num_probed_alive = 0
+        self.aborted = False
+        self.time_start = None
+        self.time_finished = None
+
+    @property
+    def duration(self):
+        if self.time_start is None or self.time_finished is None:
+            return None
+        return self.time_finished - self.time_start
+
+    def __repr__(self):
+        return '<IpSweepResult(num_ips=%r, num_probed_alive=%r, num_results=%r, aborted=%r, duration=%r)>' \
+               % (self.num_ips, self.num_probed_alive, len(self.results), self.aborted, self.duration)
+
+
+class IpSweeper(object):
+    """
+    Parallel chunked IP range sweeper.
+    Scanning function is called for each IP passing the pre-probe in one of the worker threads,
+    it should not use the shared DB session.
+    """
+
+    def __init__(self, max_workers=16, chunk_size=32, pre_probe=True, probe_timeout=2.0):
+        self.max_workers = max_workers
+        self.chunk_size = chunk_size
+        self.pre_probe = pre_probe
+        self.probe_timeout = probe_timeout
+        self.executor = None
+        self.executor_lock = threading.Lock()
+        self.trace_logger = Tracelogger(logger)
+
+    def get_executor(self):
+        """
+        Lazily creates bounded executor for sweeping
+        :return:
+        """
+        with self.executor_lock:
+            if self.executor is None:
+                self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.max_workers)
+            return self.executor
+
+    def shutdown(self):
+        """
+        Shuts down the executor
+        :return:
+        """
+        with self.executor_lock:
+            if self.executor is not None:
+                self.executor.shutdown(wait=False)
+                self.executor = None
+
+    def probe(self, ip, port):
+        """
+        Cheap TCP connect pre-probe.
+        :param ip:
+        :param port:
+        :return: True if port accepts connections
+        """
+        sock = None
+        try:
+            sock = socket.create_connection((ip, port), timeout=self.probe_timeout)
+            return True
+
+        except (socket.timeout, socket.error):
+            return False
+
+        finally:
+            if sock is not None:
+                try:
+                    sock.close()
+                except:
+                    pass
+
+    def _iter_chunks(self, ips):
+        """
+        Lazily splits the IP iterator to the chunks, keeping the iteration order
+        :param ips:
+        :return:
+        """
+        cur = []
+        for ip in ips:
+            cur.append(ip)
+            if len(cur) >= self.chunk_size:
+                yield cur
+                cur = []
+        if len(cur) > 0:
+            yield cur
+
+    def _scan_chunk(self, chunk, port, scan_fnc, is_running=None):
+        """
+        Scans one chunk of the IP addresses. Executed in the worker thread.
+        :param chunk:
+        :param port:
+        :param scan_fnc:
+        :param is_running:
+        :return: (list of (ip, result), number of alive IPs)
+        """
+        results = []
+        num_alive = 0
+        for ip in chunk:
+            if is_running is not None and not is_running():
+                break
+
+            if self.pre_probe and not self.probe(ip, port):
+                continue
+
+            num_alive += 1
+            try:
+                results.append((ip, scan_fnc(ip)))
+
+            except Exception as e:
+                logger.debug('Exception in IP sweep scan %s: %s' % (ip, e))
+                self.trace_logger.log(e)
+                results.append((ip, None))
+
+        return results, num_alive
+
+    def sweep(self, ips, port, scan_fnc, is_running=None):
+        """
+        Sweeps the given IP addresses.
+        Chunks are submitted lazily to the bounded executor, at most 2 * max_workers chunks are in flight.
+
+        :param ips: iterable of IP addresses
+        :param port: port for the pre-probe
+        :param scan_fnc: function(ip) -> result, called for each IP passing the pre-probe
+        :param is_running: function() -> bool, sweep aborts when it returns False
+        :return:
+        :rtype: IpSweepResult
+        """
+        res = IpSweepResult()
+        res.time_start = time.time()
+
+        executor = self.get_executor()
+        max_pending = 2 * self.max_workers
+        pending = set()
+
+        def collect(done):
+            for future in done:
+                results, num_alive = future.result()
+                res.results += results
+                res.num_probed_alive += num_alive
+
+        for chunk in self._iter_chunks(ips):
+            if is_running is not None and not is_running():
+                res.aborted = True
+                break
+
+            res.num_ips += len(chunk)
+            pending.add(executor.submit(self._scan_chunk, chunk, port, scan_fnc, is_running))
+
+            if len(pending) >= max_pending:
+                done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                collect(done)
+
+        done, _ = concurrent.futures.wait(pending)
+        collect(done)
+
+        if is_running is not None and not is_running():
+            res.aborted = True
+
+        res.time_finished = time.time()
+        return res
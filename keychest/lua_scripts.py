@@ -38,6 +38,36 @@ return {job, reserved}
     """
 
 
+def lua_pop_batch():
+    """
+    Batch pop lua script, reserves up to ARGV[2] jobs in one call.
+    Same semantics as lua_pop for each job.
+    Returns flat list job1, reserved1, job2, reserved2, ...
+    :return:
+    """
+    return """
+local ret = {}
+for i = 1, tonumber(ARGV[2]) do
+    -- Pop the first job off of the queue...
+    local job = redis.call('lpop', KEYS[1])
+    if(job == false) then
+        break
+    end
+
+    -- Increment the attempt count and place job on the reserved queue...
+    local reserved = cjson.decode(job)
+    reserved['attempts'] = reserved['attempts'] + 1
+    reserved = cjson.encode(reserved)
+    redis.call('zadd', KEYS[2], ARGV[1], reserved)
+
+    ret[#ret + 1] = job
+    ret[#ret + 1] = reserved
+end
+
+return ret
+    """
+
+
 def lua_after_pop():
     """
     lua script invoked after pop, which may be performed separately or in a blocking command.
@@ -4,6 +4,7 @@
 import time
 import logging
 import json
+import threading
 
 import redis
 import collections
@@ -29,6 +30,15 @@ class RedisQueue(object):
         self.default_queue = default_queue
         self.event_queue = event_queue
 
+        # delayed / expired jobs migration period in seconds, 0 migrates on each pop
+        self.migrate_interval = 1.0
+        self.migrate_last = {}  # queue -> last migration time
+        self.migrate_lock = threading.Lock()
+
+        self.num_pops = 0
+        self.num_pop_calls = 0
+        self.num_migrations = 0
+
     #
     # Queue
     #
@@ -81,15 +91,41 @@ class RedisQueue(object):
         """
         q = self.get_queue(queue)
 
-        self.migrate(q)
+        self.migrate_if_due(q)
 
         job, reserved = self.retrieve_next_job(q, blocking=blocking, timeout=timeout)
+        self.num_pop_calls += 1
 
         if reserved is not None:
+            self.num_pops += 1
             return RedisJob(None, self, job, reserved, None, q)
 
         return None
 
+    def pop_batch(self, queue=None, count=50, blocking=False, timeout=1):
+        """
+        Pops up to count jobs off of the queue in one call, each job reserved as in pop().
+        In the blocking mode waits for the first job up to timeout if the queue is empty.
+        :param queue:
+        :param count: max number of jobs to reserve
+        :param blocking:
+        :param timeout:
+        :return: list of RedisJob
+        """
+        q = self.get_queue(queue)
+
+        self.migrate_if_due(q)
+
+        pairs = self.retrieve_next_jobs(q, count)
+        if len(pairs) == 0 and blocking:
+            job, reserved = self.retrieve_next_job(q, blocking=True, timeout=timeout)
+            if reserved is not None:
+                pairs = [(job, reserved)] + (self.retrieve_next_jobs(q, count - 1) if count > 1 else [])
+
+        self.num_pop_calls += 1
+        self.num_pops += len(pairs)
+        return [RedisJob(None, self, job, reserved, None, q) for job, reserved in pairs]
+
     def migrate_expired_jobs(self, qfrom, qto):
         """
         Migrate the delayed jobs that are ready to the regular queue.
@@ -120,6 +156,36 @@ class RedisQueue(object):
 
         return ret
 
+    def retrieve_next_jobs(self, queue, count):
+        """
+        Retrieves up to count jobs from the redis queue in one script call
+        :param queue:
+        :param count:
+        :return: list of (job, reserved)
+        """
+        avail_at = int((time.time() + self.pop_retry_after)*1000) if self.pop_retry_after is not None else 0
+        res = self.redis.lua_pop_batch(keys=[queue, '%s:reserved' % queue], args=[avail_at, count])
+        if not res:
+            return []
+        return list(zip(res[0::2], res[1::2]))
+
+    def migrate_if_due(self, queue):
+        """
+        Migrates delayed or expired jobs if the migration interval elapsed since the last migration
+        :param queue:
+        :return: True if migrated
+        """
+        cur_time = time.time()
+        with self.migrate_lock:
+            last_time = self.migrate_last.get(queue, 0)
+            if self.migrate_interval and last_time + self.migrate_interval > cur_time:
+                return False
+            self.migrate_last[queue] = cur_time
+
+        self.migrate(queue)
+        self.num_migrations += 1
+        return True
+
     def migrate(self, queue):
         """
         Migrate any delayed or expired jobs onto the primary queue.
@@ -153,6 +219,13 @@ class RedisQueue(object):
         return self.redis.lua_release(keys=['%s:delayed' % q, '%s:reserved' % q],
                                       args=[job.get_reserved_job(), int((time.time() + delay)*1000)])
 
+    def stats_str(self):
+        """
+        Simple state dump, returns string
+        :return:
+        """
+        return 'pops: %s, pop calls: %s, migrations: %s' % (self.num_pops, self.num_pop_calls, self.num_migrations)
+
     def random_id(self):
         """
         Generates random job id
@@ -195,4 +268,13 @@ class RedisQueue(object):
 
         return self.push_raw(trans_form_envelope, queue)
 
+    def publish(self, channel, data):
+        """
+        Publishes the message to the pub/sub channel
+        :param channel:
+        :param data:
+        :return: number of subscribers received the message
+        """
+        return self.redis.redis.publish(channel, data)
+
 
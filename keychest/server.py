@@ -9,6 +9,7 @@ NOTE: this file will be refactored soon, pls any edits consult with maintainer
 import argparse
 import base64
 import collections
+import concurrent.futures
 import json
 import logging
 import math
@@ -37,16 +38,19 @@ from . import dbutil
 from . import redis_helper as rh
 from . import util
 from . import util_cert
+from .blacklist_index import BlacklistIndex
+from .cert_cache import CertParseCache
+from .dns_cache import DnsCache
 from .cert_path_validator import PathValidator, ValidationOsslException, ValidationResult
 from .config import Config
-from .consts import CertSigAlg, BlacklistRuleType, DbScanType, JobType, CrtshInputType, DbLastScanCacheType, IpType
+from .consts import CertSigAlg, DbScanType, JobType, CrtshInputType, DbLastScanCacheType, IpType
 from .core import Core
 from .crt_sh_processor import CrtProcessor, CrtShException, CrtShTimeoutException
 from .daemon import Daemon
 from .db_migrations import DbMigrationManager
 from .dbutil import MySQL, ScanJob, Certificate, CertificateAltName, DbCrtShQuery, DbCrtShQueryResult, \
     DbHandshakeScanJob, DbHandshakeScanJobResult, DbWatchTarget, DbWatchAssoc, DbBaseDomain, DbWhoisCheck, \
-    DbScanHistory, DbHelper, ColTransformWrapper, \
+    DbHelper, ColTransformWrapper, \
     DbDnsResolve, DbCrtShQueryInput, \
     DbSubdomainResultCache, DbSubdomainScanBlacklist, DbSubdomainWatchAssoc, DbSubdomainWatchTarget, \
     DbSubdomainWatchResultEntry, DbDnsEntry, DbLastScanCache, DbWatchService, \
@@ -54,24 +58,27 @@ from .dbutil import MySQL, ScanJob, Certificate, CertificateAltName, DbCrtShQuer
     DbIpScanRecord, DbIpScanRecordUser, DbIpScanResult, \
     ResultModelUpdater, ModelUpdater
 from .errors import Error, InvalidHostname, ServerShuttingDown
+from .ip_sweep import IpSweeper
 from .redis_client import RedisClient
 from .redis_queue import RedisQueue
 from .server_agent import ServerAgent
 from .server_api import RestAPI
 from .server_api_proc import ServerApiProc
-from .server_jobs import JobTypes, BaseJob, PeriodicJob, PeriodicReconJob, PeriodicIpScanJob, ScanResults
+from .server_jobs import JobTypes, BaseJob, PeriodicJob, PeriodicReconJob, PeriodicIpScanJob, ScanResults, \
+    LastScanPrefetch
 from .server_key_tester import KeyTester
 from .server_management import ManagementModule
 from .stat_sem import StatSemaphore
 from .tls_domain_tools import TlsDomainTools, TargetUrl, CnameCDNClassifier
 from .tls_handshake import TlsHandshaker, TlsHandshakeResult, TlsTimeout, TlsResolutionError, TlsException, \
     TlsHandshakeErrors
-from .tls_scanner import TlsScanner, RequestErrorCode
+from .tls_scanner import TlsScanner
 from .trace_logger import Tracelogger
 from .pki_manager import PkiManager
 from .pki_manager_le import PkiLeManager
 from .certificate_manager import CertificateManager
 from .database_manager import DatabaseManager
+from .db_write_sink import DbWriteSink
 
 __author__ = 'dusanklinec'
 logger = logging.getLogger(__name__)
@@ -134,20 +141,25 @@ class Server(object):
         self.watcher_workers = []
         self.watcher_thread = None
         self.watcher_job_semaphores = {}  # semaphores for particular tasks
+        self.scan_executor = None  # shared executor for concurrent network scans
+        self.ip_sweeper = None  # type: IpSweeper
 
-        self.sub_blacklist = {}
+        self.sub_blacklist = BlacklistIndex()  # compiled index, replaced as a whole on reload
         self.sub_blacklist_lock = RLock()
 
         self.trace_logger = Tracelogger(logger)
         self.crt_sh_proc = CrtProcessor(timeout=8, attempts=2)
         self.tls_handshaker = TlsHandshaker(timeout=5, tls_version='TLS_1_2', attempts=3)
-        self.crt_validator = PathValidator()
+        self.cert_cache = CertParseCache()
+        self.dns_cache = DnsCache()
+        self.crt_validator = PathValidator(cert_cache=self.cert_cache)
         self.domain_tools = TlsDomainTools()
         self.cname_cdn_classif = CnameCDNClassifier()
         self.tls_scanner = TlsScanner()
         self.pki_manager = PkiManager()
         self.cert_manager = CertificateManager()
         self.db_manager = DatabaseManager()
+        self.db_sink = DbWriteSink()
         self.test_timeout = 5
         self.api = None
         self.events = Events()
@@ -173,6 +185,8 @@ class Server(object):
         self.delta_crtsh = timedelta(hours=12)
         self.delta_whois = timedelta(hours=48)
         self.delta_wildcard = timedelta(days=2)
+        self.delta_wildcard_full = timedelta(days=14)  # full wildcard recon reconciliation
+        self.wildcard_full_recon = {}  # watch id -> time of the last full wildcard recon
         self.delta_ip_scan = timedelta(days=2)
 
     def check_pid(self, retry=True):
@@ -265,8 +279,18 @@ class Server(object):
         """
         self.crt_validator.init()
         self.cname_cdn_classif.init()
+        CrtProcessor.rate_limiter.rate = self.config.crtsh_rate
+        self.crt_sh_proc = CrtProcessor(timeout=8, attempts=2, download_workers=self.config.crtsh_download_workers,
+                                        output_json=self.config.crtsh_json)
+        self.tls_scanner.http_pool.enabled = self.config.probe_keepalive
+        self.dns_cache.enabled = self.config.dns_cache
+        if self.config.dns_cache:
+            self.dns_cache.install_urllib3()
         self.db_manager.init(db=self.db, config=self.config)
-        self.cert_manager.init(db=self.db, config=self.config, db_manager=self.db_manager)
+        self.db_sink.init(db=self.db, config=self.config)
+        self.db_sink.start()
+        self.cert_manager.init(db=self.db, config=self.config, db_manager=self.db_manager,
+                               cert_cache=self.cert_cache)
         self.pki_manager.init(db=self.db, config=self.config)
 
         le_pki_manager = PkiLeManager(self.pki_manager)
@@ -530,6 +554,34 @@ class Server(object):
         :return:
         :rtype (TlsHandshakeResult, DbHandshakeScanJob)
         """
+        try:
+            ret = self.scan_handshake_net(job_data, job_db, **kwargs)
+            if ret is None:
+                return
+            resp, scan_db = ret
+            if resp is None:
+                return None, None
+
+            self.scan_handshake_persist(s, resp, scan_db, store_job=store_job, **kwargs)
+            return resp, scan_db
+
+        except Exception as e:
+            logger.debug('Exception when scanning: %s' % e)
+            self.trace_logger.log(e)
+        return None, None
+
+    def scan_handshake_net(self, job_data, job_db=None, **kwargs):
+        """
+        Network part of the handshake scan - TLS handshake, validity test, reverse IP lookup, connect analysis.
+        Does not touch the database so it can be executed concurrently in the scan executor.
+        Results are returned in a detached scan record, persisted later by scan_handshake_persist().
+
+        :param job_data:
+        :param job_db:
+        :param kwargs:
+        :return:
+        :rtype (TlsHandshakeResult, DbHandshakeScanJob)
+        """
         domain = job_data['scan_host']
         domain_sni = util.defvalkey(job_data, 'scan_sni', domain, take_none=False)
         scan_ip = util.defvalkey(job_data, 'scan_ip', None)
@@ -552,10 +604,8 @@ class Server(object):
         if 'do_connect_analysis' in kwargs:  # can only disable, if DNS failed, cannot perform
             do_connect_analysis &= kwargs.get('do_connect_analysis')
 
-        do_process_certificates = kwargs.get('do_process_certificates', True)
-
         # Simple TLS handshake to the given host.
-        # Analyze results, store scan record.
+        # Analyze results, build scan record.
         try:
             resp = None  # type: TlsHandshakeResult
             try:
@@ -594,26 +644,17 @@ class Server(object):
             scan_db.time_elapsed = time_elapsed
             scan_db.results = len(resp.certificates)
             scan_db.new_results = 0
-            if store_job:
-                s.add(scan_db)
-                s.flush()
-
-            # Certificates processing + cert path validation
-            if do_process_certificates:
-                self.process_handshake_certs(s, resp, scan_db, do_job_subres=store_job)
 
             # Cert validity
             self.tls_cert_validity_test(resp=resp, scan_db=scan_db)
-            if store_job:
-                s.flush()
 
             # Reverse IP lookup
             if scan_db.ip_scanned is not None and scan_db.ip_scanned != '-':
-                self.reverse_ip_analysis(s, sys_params, resp, scan_db, domain_sni, job_data=job_data)
+                self.reverse_ip_analysis(None, sys_params, resp, scan_db, domain_sni, job_data=job_data)
 
             # Try direct connect with requests, follow urls
             if do_connect_analysis:
-                self.connect_analysis(s, sys_params, resp, scan_db, domain_sni, port, scheme, job_data=job_data)
+                self.connect_analysis(None, sys_params, resp, scan_db, domain_sni, port, scheme, job_data=job_data)
             else:
                 logger.debug('Connect analysis skipped for %s' % domain_sni)
 
@@ -624,7 +665,31 @@ class Server(object):
             self.trace_logger.log(e)
         return None, None
 
-    def scan_crt_sh(self, s, job_data, query, job_db, store_to_db=True):
+    def scan_handshake_persist(self, s, resp, scan_db, store_job=True, **kwargs):
+        """
+        Database part of the handshake scan - stores the scan record (if desired) and the certificates.
+        :param s:
+        :param resp:
+        :type resp: TlsHandshakeResult
+        :param scan_db:
+        :type scan_db: DbHandshakeScanJob
+        :param store_job:
+        :param kwargs:
+        :return:
+        """
+        do_process_certificates = kwargs.get('do_process_certificates', True)
+        if store_job:
+            s.add(scan_db)
+            s.flush()
+
+        # Certificates processing + cert path validation
+        if do_process_certificates:
+            self.process_handshake_certs(s, resp, scan_db, do_job_subres=store_job)
+
+        if store_job:
+            s.flush()
+
+    def scan_crt_sh(self, s, job_data, query, job_db, store_to_db=True, release_db=False):
         """
         Performs one simple CRT SH scan with the given query
         stores the results.
@@ -636,6 +701,9 @@ class Server(object):
         :type job_db ScanJob
         :param store_to_db if true results are stored to the database, otherwise just returned.
                Gathered certificates are stored always.
+        :param release_db: if true, the session transaction is committed before the crt.sh queries
+               so the DB connection is not held during the network I/O. New certificates are downloaded
+               before they are stored.
 
         :return:
         :rtype Tuple[DbCrtShQuery, List[DbCrtShQueryResult]]
@@ -656,6 +724,9 @@ class Server(object):
         elif job_type == JobType.UI:
             cert_load_count = 30
 
+        if release_db:
+            DbHelper.release_session(s)
+
         try:
             crt_sh = self.crt_sh_proc.query(raw_query, **scan_kwargs)
 
@@ -708,12 +779,15 @@ class Server(object):
             if store_to_db:
                 s.add(crtsh_res_db)
 
-        # load pem for new certificates
-        for new_crt_id in sorted(list(new_ids), reverse=True)[:cert_load_count]:
-            db_cert, subres = \
-                self.fetch_new_certs(s, job_data, new_crt_id,
-                                     [x for x in crt_sh.results if int(x.id) == new_crt_id][0],
-                                     crtsh_query_db, store_res=store_to_db)
+        # load pem for new certificates - downloaded concurrently, parsed as they arrive, stored at once
+        ids_to_load = sorted(list(new_ids), reverse=True)[:cert_load_count]
+        if release_db:
+            DbHelper.release_session(s)
+
+        index_results = dict([(int(x.id), x) for x in crt_sh.results if x is not None and x.id is not None])
+        downloads = self.crt_sh_proc.download_crts(ids_to_load)
+        for db_cert, subres in self.fetch_new_certs_bulk(s, job_data, downloads, index_results, crtsh_query_db,
+                                                         store_res=store_to_db):
             if db_cert is not None:
                 certs_ids.append(db_cert.id)
             if subres is not None:
@@ -760,38 +834,8 @@ class Server(object):
                     job_db = s.merge(job_db)
                 return last_scan
 
-            scan_db = DbWhoisCheck()
+            scan_db = self.scan_whois_net(top_domain, sys_params)
             scan_db.domain = top_domain_db
-            scan_db.last_scan_at = datetime.now()
-            scan_db.created_at = salch.func.now()
-            scan_db.updated_at = salch.func.now()
-            resp = None
-            try:
-                resp = self.try_whois(top_domain, attempts=sys_params['retry'])
-                if resp is None:  # not found
-                    scan_db.status = 2
-                else:
-                    scan_db.registrant_cc = util.utf8ize(util.first(resp.country))
-                    scan_db.registrar = util.utf8ize(util.first(resp.registrar))
-                    scan_db.expires_at = util.first(resp.expiration_date)
-                    scan_db.registered_at = util.first(resp.creation_date)
-                    scan_db.rec_updated_at = util.first(resp.updated_date)
-                    scan_db.dnssec = not util.is_empty(resp.dnssec) and resp.dnssec != 'unsigned'
-                    scan_db.dns = json.dumps(util.lower(util.strip(
-                        sorted(util.try_list(resp.name_servers)))))
-                    scan_db.emails = json.dumps(util.lower(util.strip(
-                        sorted(util.try_list(resp.emails)))))
-                    scan_db.status = 1
-
-            except ph4whois.parser.PywhoisSlowDownError as se:
-                scan_db.status = 3
-                logger.debug('Whois scan fail - slow down: %s' % se)
-                self.trace_logger.log(se, custom_msg='Whois exception')
-
-            except Exception as e:
-                scan_db.status = 0
-                logger.debug('Whois scan fail: %s' % e)
-                self.trace_logger.log(e, custom_msg='Whois exception')
 
             if store_to_db and scan_db.status != 3:
                 s.add(scan_db)
@@ -806,6 +850,49 @@ class Server(object):
             logger.debug('Exception in whois scan: %s' % e)
             self.trace_logger.log(e)
 
+    def scan_whois_net(self, top_domain, sys_params):
+        """
+        Whois query for the top domain, network part of the whois scan.
+        Does not touch the database, returned check is transient.
+        :param top_domain:
+        :param sys_params:
+        :return:
+        :rtype DbWhoisCheck
+        """
+        scan_db = DbWhoisCheck()
+        scan_db.last_scan_at = datetime.now()
+        scan_db.created_at = salch.func.now()
+        scan_db.updated_at = salch.func.now()
+        resp = None
+        try:
+            resp = self.try_whois(top_domain, attempts=sys_params['retry'])
+            if resp is None:  # not found
+                scan_db.status = 2
+            else:
+                scan_db.registrant_cc = util.utf8ize(util.first(resp.country))
+                scan_db.registrar = util.utf8ize(util.first(resp.registrar))
+                scan_db.expires_at = util.first(resp.expiration_date)
+                scan_db.registered_at = util.first(resp.creation_date)
+                scan_db.rec_updated_at = util.first(resp.updated_date)
+                scan_db.dnssec = not util.is_empty(resp.dnssec) and resp.dnssec != 'unsigned'
+                scan_db.dns = json.dumps(util.lower(util.strip(
+                    sorted(util.try_list(resp.name_servers)))))
+                scan_db.emails = json.dumps(util.lower(util.strip(
+                    sorted(util.try_list(resp.emails)))))
+                scan_db.status = 1
+
+        except ph4whois.parser.PywhoisSlowDownError as se:
+            scan_db.status = 3
+            logger.debug('Whois scan fail - slow down: %s' % se)
+            self.trace_logger.log(se, custom_msg='Whois exception')
+
+        except Exception as e:
+            scan_db.status = 0
+            logger.debug('Whois scan fail: %s' % e)
+            self.trace_logger.log(e, custom_msg='Whois exception')
+
+        return scan_db
+
     def scan_dns(self, s, job_data, query, job_db, store_to_db=True):
         """
         Performs DNS scan
@@ -833,6 +920,7 @@ class Server(object):
         scan_db.last_scan_at = datetime.now()
         scan_db.created_at = salch.func.now()
         scan_db.updated_at = salch.func.now()
+        cname = None
 
         try:
             if is_ip != IpType.NOT_IP:
@@ -842,14 +930,9 @@ class Server(object):
                 scan_db.is_synthetic = True
                 
             else:
-                results = socket.getaddrinfo(domain, 443,
-                                             0,
-                                             socket.SOCK_STREAM,
-                                             socket.IPPROTO_TCP)
-
-                res = []
-                for cur in results:
-                    res.append((cur[0], cur[4][0]))
+                res, cname = self.dns_cache.resolve_host(domain)  # A, AAAA, CNAME concurrently
+                if isinstance(res, Exception):
+                    raise res
 
             scan_db.dns_res = res
             scan_db.dns_status = 1
@@ -873,11 +956,10 @@ class Server(object):
         # CNAME resolution
         try:
             if is_ip == IpType.NOT_IP:
-                my_resolver = dns.resolver.Resolver()
-                my_resolver.timeout = 4
-                cnames = list(my_resolver.query(domain, 'CNAME'))
-                if len(cnames) > 0:
-                    scan_db.cname = util.remove_trailing_char(cnames[0].to_text(), '.')
+                if isinstance(cname, Exception):
+                    raise cname
+                if cname is not None:
+                    scan_db.cname = cname
                     job_data['cname'] = scan_db.cname
 
         except dns.resolver.NoAnswer:
@@ -922,45 +1004,49 @@ class Server(object):
     # Periodic scanner
     #
 
-    def load_active_watch_targets(self, s, last_scan_margin=300, randomize=True):
+    def load_active_watch_targets(self, s):
         """
-        Loads active jobs to scan, from the oldest.
-        After loading the result is a tuple (DbWatchTarget, min_periodicity).
+        Loads active watch targets due to scan, the most overdue first.
+        After loading the result is a tuple (DbWatchTarget, DbWatchService).
+
+        Uses indexed watch_target.next_scan_at maintained by the feeder / workers
+        so the query is a simple range scan. Targets with no next_scan_at are due immediately.
 
-        select wt.*, min(uw.scan_periodicity) from user_watch_target uw
-            inner join watch_target wt on wt.id = uw.watch_id
-            where uw.deleted_at is null
-            group by wt.id, uw.scan_type
-            order by last_scan_state desc;
         :param s : SaQuery query
         :type s: SaQuery
-        :param last_scan_margin: margin for filtering out records that were recently processed.
-        :param randomize: randomizes margin +- 25%
         :return:
         """
-        q = s.query(
-                    DbWatchTarget,
-                    salch.func.min(DbWatchAssoc.scan_periodicity).label('min_periodicity'),
-                    DbWatchService
-        )\
-            .select_from(DbWatchAssoc)\
-            .join(DbWatchTarget, DbWatchAssoc.watch_id == DbWatchTarget.id)\
-            .outerjoin(DbWatchService, DbWatchService.id == DbWatchTarget.service_id)\
+        active_assoc = s.query(DbWatchAssoc.id)\
+            .filter(DbWatchAssoc.watch_id == DbWatchTarget.id)\
             .filter(DbWatchAssoc.deleted_at == None)\
             .filter(DbWatchAssoc.disabled_at == None)
 
-        if last_scan_margin:
-            if randomize:
-                fact = randomize if isinstance(randomize, float) else self.randomize_feeder_fact
-                last_scan_margin += math.ceil(last_scan_margin * random.uniform(-1*fact, fact))
-            cur_margin = datetime.now() - timedelta(seconds=last_scan_margin)
-            q = q.filter(salch.or_(
-                DbWatchTarget.last_scan_at < cur_margin,
-                DbWatchTarget.last_scan_at == None
-            ))
+        return s.query(DbWatchTarget, DbWatchService)\
+            .outerjoin(DbWatchService, DbWatchService.id == DbWatchTarget.service_id)\
+            .filter(salch.or_(
+                DbWatchTarget.next_scan_at <= datetime.now(),
+                DbWatchTarget.next_scan_at == None
+            ))\
+            .filter(active_assoc.exists())\
+            .order_by(DbWatchTarget.next_scan_at)  # select the most overdue first, NULLs first
+
+    def load_watch_min_periodicity(self, s, watch_ids):
+        """
+        Loads minimal scan periodicity over active associations for the given watch targets.
+        :param s:
+        :param watch_ids:
+        :return: watch_id -> min_periodicity
+        """
+        if len(watch_ids) == 0:
+            return {}
 
-        return q.group_by(DbWatchTarget.id, DbWatchAssoc.scan_type)\
-                .order_by(DbWatchTarget.last_scan_at)  # select the oldest scanned first
+        res = s.query(DbWatchAssoc.watch_id, salch.func.min(DbWatchAssoc.scan_periodicity))\
+            .filter(DbWatchAssoc.watch_id.in_(watch_ids))\
+            .filter(DbWatchAssoc.deleted_at == None)\
+            .filter(DbWatchAssoc.disabled_at == None)\
+            .group_by(DbWatchAssoc.watch_id)\
+            .all()
+        return {x[0]: x[1] for x in res}
 
     def load_active_recon_targets(self, s, last_scan_margin=300, randomize=True):
         """
@@ -1031,7 +1117,15 @@ class Server(object):
         Computes minimal scan margin from the scan timeouts
         :return:
         """
-        return min(self.delta_dns, self.delta_tls, self.delta_crtsh, self.delta_whois).total_seconds()
+        return self.min_scan_delta().total_seconds()
+
+    def min_scan_delta(self):
+        """
+        Minimal scan delta of the watcher sub-scans
+        :return:
+        :rtype: timedelta
+        """
+        return min(self.delta_dns, self.delta_tls, self.delta_crtsh, self.delta_whois)
 
     def periodic_queue_is_full(self, for_who=None):
         """
@@ -1079,6 +1173,12 @@ class Server(object):
         self.watcher_job_semaphores[JobTypes.IP_SCAN] = StatSemaphore(num_max_ips)
         self.watcher_job_semaphores[JobTypes.API_PROC] = StatSemaphore(num_max_api)
 
+        # shared executor for network scans fan-out (e.g., multi-IP TLS scans)
+        self.scan_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.config.periodic_scan_workers)
+
+        self.ip_sweeper = IpSweeper(max_workers=self.config.ip_scan_workers,
+                                    pre_probe=self.config.ip_scan_pre_probe)
+
         # periodic worker start
         for worker_idx in range(self.config.periodic_workers):
             t = threading.Thread(target=self.periodic_worker_main, args=(worker_idx,))
@@ -1094,6 +1194,7 @@ class Server(object):
         if self.args.no_jobs:
             return
 
+        self.db.set_subsystem('feeder')
         while self.is_running():
             ctime = time.time()
 
@@ -1155,17 +1256,16 @@ class Server(object):
             return
 
         try:
-            min_scan_margin = self.min_scan_margin()
-            query = self.load_active_watch_targets(s, last_scan_margin=min_scan_margin)
-            iterator = query.yield_per(100)
-            for x in iterator:
-                watch_target, min_periodicity, watch_service = x
+            # Loaded at once, batches are processed with further queries on the same connection.
+            query = self.load_active_watch_targets(s)
+            targets = query.limit(self.watcher_job_queue_size).all()
 
+            for batch in util.chunk(targets, 100):
                 if self.periodic_queue_is_full():
                     return
 
-                job = PeriodicJob(target=watch_target, periodicity=min_periodicity, watch_service=watch_service)
-                self.periodic_add_job(job)
+                jobs = [PeriodicJob(target=x[0], watch_service=x[1]) for x in batch]
+                self._periodic_feeder_watch_batch(s, jobs)
 
         except QFull:
             logger.debug('Queue full')
@@ -1177,6 +1277,201 @@ class Server(object):
             self.trace_logger.log(e)
             raise
 
+    def _periodic_feeder_watch_batch(self, s, jobs):
+        """
+        Prefetches last scans for the batch of watcher jobs, adds jobs to the queue
+        :param s:
+        :param jobs:
+        :return:
+        """
+        with self.watcher_db_lock:
+            jobs = [x for x in jobs if x.key() not in self.watcher_db_cur_jobs]
+        if len(jobs) == 0:
+            return
+
+        periodicities = self.load_watch_min_periodicity(s, [x.watch_id() for x in jobs])
+        for job in jobs:
+            job.periodicity = periodicities.get(job.watch_id())
+
+        try:
+            self.prefetch_last_scans(s, jobs)
+        except Exception as e:
+            logger.warning('Exception in last scan prefetch: %s' % e)
+            self.trace_logger.log(e, custom_msg='Last scan prefetch')
+            for job in jobs:
+                job.prefetch = None
+
+        # Jobs with no sub-scan due are not enqueued, only next scan time is moved.
+        not_due = []
+        for job in jobs:
+            if job.prefetch is None:
+                continue
+
+            next_scan_at = self.periodic_scans_due(job)
+            if len(job.scans_due) == 0:
+                not_due.append({'b_id': job.watch_id(), 'b_next_scan_at': next_scan_at})
+
+        if len(not_due) > 0:
+            self.periodic_update_next_scan(not_due)
+
+        not_due_ids = set([x['b_id'] for x in not_due])
+        for job in jobs:
+            if self.periodic_queue_is_full():
+                return
+            if job.watch_id() not in not_due_ids:
+                self.periodic_add_job(job)
+
+    def periodic_update_next_scan(self, updates):
+        """
+        Moves next scan time of the watch targets.
+        Separate session - commit on the feeder session would expire all loaded targets and prefetched scans
+        handed over to the workers.
+        :param updates: list of dicts {b_id: watch_id, b_next_scan_at: datetime}
+        :return:
+        """
+        s = self.db.get_session()
+        try:
+            self.db_manager.update_watch_next_scan_at(s, updates)
+            s.commit()
+
+        finally:
+            util.silent_expunge_all(s)
+            util.silent_close(s)
+
+    def job_delta(self, job, delta):
+        """
+        Effective scan delta for the job - per-type delta bounded by the assoc minimal scan periodicity (seconds).
+        :param job:
+        :type job: PeriodicJob
+        :param delta:
+        :type delta: timedelta
+        :return:
+        :rtype: timedelta
+        """
+        return job.scan_delta(delta)
+
+    def periodic_scans_due(self, job):
+        """
+        Determines which sub-scans of the watcher job are due from the prefetched last scans.
+        Sets job.scans_due, returns time of the nearest due sub-scan.
+        Due decision is deterministic (no randomization), workers use the same rule (PeriodicJob.is_scan_fresh).
+        Only the returned next scan time is postponed by a random delay, to spread the load.
+
+        :param job:
+        :type job: PeriodicJob
+        :return:
+        :rtype: datetime
+        """
+        now = datetime.now()
+        url = self.urlize(job)
+        prefetch = job.prefetch
+        due_times = {}  # scan type -> due time
+
+        def due_time(last_scan, delta):
+            if last_scan is None or not last_scan.last_scan_at:
+                return now
+            return last_scan.last_scan_at + self.job_delta(job, delta)
+
+        # DNS - not performed for IP hosts, manual DNS
+        _, ips = job.scan_ips(prefetch.dns)
+        if job.dns_scan_applicable():
+            due_times[DbScanType.DNS] = due_time(prefetch.dns, self.delta_dns)
+
+        # TLS - all IPs resolved by the last DNS scan, DNS change may bring new IPs
+        if job.target.agent_id is None:
+            tls_times = [due_time(prefetch.tls.get(ip), self.delta_tls) for ip in set(ips)]
+            if DbScanType.DNS in due_times:
+                tls_times.append(due_times[DbScanType.DNS])
+            if len(tls_times) > 0:
+                due_times[DbScanType.TLS] = min(tls_times)
+
+        due_times[DbScanType.CRTSH] = due_time(prefetch.crtsh, self.delta_crtsh)
+
+        if TlsDomainTools.can_whois(url.host):
+            due_times[DbScanType.WHOIS] = due_time(prefetch.whois, self.delta_whois)
+
+        job.scans_due = set([k for k in due_times if due_times[k] <= now])
+
+        # spread the load a bit
+        next_scan_at = min(due_times.values())
+        spread = self.job_delta(job, self.min_scan_delta()).total_seconds() * self.randomize_feeder_fact
+        return next_scan_at + timedelta(seconds=random.uniform(0, spread))
+
+    def prefetch_last_scans(self, s, jobs):
+        """
+        Loads last scans for the whole batch of watcher jobs in a few IN queries,
+        using the last scan cache. Results are attached to the jobs as LastScanPrefetch.
+
+        :param s:
+        :param jobs:
+        :type jobs: list[PeriodicJob]
+        :return:
+        """
+        if len(jobs) == 0:
+            return
+
+        watch_map = {}  # watch_id -> prefetch
+        for job in jobs:
+            job.prefetch = LastScanPrefetch()
+            watch_map[job.watch_id()] = job.prefetch
+
+        # DNS - denormalized last dns scan id
+        dns_ids = list(set([x.target.last_dns_scan_id for x in jobs if x.target.last_dns_scan_id is not None]))
+        if len(dns_ids) > 0:
+            for dns_scan in s.query(DbDnsResolve).filter(DbDnsResolve.id.in_(dns_ids)).all():
+                if dns_scan.watch_id in watch_map:
+                    watch_map[dns_scan.watch_id].dns = dns_scan
+
+        # TLS + CRTSH - last scan cache
+        caches = s.query(DbLastScanCache) \
+            .filter(DbLastScanCache.cache_type == DbLastScanCacheType.LOCAL_SCAN) \
+            .filter(DbLastScanCache.scan_type.in_([DbScanType.TLS, DbScanType.CRTSH])) \
+            .filter(DbLastScanCache.obj_id.in_(list(watch_map.keys()))) \
+            .all()
+
+        tls_ids = [x.scan_id for x in caches if x.scan_type == DbScanType.TLS]
+        crtsh_ids = [x.scan_id for x in caches if x.scan_type == DbScanType.CRTSH]
+
+        for sub_ids in util.chunk(tls_ids, 500):
+            for tls in s.query(DbHandshakeScanJob).filter(DbHandshakeScanJob.id.in_(sub_ids)).all():
+                if tls.watch_id in watch_map:
+                    watch_map[tls.watch_id].tls[tls.ip_scanned] = tls
+
+        if len(crtsh_ids) > 0:
+            for crtsh in s.query(DbCrtShQuery).filter(DbCrtShQuery.id.in_(crtsh_ids)).all():
+                if crtsh.watch_id in watch_map and crtsh.sub_watch_id is None:
+                    watch_map[crtsh.watch_id].crtsh = crtsh
+
+        # Whois - top domains, last scan cache
+        top_domains = collections.defaultdict(list)  # top domain name -> prefetch list
+        for job in jobs:
+            url = self.urlize(job)
+            if TlsDomainTools.can_whois(url.host):
+                top_domains[TlsDomainTools.get_top_domain(url.host)].append(job.prefetch)
+
+        if len(top_domains) == 0:
+            return
+
+        domain_map = {}  # domain id -> prefetch list
+        for domain in s.query(DbBaseDomain).filter(DbBaseDomain.domain_name.in_(list(top_domains.keys()))).all():
+            domain_map[domain.id] = top_domains[domain.domain_name]
+            for prefetch in domain_map[domain.id]:
+                prefetch.top_domain = domain
+
+        if len(domain_map) == 0:
+            return
+
+        whois_ids = [x.scan_id for x in s.query(DbLastScanCache)
+                     .filter(DbLastScanCache.cache_type == DbLastScanCacheType.LOCAL_SCAN)
+                     .filter(DbLastScanCache.scan_type == DbScanType.WHOIS)
+                     .filter(DbLastScanCache.obj_id.in_(list(domain_map.keys())))
+                     .all()]
+
+        if len(whois_ids) > 0:
+            for whois in s.query(DbWhoisCheck).filter(DbWhoisCheck.id.in_(whois_ids)).all():
+                for prefetch in domain_map.get(whois.domain_id, []):
+                    prefetch.whois = whois
+
     def _periodic_feeder_recon(self, s):
         """
         Load watcher jobs - recon jobs
@@ -1274,6 +1569,7 @@ class Server(object):
         :return:
         """
         self.local_data.idx = idx
+        self.db.set_subsystem('periodic')
         logger.info('Periodic Scanner Worker %02d started' % idx)
 
         while self.is_running():
@@ -1414,11 +1710,14 @@ class Server(object):
         :param job:
         :return:
         """
+        # next feeder check after the shortest scan delta, feeder then computes exact due times
+        next_scan_at = datetime.now() + self.job_delta(job, self.min_scan_delta())
+
         s = self.db.get_session()
         try:
             stmt = DbWatchTarget.__table__.update()\
                 .where(DbWatchTarget.id == job.target.id)\
-                .values(last_scan_at=salch.func.now())
+                .values(last_scan_at=salch.func.now(), next_scan_at=next_scan_at)
             s.execute(stmt)
             s.commit()
 
@@ -1512,6 +1811,8 @@ class Server(object):
             job.attempts += 1
 
         finally:
+            job.prefetch = None  # valid only for the first processing
+            job.scans_due = None
             util.silent_expunge_all(s)
             util.silent_close(s)
 
@@ -1568,15 +1869,26 @@ class Server(object):
         :return:
         """
         job_scan = job.scan_dns  # type: ScanResults
-        last_scan = self.load_last_dns_scan_optim(s, job.watch_id())
-        if last_scan is not None \
-                and last_scan.last_scan_at \
-                and last_scan.last_scan_at > self.diff_time(self.delta_dns, rnd=True):
+        last_scan = job.prefetch.dns if job.prefetch is not None else None
+
+        # IP hosts, manual DNS - no DNS scan, IPs from the host / the last synthetic DNS result
+        if not job.dns_scan_applicable():
+            if last_scan is None and job.target.manual_dns:
+                last_scan = self.load_last_dns_scan_optim(s, job.watch_id())
+            job_scan.skip(last_scan)
+            self.wp_process_dns(s, job, last_scan)
+            return
+
+        if job.is_scan_due(DbScanType.DNS) and not job.is_scan_fresh(last_scan, self.delta_dns):
+            last_scan = self.load_last_dns_scan_optim(s, job.watch_id())
+
+        if not job.is_scan_due(DbScanType.DNS) or job.is_scan_fresh(last_scan, self.delta_dns):
             job_scan.skip(last_scan)
             self.wp_process_dns(s, job, job_scan.aux)
             return  # scan is relevant enough
 
         try:
+            DbHelper.release_session(s, detach=True)
             self.wp_scan_dns(s, job, last_scan)
 
         except Exception as e:
@@ -1604,15 +1916,21 @@ class Server(object):
             job_scan.skip()  # DNS is an important part, if watch cannot be resolved - give up.
             return
 
-        prev_scans = self.load_last_tls_scan_last_dns(s, job.watch_id(), job.ips)
-        prev_scans_map = {x.ip_scanned: x for x in prev_scans}
-
-        # repeat
         ips_set = set(job.ips)
-        scans_to_repeat = list(ips_set - set([x.ip_scanned for x in prev_scans]))  # not scanned yet
-        scans_to_repeat += [x.ip_scanned for x in prev_scans
-                            if x.ip_scanned != '-' and x.ip_scanned in ips_set
-                            and (not x.last_scan_at or x.last_scan_at <= self.diff_time(self.delta_tls, rnd=True))]
+        scans_to_repeat = None
+        prev_scans_map = None
+
+        # prefetched scans are used only to skip fresh ones, scan is performed on fresh data from the DB.
+        if job.prefetch is not None:
+            prev_scans = [job.prefetch.tls[ip] for ip in ips_set if ip in job.prefetch.tls]
+            prev_scans_map = {x.ip_scanned: x for x in prev_scans}
+            scans_to_repeat = self._tls_scans_to_repeat(job, ips_set, prev_scans) \
+                if job.is_scan_due(DbScanType.TLS) else []
+
+        if scans_to_repeat is None or len(scans_to_repeat) > 0:
+            prev_scans = self.load_last_tls_scan_last_dns(s, job.watch_id(), job.ips)
+            prev_scans_map = {x.ip_scanned: x for x in prev_scans}
+            scans_to_repeat = self._tls_scans_to_repeat(job, ips_set, prev_scans)
 
         logger.debug('ips: %s, repeat: %s, url: %s, scan map: %s, '
                      % (job.ips, scans_to_repeat, self.urlize(job), prev_scans_map))
@@ -1622,8 +1940,13 @@ class Server(object):
             return  # scan is relevant enough
 
         try:
-            for cur_ip in scans_to_repeat:
-                self.wp_scan_tls(s, job, prev_scans_map, ip=cur_ip)
+            if len(scans_to_repeat) > 1 and self.scan_executor is not None:
+                DbHelper.release_session(s, detach=True)
+                self.wp_scan_tls_multi(s, job, prev_scans_map, scans_to_repeat)
+            else:
+                for cur_ip in scans_to_repeat:
+                    DbHelper.release_session(s, detach=True)
+                    self.wp_scan_tls(s, job, prev_scans_map, ip=cur_ip)
             job_scan.ok()
 
         except Exception as e:
@@ -1632,6 +1955,21 @@ class Server(object):
             logger.error('TLS scan exception: %s' % e)
             self.trace_logger.log(e, custom_msg='TLS scan')
 
+    def _tls_scans_to_repeat(self, job, ips_set, prev_scans):
+        """
+        Returns list of IP addresses to repeat the TLS scan on
+        :param job:
+        :type job: PeriodicJob
+        :param ips_set:
+        :param prev_scans:
+        :return:
+        """
+        scans_to_repeat = list(ips_set - set([x.ip_scanned for x in prev_scans]))  # not scanned yet
+        scans_to_repeat += [x.ip_scanned for x in prev_scans
+                            if x.ip_scanned != '-' and x.ip_scanned in ips_set
+                            and not job.is_scan_fresh(x, self.delta_tls)]
+        return scans_to_repeat
+
     def periodic_scan_crtsh(self, s, job):
         """
         Periodic CRTsh scan - determines if the check is required, invokes the check
@@ -1642,14 +1980,16 @@ class Server(object):
         """
         job_scan = job.scan_crtsh  # type: ScanResults
 
-        last_scan = self.load_last_crtsh_scan(s, job.watch_id())
-        if last_scan is not None \
-                and last_scan.last_scan_at \
-                and last_scan.last_scan_at > self.diff_time(self.delta_crtsh, rnd=True):
+        last_scan = job.prefetch.crtsh if job.prefetch is not None else None
+        if job.is_scan_due(DbScanType.CRTSH) and not job.is_scan_fresh(last_scan, self.delta_crtsh):
+            last_scan = self.load_last_crtsh_scan(s, job.watch_id())
+
+        if not job.is_scan_due(DbScanType.CRTSH) or job.is_scan_fresh(last_scan, self.delta_crtsh):
             job_scan.skip(last_scan)
             return  # scan is relevant enough
 
         try:
+            DbHelper.release_session(s, detach=True)
             self.wp_scan_crtsh(s, job, last_scan)
 
         except Exception as e:
@@ -1673,17 +2013,21 @@ class Server(object):
             job_scan.skip()
             return  # has IP address only, no whois check
 
+        if job.prefetch is not None \
+                and (not job.is_scan_due(DbScanType.WHOIS) or job.is_scan_fresh(job.prefetch.whois, self.delta_whois)):
+            job_scan.skip(job.prefetch.whois)
+            return  # scan is relevant enough, prefetched
+
         top_domain = TlsDomainTools.get_top_domain(url.host)
         top_domain, is_new = self.db_manager.load_top_domain(s, top_domain)
         last_scan = self.load_last_whois_scan(s, top_domain) if not is_new else None
-        if last_scan is not None \
-                and last_scan.last_scan_at \
-                and last_scan.last_scan_at > self.diff_time(self.delta_whois, rnd=True):
+        if job.is_scan_fresh(last_scan, self.delta_whois):
             job_scan.skip(last_scan)
             return  # scan is relevant enough
 
         # initiate new whois check
         try:
+            DbHelper.release_session(s, detach=True)
             self.wp_scan_whois(s=s, job=job, url=url, top_domain=top_domain, last_scan=last_scan)
 
         except Exception as e:
@@ -1858,6 +2202,7 @@ class Server(object):
         if is_same_as_before:
             last_scan.last_scan_at = salch.func.now()
             last_scan.num_scans += 1
+            s.merge(last_scan)
             job_scan.aux = last_scan
 
         else:
@@ -1883,13 +2228,7 @@ class Server(object):
         s.commit()
 
         # Store scan history
-        hist = DbScanHistory()
-        hist.watch_id = job.target.id
-        hist.scan_type = 4  # dns scan
-        hist.scan_code = 0
-        hist.created_at = salch.func.now()
-        s.add(hist)
-        s.commit()
+        self.db_sink.add_history(job.target.id, scan_type=4)  # dns scan
 
         # TODO: store gap if there is one
         # - compare last scan with the SLA periodicity. multiple IP addressess make it complicated...
@@ -1904,20 +2243,15 @@ class Server(object):
 
     def wp_process_dns(self, s, job, last_scan):
         """
-        Processes DNS scan, sets primary IP address
+        Processes DNS scan, sets primary IP address, IP addresses to scan
         :param s:
         :param job:
-        :type job: ScanJob
+        :type job: PeriodicJob
         :param last_scan:
         :type last_scan: DbDnsResolve
         :return:
         """
-        if last_scan and last_scan.dns_res and len(last_scan.dns_res) > 0:
-            domains = sorted(last_scan.dns_res)
-            job.primary_ip = domains[0][1]
-            job.ips = [x[1] for x in last_scan.dns_res]
-        else:
-            job.primary_ip = None
+        job.primary_ip, job.ips = job.scan_ips(last_scan)
 
     def wp_scan_tls(self, s, job, scan_list, ip=None):
         """
@@ -1929,6 +2263,61 @@ class Server(object):
         :param ip:
         :return:
         """
+        url = self.urlize(job)
+        job_spec = self._wp_scan_tls_spec(job, scan_list, ip=ip)
+        if job_spec is None:
+            return False
+
+        handshake_res, db_scan = self.scan_handshake(s, job_spec, url.host, None, store_job=False)
+        if handshake_res is None:
+            return False
+
+        return self._wp_scan_tls_store(s, job, scan_list, db_scan)
+
+    def wp_scan_tls_multi(self, s, job, scan_list, ips):
+        """
+        Watcher TLS scan for multiple IP addresses of the same target.
+        Network part of the scans (handshake, connect analysis) runs concurrently in the shared
+        scan executor, results are then merged to the database on the job's session sequentially,
+        in the order of the given IP addresses.
+
+        :param s:
+        :param job:
+        :type job: PeriodicJob
+        :param scan_list:
+        :param ips:
+        :return:
+        """
+        futures = []
+        for ip in ips:
+            job_spec = self._wp_scan_tls_spec(job, scan_list, ip=ip)
+            if job_spec is None:
+                continue
+            futures.append(self.scan_executor.submit(self.scan_handshake_net, job_spec))
+
+        # Wait for all scans to finish before touching the DB so a failure does not leave running scans behind.
+        concurrent.futures.wait(futures)
+
+        for future in futures:
+            ret = future.result()
+            if ret is None or ret[0] is None:
+                continue
+
+            handshake_res, db_scan = ret
+            self.scan_handshake_persist(s, handshake_res, db_scan, store_job=False)
+            self._wp_scan_tls_store(s, job, scan_list, db_scan)
+
+        return True
+
+    def _wp_scan_tls_spec(self, job, scan_list, ip=None):
+        """
+        Builds job spec for the watcher TLS scan
+        :param job:
+        :type job: PeriodicJob
+        :param scan_list:
+        :param ip:
+        :return: job spec or None if the scan should be skipped
+        """
         job_scan = job.scan_tls  # type: ScanResults
         job_spec = self._create_job_spec(job)
         url = self.urlize(job)
@@ -1946,16 +2335,25 @@ class Server(object):
             job_spec['scan_host'] = job.primary_ip
         else:
             job_scan.skip(scan_list)  # skip TLS handshake check totally if DNS is not valid
-            return False
+            return None
 
         # Cname from DNS scan
         if job.scan_dns and job.scan_dns.aux and job.scan_dns.aux.cname:
             job_spec['cname'] = job.scan_dns.aux.cname
 
-        handshake_res, db_scan = self.scan_handshake(s, job_spec, url.host, None, store_job=False)
-        if handshake_res is None:
-            return False
+        return job_spec
 
+    def _wp_scan_tls_store(self, s, job, scan_list, db_scan):
+        """
+        Compares the TLS scan with the last one, stores the result
+        :param s:
+        :param job:
+        :type job: PeriodicJob
+        :param scan_list:
+        :param db_scan:
+        :type db_scan: DbHandshakeScanJob
+        :return:
+        """
         last_scan = util.defvalkey(scan_list, db_scan.ip_scanned, None)
 
         # Compare with last result, store if new one or update the old one
@@ -1976,16 +2374,10 @@ class Server(object):
             logger.info('TLS scan is different, lastscan: %s for %s' % (last_scan, db_scan.ip_scanned))
 
             # update last scan cache
-            ResultModelUpdater.update_cache(s, db_scan)
+            self.db_sink.update_cache(db_scan)
 
         # Store scan history
-        hist = DbScanHistory()
-        hist.watch_id = job.target.id
-        hist.scan_type = 1
-        hist.scan_code = 0
-        hist.created_at = salch.func.now()
-        s.add(hist)
-        s.commit()
+        self.db_sink.add_history(job.target.id, scan_type=1)
 
         # TODO: store gap if there is one
         # - compare last scan with the SLA periodicity. multiple IP addressess make it complicated...
@@ -2011,7 +2403,7 @@ class Server(object):
         url = self.urlize(job)
 
         crtsh_query_db, sub_res_list = self.scan_crt_sh(
-            s=s, job_data=job_spec, query=url.host, job_db=None, store_to_db=False)
+            s=s, job_data=job_spec, query=url.host, job_db=None, store_to_db=False, release_db=True)
         if crtsh_query_db is None:
             job_scan.fail()
             return
@@ -2035,16 +2427,10 @@ class Server(object):
             s.commit()
 
             # update last scan cache
-            ResultModelUpdater.update_cache(s, crtsh_query_db)
+            self.db_sink.update_cache(crtsh_query_db)
 
         # Store scan history
-        hist = DbScanHistory()
-        hist.watch_id = job.target.id
-        hist.scan_type = 2  # crtsh scan
-        hist.scan_code = 0
-        hist.created_at = salch.func.now()
-        s.add(hist)
-        s.commit()
+        self.db_sink.add_history(job.target.id, scan_type=2)  # crtsh scan
 
         # TODO: store gap if there is one
         # - compare last scan with the SLA periodicity. multiple IP addressess make it complicated...
@@ -2094,27 +2480,20 @@ class Server(object):
 
         # new result - store new subdomain data, invalidate old results
         if not is_same_as_before:
-            # - extract domains to the result cache....
-            # - load previously saved certs, not loaded now, from db
-            # TODO: load previous result, just add altnames added in new certificates.
+            # - extract domains to the result cache.
+            # - incremental: only certificates newer than the last watermark, merged to the previous result
             sub_lists = list(sub_res_list) + list(sub_res_list_base)
-            certs_to_load = list(set([x.crt_id for x in sub_lists
-                                      if x is not None and x.crt_sh_id is not None and x.cert_db is None]))
-            certs_loaded = list(self.cert_manager.cert_load_by_id(s, certs_to_load).values())
-            certs_downloaded = [x.cert_db for x in sub_lists
-                                if x is not None and x.cert_db is not None]
-
-            all_alt_names = set()
-            for cert in (certs_loaded + certs_downloaded):  # type: Certificate
-                for alt in cert.all_names:
-                    all_alt_names.add(util.lower(alt))
-
-            # - filter out alt names not ending on the target
-            suffix = '.%s' % query.iquery
-            suffix_alts = set()
-            for alt in all_alt_names:
-                if alt.endswith(suffix) or alt == query.iquery:
-                    suffix_alts.add(alt)
+            watermark = self.wildcard_recon_watermark(job.watch_id(), last_cache_res)
+            suffix_alts = self.wildcard_alt_names(s, query.iquery, sub_lists, watermark)
+            if watermark is not None:
+                suffix_alts.update(last_cache_res.trans_result)
+            else:
+                self.wildcard_full_recon[job.watch_id()] = time.time()
+
+            newest_ids = [x.crt_sh_id for x in sub_lists if x is not None and x.crt_sh_id is not None]
+            if watermark is not None:
+                newest_ids.append(watermark)
+            newest_idx = max(newest_ids) if newest_ids else crtsh_query_db.newest_cert_sh_id
 
             # Result
             db_sub = DbSubdomainResultCache()
@@ -2122,21 +2501,25 @@ class Server(object):
             db_sub.created_at = salch.func.now()
             db_sub.updated_at = salch.func.now()
             db_sub.last_scan_at = salch.func.now()
-            db_sub.last_scan_idx = crtsh_query_db.newest_cert_sh_id
+            db_sub.last_scan_idx = newest_idx
             db_sub.num_scans = 1
             db_sub.scan_type = 1  # crtsh
             db_sub.trans_result = sorted(list(suffix_alts))
             db_sub.result_size = len(db_sub.trans_result)
             db_sub.result = json.dumps(db_sub.trans_result)
 
+            def update_watermark(x):
+                x.last_scan_idx = newest_idx
+
             mm = DbSubdomainResultCache
             is_same, db_sub_new, last_scan = \
-                ResultModelUpdater.insert_or_update(s, [mm.watch_id, mm.scan_type], [mm.result], db_sub)
+                ResultModelUpdater.insert_or_update(s, [mm.watch_id, mm.scan_type], [mm.result], db_sub,
+                                                    last_scan_update_fnc=update_watermark)
             s.commit()
 
             # update last scan cache
             if not is_same:
-                ResultModelUpdater.update_cache(s, db_sub_new)
+                self.db_sink.update_cache(db_sub_new)
 
             # Subdomains insert / update
             self.subs_sync_records(s, job, db_sub_new)
@@ -2163,6 +2546,54 @@ class Server(object):
         # finished with success
         job_scan.ok()
 
+    def wildcard_recon_watermark(self, watch_id, last_cache_res):
+        """
+        Returns the crt.sh ID watermark for the incremental wildcard recon, None if the full recon is needed:
+        no previous result or the periodic full reconciliation is due.
+        :param watch_id:
+        :param last_cache_res:
+        :type last_cache_res: DbSubdomainResultCache
+        :return:
+        """
+        if last_cache_res is None or last_cache_res.last_scan_idx is None:
+            return None
+
+        last_full = self.wildcard_full_recon.get(watch_id)
+        if last_full is None or last_full + self.delta_wildcard_full.total_seconds() < time.time():
+            return None
+
+        return last_cache_res.last_scan_idx
+
+    def wildcard_alt_names(self, s, iquery, sub_lists, watermark=None):
+        """
+        Collects alt names of the crt.sh result certificates matching the wildcard query.
+        With the watermark only certificates newer than the watermark or freshly downloaded are processed.
+        :param s:
+        :param iquery: wildcard domain
+        :param sub_lists: crt.sh query results
+        :type sub_lists: list[DbCrtShQueryResult]
+        :param watermark: newest crt.sh ID processed before
+        :return: set of alt names
+        """
+        sub_lists = [x for x in sub_lists if x is not None]
+        if watermark is not None:
+            sub_lists = [x for x in sub_lists
+                         if x.cert_db is not None or (x.crt_sh_id is not None and x.crt_sh_id > watermark)]
+
+        # - load previously saved certs, not loaded now, from db
+        certs_to_load = list(set([x.crt_id for x in sub_lists if x.crt_sh_id is not None and x.cert_db is None]))
+        certs_loaded = list(self.cert_manager.cert_load_by_id(s, certs_to_load).values()) if certs_to_load else []
+        certs_downloaded = [x.cert_db for x in sub_lists if x.cert_db is not None]
+
+        all_alt_names = set()
+        for cert in (certs_loaded + certs_downloaded):  # type: Certificate
+            for alt in cert.all_names:
+                all_alt_names.add(util.lower(alt))
+
+        # - filter out alt names not ending on the target
+        suffix = '.%s' % iquery
+        return set([alt for alt in all_alt_names if alt.endswith(suffix) or alt == iquery])
+
     def wp_scan_whois(self, s, job, url, top_domain, last_scan):
         """
         Watcher whois scan - body
@@ -2180,7 +2611,8 @@ class Server(object):
         job_spec = self._create_job_spec(job)
         url = self.urlize(job)
 
-        scan_db = self.scan_whois(s=s, job_data=job_spec, query=top_domain, job_db=None, store_to_db=False)
+        # network phase, no DB connection held during the whois query
+        scan_db = self.scan_whois_net(top_domain.domain_name, job_spec['sysparams'])
         if scan_db.status == 3:  # too fast
             job_scan.fail()
             return
@@ -2192,6 +2624,7 @@ class Server(object):
             last_scan.num_scans += 1
             last_scan = s.merge(last_scan)
         else:
+            scan_db.domain_id = top_domain.id
             scan_db.watch_id = job.target.id
             scan_db.num_scans = 1
             scan_db.updated_at = salch.func.now()
@@ -2206,16 +2639,10 @@ class Server(object):
 
         # update last scan cache
         if not is_same_as_before:
-            ResultModelUpdater.update_cache(s, scan_db)
+            self.db_sink.update_cache(scan_db)
 
         # Store scan history
-        hist = DbScanHistory()
-        hist.watch_id = job.target.id
-        hist.scan_type = 3  # whois
-        hist.scan_code = 0
-        hist.created_at = salch.func.now()
-        s.add(hist)
-        s.commit()
+        self.db_sink.add_history(job.target.id, scan_type=3)  # whois
 
         # TODO: store gap if there is one
         # - compare last scan with the SLA periodicity. multiple IP addressess make it complicated...
@@ -2240,7 +2667,7 @@ class Server(object):
 
         # crtsh search for base record
         crtsh_query_db_base, sub_res_list_base = self.scan_crt_sh(
-            s=s, job_data=job_spec, query=query_base, job_db=None, store_to_db=False)
+            s=s, job_data=job_spec, query=query_base, job_db=None, store_to_db=False, release_db=True)
 
         # load previous input id scan - for change detection
         last_scan_base = self.load_last_crtsh_wildcard_scan(s, watch_id=job.target.id, input_id=query_base.id)
@@ -2264,7 +2691,7 @@ class Server(object):
         # WILDCARD
         # crtsh search for wildcard
         crtsh_query_db, sub_res_list = self.scan_crt_sh(
-            s=s, job_data=job_spec, query=query, job_db=None, store_to_db=False)
+            s=s, job_data=job_spec, query=query, job_db=None, store_to_db=False, release_db=True)
 
         is_same_as_before = self.diff_scan_crtsh_wildcard(crtsh_query_db, last_scan)
         if is_same_as_before:
@@ -2342,7 +2769,7 @@ class Server(object):
             target = s.merge(job.target)
             target.last_result_id = scan_db.id
 
-            ResultModelUpdater.update_cache(s, scan_db)
+            self.db_sink.update_cache(scan_db)
             s.commit()
 
         s.commit()
@@ -2373,24 +2800,33 @@ class Server(object):
         ip_int_end = TlsDomainTools.ip_to_int(job.target.ip_end)
         iter = TlsDomainTools.iter_ips(ip_start_int=ip_int_beg, ip_stop_int=ip_int_end)
 
-        time_start = time.time()
+        job_spec['sysparams']['timeout'] = 5
+        job_spec['sysparams']['retry'] = 2
+        port = int(util.defvalkey(job_spec, 'scan_port', 443, take_none=False))
+
+        def scan_ip(ip):
+            ip_spec = dict(job_spec)
+            ip_spec['sysparams'] = dict(job_spec['sysparams'])
+            ip_spec['scan_ip'] = ip
+            return self.scan_handshake_net(ip_spec, do_connect_analysis=False)
+
+        # Network part of the sweep, concurrent, chunked, IPs with closed port are skipped by the pre-probe
+        sweep_res = self.ip_sweeper.sweep(iter, port, scan_ip, is_running=self.is_running)
+
+        # Server termination - abort job, will be performed all over again next time
+        if sweep_res.aborted or not self.is_running():
+            raise ServerShuttingDown('IP scanning aborted')
+
+        logger.debug('IP sweep finished: %s' % sweep_res)
+
         live_ips_ids = []
         valid_ips_ids = []
         valid_ips = []
-        for ip in iter:
-            # Server termination - abort job, will be performed all over again next time
-            if not self.is_running():
-                raise ServerShuttingDown('IP scanning aborted')
-
-            # TODO: easy parallelization, threads, input = job_spec, output = handshake, db_scan
-            # Greater chunks are needed, 1 IP per thread is not efficient, take at least 10 per thread.
-            job_spec['scan_ip'] = ip
-            job_spec['sysparams']['timeout'] = 5
-            job_spec['sysparams']['retry'] = 2
-            handshake_res, db_scan = \
-                self.scan_handshake(s, job_spec, None, None, store_job=False,
-                                    do_connect_analysis=False, do_process_certificates=False)
+        for ip, scan_res in sweep_res.results:
+            if scan_res is None or scan_res[1] is None:
+                continue
 
+            handshake_res, db_scan = scan_res
             if db_scan.err_code:
                 continue
 
@@ -2412,7 +2848,7 @@ class Server(object):
         res.last_scan_at = salch.func.now()
         res.finished_at = salch.func.now()
 
-        res.duration = time.time() - time_start
+        res.duration = sweep_res.duration
         res.num_ips_alive = len(live_ips_ids)
         res.num_ips_found = len(valid_ips)
         res.ips_alive_ids = json.dumps(live_ips_ids)
@@ -2958,43 +3394,35 @@ class Server(object):
         # Raw hostname
         test_domain = TlsDomainTools.parse_hostname(hostname)
 
-        # Try raw connect to the tls if the previous failure does not indicate service is not running
+        # Probes run concurrently, each bounded by the probe deadline
+        # - https: raw connect to the tls if the previous failure does not indicate service is not running
+        # - http: simple HTTP check - default connection point when there is no scheme
+        urls = []
         if resp.handshake_failure not in [TlsHandshakeErrors.CONN_ERR, TlsHandshakeErrors.READ_TO]:
-            c_url = '%s://%s:%s' % (scheme, test_domain, port)
-
-            # Direct request attempt on the url - analyze Request behaviour, headers.
-            r, error = self.tls_scanner.req_connect(c_url, timeout=sys_params['timeout'], allow_redirects=False)
-            scan_db.req_https_result = self.tls_scanner.err2status(error)
+            urls.append('%s://%s:%s' % (scheme, test_domain, port))
+        if port == 443:
+            urls.append('http://%s' % test_domain)
 
-            # Another request for HSTS & pinning detection without cert verify.
-            if error == RequestErrorCode.SSL:
-                r, error = self.tls_scanner.req_connect(c_url, timeout=sys_params['timeout'], allow_redirects=False,
-                                                        verify=False)
-            self.http_headers_analysis(s, scan_db, r)
+        probes = self.tls_scanner.connect_probes(urls, timeout=sys_params['timeout'],
+                                                 max_duration=self.config.probe_deadline)
 
-            r, error = self.tls_scanner.req_connect(c_url, timeout=sys_params['timeout'])
-            scan_db.follow_https_result = self.tls_scanner.err2status(error)
+        if resp.handshake_failure not in [TlsHandshakeErrors.CONN_ERR, TlsHandshakeErrors.READ_TO]:
+            probe = probes.pop(0)
 
-            # Load follow URL if there was a SSL error.
-            if error == RequestErrorCode.SSL:
-                r, error = self.tls_scanner.req_connect(c_url, timeout=sys_params['timeout'], verify=False)
+            # Direct request on the url - analyze Request behaviour, headers. Same response starts the redirect chain
+            scan_db.req_https_result = self.tls_scanner.err2status(probe.first_error)
+            self.http_headers_analysis(s, scan_db, probe.first)
 
-            scan_db.follow_https_url = r.url if error is None else None
+            scan_db.follow_https_result = self.tls_scanner.err2status(probe.follow_error)
+            scan_db.follow_https_url = probe.follow_url
 
-        # simple HTTP check - default connection point when there is no scheme
         if port == 443:
-            c_url = 'http://%s' % test_domain
-
-            r, error = self.tls_scanner.req_connect(c_url, timeout=sys_params['timeout'])
-            scan_db.follow_http_result = self.tls_scanner.err2status(error)
-
-            # Another request without cert verify, follow url is interesting
-            if error == RequestErrorCode.SSL:
-                r, error = self.tls_scanner.req_connect(c_url, timeout=sys_params['timeout'], verify=False)
-
-            scan_db.follow_http_url = r.url if error is None else None
+            probe = probes.pop(0)
+            scan_db.follow_http_result = self.tls_scanner.err2status(probe.follow_error)
+            scan_db.follow_http_url = probe.follow_url
 
-        s.flush()
+        if s is not None:
+            s.flush()
 
     def http_headers_analysis(self, s, scan_db, r):
         """
@@ -3040,7 +3468,7 @@ class Server(object):
             return None
 
         try:
-            addr = socket.gethostbyaddr(ip)
+            addr = self.dns_cache.gethostbyaddr(ip)
             scan_db.ip_scanned_reverse = util.take_last(addr[0], 254)
             scan_db.cdn_reverse = self.cname_cdn_classif.classify_cname(scan_db.ip_scanned_reverse)
 
@@ -3067,7 +3495,7 @@ class Server(object):
             return JobType.UI
         return params['mode']
 
-    def fetch_new_certs(self, s, job_data, crt_sh_id, index_result, crtsh_query_db, store_res=True):
+    def fetch_new_certs(self, s, job_data, crt_sh_id, index_result, crtsh_query_db, store_res=True, response=None):
         """
         Fetches the new cert from crt.sh, parses, inserts to the db
         :param s: 
@@ -3076,14 +3504,80 @@ class Server(object):
         :param index_result: 
         :param crtsh_query_db: crt.sh scan object
         :param store_res: true if to store crt sh result
+        :param response: already downloaded crt.sh response, downloaded if None
         :return: cert_db
         :rtype: Tuple[Certificate, DbCrtShQueryResult]
         """
         try:
-            response = self.crt_sh_proc.download_crt(crt_sh_id)
+            new_cert = self.load_crtsh_cert(crt_sh_id, index_result, response=response)
+            if new_cert is None:
+                return None, None
+
+            cert_db, is_new = self.cert_manager.add_cert_or_fetch(s, new_cert, fetch_first=True, add_alts=True)
+            crtsh_res_db = self.crtsh_cert_result(s, crt_sh_id, cert_db, new_cert, is_new, crtsh_query_db,
+                                                  store_res=store_res)
+            s.commit()
+            return cert_db, crtsh_res_db
+
+        except Exception as e:
+            logger.error('Exception when downloading a certificate %s: %s' % (crt_sh_id, e))
+            self.trace_logger.log(e)
+        return None, None
+
+    def fetch_new_certs_bulk(self, s, job_data, downloads, index_results, crtsh_query_db, store_res=True):
+        """
+        Parses downloaded crt.sh certs as they arrive, inserts all of them to the db at once
+        :param s:
+        :param job_data:
+        :param downloads: iterable of (crt.sh id, crt.sh response)
+        :param index_results: crt.sh id -> index result
+        :param crtsh_query_db: crt.sh scan object
+        :param store_res: true if to store crt sh result
+        :return: list of stored certificates and crt.sh results
+        :rtype: list[Tuple[Certificate, DbCrtShQueryResult]]
+        """
+        new_certs = []
+        for crt_sh_id, response in downloads:
+            new_cert = self.load_crtsh_cert(crt_sh_id, index_results[crt_sh_id], response=response)
+            if new_cert is not None:
+                new_certs.append((crt_sh_id, new_cert))
+
+        if len(new_certs) == 0:
+            return []
+
+        ret = []
+        try:
+            stored = self.cert_manager.add_certs_bulk(s, [x[1] for x in new_certs], fetch_first=True, add_alts=True)
+            for crt_sh_id, new_cert in new_certs:
+                cert_db = stored.get(util.lower(new_cert.fprint_sha1))
+                if cert_db is None:
+                    continue
+
+                crtsh_res_db = self.crtsh_cert_result(s, crt_sh_id, cert_db, new_cert, cert_db.trans_is_new,
+                                                      crtsh_query_db, store_res=store_res)
+                ret.append((cert_db, crtsh_res_db))
+            s.commit()
+
+        except Exception as e:
+            logger.error('Exception when storing downloaded certificates: %s' % e)
+            self.trace_logger.log(e)
+        return ret
+
+    def load_crtsh_cert(self, crt_sh_id, index_result, response=None):
+        """
+        Downloads the cert from crt.sh if not downloaded yet, parses it to the new Certificate
+        :param crt_sh_id:
+        :param index_result:
+        :param response: already downloaded crt.sh response, downloaded if None
+        :return:
+        :rtype: Certificate
+        """
+        try:
+            if response is None:
+                response = self.crt_sh_proc.download_crt(crt_sh_id)
             if not response.success:
                 logger.debug('Download of %s not successful' % crt_sh_id)
-                return None, None
+                return None
 
             cert_db = Certificate()
             cert_db.crt_sh_id = crt_sh_id
@@ -3091,44 +3585,53 @@ class Server(object):
             cert_db.created_at = salch.func.now()
             cert_db.pem = util.strip_pem(response.result)
             cert_db.source = 'crt.sh'
-            alt_names = []
 
             try:
-                cert = self.cert_manager.parse_certificate(cert_db, pem=str(cert_db.pem))
-                alt_names = cert_db.alt_names_arr
+                self.cert_manager.parse_certificate(cert_db, pem=str(cert_db.pem))
 
             except Exception as e:
                 cert_db.fprint_sha1 = util.try_sha1_pem(str(cert_db.pem))
                 logger.error('Unable to parse certificate %s: %s' % (crt_sh_id, e))
                 self.trace_logger.log(e)
 
-            new_cert = cert_db
-            cert_db, is_new = self.cert_manager.add_cert_or_fetch(s, cert_db, fetch_first=True, add_alts=True)
-            if not is_new:   # cert exists, fill in missing fields if empty
-                mm = Certificate
-                changes = DbHelper.update_model_null_values(cert_db, new_cert, [
-                    mm.crt_sh_id, mm.crt_sh_ca_id, mm.parent_id,
-                    mm.key_type, mm.key_bit_size, mm.sig_alg])
-                if changes > 0:
-                    s.commit()
-
-            # crt.sh scan info
-            crtsh_res_db = DbCrtShQueryResult()
-            crtsh_res_db.query_id = crtsh_query_db.id
-            crtsh_res_db.job_id = crtsh_query_db.job_id
-            crtsh_res_db.was_new = 1
-            crtsh_res_db.crt_id = cert_db.id
-            crtsh_res_db.crt_sh_id = crt_sh_id
-            crtsh_res_db.cert_db = cert_db
-            if store_res:
-                s.add(crtsh_res_db)
-
-            return cert_db, crtsh_res_db
+            return cert_db
 
         except Exception as e:
             logger.error('Exception when downloading a certificate %s: %s' % (crt_sh_id, e))
             self.trace_logger.log(e)
-        return None, None
+        return None
+
+    def crtsh_cert_result(self, s, crt_sh_id, cert_db, new_cert, is_new, crtsh_query_db, store_res=True):
+        """
+        Builds crt.sh scan result for the stored certificate.
+        Fills in missing fields of the existing certificate. Does not commit.
+        :param s:
+        :param crt_sh_id:
+        :param cert_db: stored certificate
+        :param new_cert: downloaded certificate
+        :param is_new:
+        :param crtsh_query_db: crt.sh scan object
+        :param store_res: true if to store crt sh result
+        :return:
+        :rtype: DbCrtShQueryResult
+        """
+        if not is_new:   # cert exists, fill in missing fields if empty
+            mm = Certificate
+            DbHelper.update_model_null_values(cert_db, new_cert, [
+                mm.crt_sh_id, mm.crt_sh_ca_id, mm.parent_id,
+                mm.key_type, mm.key_bit_size, mm.sig_alg])
+
+        # crt.sh scan info
+        crtsh_res_db = DbCrtShQueryResult()
+        crtsh_res_db.query_id = crtsh_query_db.id
+        crtsh_res_db.job_id = crtsh_query_db.job_id
+        crtsh_res_db.was_new = 1
+        crtsh_res_db.crt_id = cert_db.id
+        crtsh_res_db.crt_sh_id = crt_sh_id
+        crtsh_res_db.cert_db = cert_db
+        if store_res:
+            s.add(crtsh_res_db)
+        return crtsh_res_db
 
     def analyze_cert(self, s, job_data, cert):
         """
@@ -3294,19 +3797,7 @@ class Server(object):
         :param domain:
         :return:
         """
-        blcopy = []
-        with self.sub_blacklist_lock:
-            blcopy = list(self.sub_blacklist)
-
-        for rule in blcopy:
-            if rule.rule_type == BlacklistRuleType.SUFFIX:
-                if domain.endswith(rule.rule):
-                    return rule
-            elif rule.rule_type == BlacklistRuleType.MATCH:
-                if domain == rule.rule:
-                    return rule
-
-        return None
+        return self.sub_blacklist.find(domain)
 
     def get_validation_leaf_error(self, valres):
         """
@@ -3710,6 +4201,7 @@ class Server(object):
         :return: 
         """
         self.local_data.idx = idx
+        self.db.set_subsystem('redis')
         logger.info('Worker %02d started' % idx)
 
         while self.is_running():
@@ -3737,16 +4229,16 @@ class Server(object):
                 self.job_queue.task_done()
         logger.info('Worker %02d terminated' % idx)
 
-    def scan_load_redis_job(self):
+    def scan_load_redis_jobs(self):
         """
-        Loads redis job from the queue. Blocking behavior for optimized performance
+        Loads a batch of redis jobs from the queue. Blocking behavior for optimized performance
         :return: 
         """
-        job = self.redis_queue.pop(blocking=True, timeout=1)
-        if job is None:
+        jobs = self.redis_queue.pop_batch(count=self.config.redis_pop_batch, blocking=True, timeout=1)
+        if len(jobs) == 0:
             raise QEmpty()
 
-        return job
+        return jobs
 
     def scan_redis_jobs(self):
         """
@@ -3758,23 +4250,22 @@ class Server(object):
         logger.info('Redis total queue size: %s' % cur_size)
 
         while self.is_running():
-            job = None
+            jobs = []
             try:
-                job = self.scan_load_redis_job()
+                jobs = self.scan_load_redis_jobs()
 
             except QEmpty:
                 time.sleep(0.01)
                 continue
 
-            try:
-                self.job_queue.put(('redis', job))
+            for job in jobs:
+                try:
+                    self.job_queue.put(('redis', job))
 
-            except Exception as e:
-                logger.error('Exception in processing job %s' % (e, ))
-                self.trace_logger.log(e)
+                except Exception as e:
+                    logger.error('Exception in processing job %s' % (e, ))
+                    self.trace_logger.log(e)
 
-            finally:
-                pass
         logger.info('Queue scanner terminated')
 
     #
@@ -3836,10 +4327,11 @@ class Server(object):
         s = None
         try:
             s = self.db.get_session()
-            blacklist_db = s.query(DbSubdomainScanBlacklist).all()
+            blacklist_db = s.query(DbSubdomainScanBlacklist).order_by(DbSubdomainScanBlacklist.id).all()
+            index = BlacklistIndex(blacklist_db)
 
             with self.sub_blacklist_lock:
-                self.sub_blacklist = blacklist_db
+                self.sub_blacklist = index
 
         finally:
             util.silent_close(s)
@@ -3859,6 +4351,16 @@ class Server(object):
                         continue
 
                     self.state_ram_check()
+                    logger.debug('DB write sink: %s' % self.db_sink.stats_str())
+                    logger.debug('DB pool: %s' % self.db.pool_state())
+                    logger.debug('Cert cache: %s' % self.cert_cache.stats_str())
+                    logger.debug('crt.sh HTTP: %s' % self.crt_sh_proc.http_pool.stats_str())
+                    logger.debug('Redis queue: %s' % self.redis_queue.stats_str())
+                    logger.debug('DNS cache: %s' % self.dns_cache.stats_str())
+                    logger.debug('Blacklist: %s' % self.sub_blacklist.stats_str())
+                    if self.mod_agent.agent_spool is not None:
+                        logger.debug('Agent spool: %s' % self.mod_agent.agent_spool.stats_str())
+                    self.db.check_held_connections()
                     self.state_last_check = cur_time
 
                 except Exception as e:
@@ -3952,6 +4454,16 @@ class Server(object):
         for server_mod in self.modules:
             server_mod.shutdown()
 
+        if self.scan_executor is not None:
+            self.scan_executor.shutdown(wait=False)
+        self.tls_scanner.shutdown()
+        self.dns_cache.shutdown()
+        if self.ip_sweeper is not None:
+            self.ip_sweeper.shutdown()
+
+        # drain write-behind buffers
+        self.db_sink.shutdown()
+
     def run_modules(self):
         """
         Run all modules
@@ -14,7 +14,9 @@ from future.utils import iteritems
 
 from . import util
 from . import dbutil
-from .agent import AgentResultPush
+from .agent import AgentResultPush, AgentResultSpool, encode_results_payload
+from .agent_commands import publish_agent_command
+from .core import CONFIG_DIR
 from .tls_domain_tools import TlsDomainTools
 from .trace_logger import Tracelogger
 from .errors import Error, InvalidHostname, ServerShuttingDown, InvalidInputData
@@ -38,6 +40,7 @@ from queue import Queue, Empty as QEmpty, Full as QFull, PriorityQueue
 
 
 import sqlalchemy as salch
+from flask import jsonify, make_response
 from sqlalchemy.orm.query import Query as SaQuery
 from sqlalchemy import case, literal_column
 from sqlalchemy.orm.session import make_transient
@@ -50,14 +53,26 @@ class ServerAgent(ServerModule):
     """
     Server API processor
     """
+    SPOOL_FILE = 'agent-spool.log'
+    PUBLISH_BACKOFF_MIN = 1.0
+    PUBLISH_BACKOFF_MAX = 120.0
+    HOSTS_FULL_SYNC = 600  # full host sync period, delta syncs in between
 
     def __init__(self, *args, **kwargs):
         super(ServerAgent, self).__init__(*args, **kwargs)
 
         self.trace_logger = Tracelogger(logger)
         self.local_data = threading.local()
-        self.agent_publish_event = threading.Event()  # if set to true publish now
         self.agent_queue = PriorityQueue()  # queue of results to publish
+        self.agent_spool = None  # type: AgentResultSpool
+        self.agent_batch = []  # scans collected for the next batch
+        self.agent_batch_started = None
+        self.agent_publish_backoff = 0
+        self.agent_publish_next = 0  # time of the next publish attempt after a failure
+        self.agent_hosts_etag = None  # host list version of the last sync
+        self.agent_hosts_cursor = None  # updated_at cursor of the last sync
+        self.agent_hosts_ids = set()  # watch ids synced from the master
+        self.agent_hosts_full_sync = 0  # time of the last full sync
 
     def init(self, server):
         """
@@ -101,6 +116,7 @@ class ServerAgent(ServerModule):
             # insert dummy user for watch association
             s = self.db.get_session()
             self._agent_init_sentinels(s)
+            self.agent_init_spool()
 
             # Start publisher thread
             publish_thread = threading.Thread(target=self.agent_publisher_main, args=())
@@ -129,7 +145,15 @@ class ServerAgent(ServerModule):
         psh.job = job
 
         self.agent_queue.put(psh, False)
-        self.agent_publish_event.set()
+
+    def agent_init_spool(self):
+        """
+        Opens the result spool, pending batches from the previous run are published first
+        :return:
+        """
+        path = util.defval(self.config.agent_spool, os.path.join(CONFIG_DIR, self.SPOOL_FILE))
+        self.agent_spool = AgentResultSpool(path)
+        self.agent_spool.open()
 
     def _agent_init_sentinels(self, s):
         """
@@ -197,7 +221,7 @@ class ServerAgent(ServerModule):
         kwds['headers'] = headers
         kwds.setdefault('timeout', 10)
 
-        attempts = kwds.get('attempts', 3)
+        attempts = kwds.pop('attempts', 3)
         for attempt in range(attempts):
             try:
                 r = requests.request(method=method, url=self.config.master_endpoint + url, **kwds)
@@ -211,19 +235,50 @@ class ServerAgent(ServerModule):
 
     def agent_sync_hosts(self, s):
         """
-        Syncs hosts with the master by calling get hosts method and syncing
+        Syncs hosts with the master by calling get hosts method and syncing.
+        After the full sync only targets changed since the last sync are requested,
+        nothing is transferred if the host list version did not change.
         :param s:
         :return:
         """
-        resp = self._agent_request_get(url='/api/v1.0/get_targets')
-        targets = resp.json()
-        targets = targets['targets']
-        self.agent_merge_hosts(s, targets)
+        delta = self.agent_hosts_etag is not None and self.agent_hosts_full_sync + self.HOSTS_FULL_SYNC > time.time()
+        params, headers = {}, {}
+        if delta:
+            params['since'] = self.agent_hosts_cursor
+            headers['If-None-Match'] = self.agent_hosts_etag
+
+        resp = self._agent_request_get(url='/api/v1.0/get_targets', params=params, headers=headers)
+        if resp.status_code == 304:
+            return
+
+        js = resp.json()
+        targets = js['targets']
+        version = js.get('version')
+        if not js.get('delta'):
+            self.agent_hosts_ids = set(self.agent_merge_hosts(s, targets))
+            self.agent_hosts_full_sync = time.time()
+
+        else:
+            # Deleted targets are not in the delta, detected by the version mismatch -> full sync
+            ids = self.agent_hosts_ids | set([x['id'] for x in targets])
+            if len(ids) != version['count'] or sum(ids) != version['id_sum']:
+                logger.debug('Host set changed, full sync')
+                self.agent_hosts_etag = None
+                return self.agent_sync_hosts(s)
+
+            self.agent_merge_hosts(s, targets, delta=True)
+            self.agent_hosts_ids = ids
+
+        self.agent_hosts_etag = resp.headers.get('ETag') if version is not None else None
+        self.agent_hosts_cursor = version['cursor'] if version is not None else None
 
-    def agent_merge_hosts(self, s, targets):
+    def agent_merge_hosts(self, s, targets, delta=False):
         """
         Merges loaded hosts from the master
-        :return:
+        :param s:
+        :param targets:
+        :param delta: if true, targets contain only changed targets, associations are not removed
+        :return: list of merged watch ids
         """
         allowed_ids = []
         for target in targets:
@@ -232,7 +287,7 @@ class ServerAgent(ServerModule):
             allowed_ids.append(watch.id)
 
         # load all assocs, insert new ones
-        assocs = s.query(DbWatchAssoc).filter(DbWatchAssoc.watch_id.in_(allowed_ids)).all()
+        assocs = s.query(DbWatchAssoc).filter(DbWatchAssoc.watch_id.in_(allowed_ids)).all() if allowed_ids else []
         associated_watches = set([x.watch_id for x in assocs])
         watches_to_assoc = list(set(allowed_ids) - associated_watches)
         for wid in watches_to_assoc:
@@ -249,10 +304,12 @@ class ServerAgent(ServerModule):
                 logger.warning('Could not add WID: %s: %s' % (wid, e))
 
         # delete assocs where watch id not in the allowed ids
-        stmt = salch.delete(DbWatchAssoc) \
-            .where(DbWatchAssoc.watch_id.notin_(allowed_ids))
-        s.execute(stmt)
+        if not delta:
+            stmt = salch.delete(DbWatchAssoc) \
+                .where(DbWatchAssoc.watch_id.notin_(allowed_ids))
+            s.execute(stmt)
         s.commit()
+        return allowed_ids
 
     def agent_watch_to_db(self, s, watch_json, svc=None, top_domain=None):
         """
@@ -276,14 +333,27 @@ class ServerAgent(ServerModule):
         if svc is not None:
             watch.service_id = svc.id
 
-        db_watch, is_new = ModelUpdater.load_or_insert(s, watch, [
+        cols = [
             DbWatchTarget.id,
             DbWatchTarget.scan_host,
             DbWatchTarget.scan_port,
             DbWatchTarget.scan_scheme,
             DbWatchTarget.scan_connect,
             DbWatchTarget.service_id
-        ])
+        ]
+
+        # target changed on the master, update ours
+        db_watch = s.query(DbWatchTarget).filter(DbWatchTarget.id == watch.id).first()
+        if db_watch is not None:
+            changed = [x.key for x in cols if getattr(db_watch, x.key) != getattr(watch, x.key)]
+            for key in changed:
+                setattr(db_watch, key, getattr(watch, key))
+            if changed:
+                db_watch.updated_at = salch.func.now()
+                s.commit()
+            return db_watch
+
+        db_watch, is_new = ModelUpdater.load_or_insert(s, watch, cols)
         return db_watch
 
     def agent_svc_to_db(self, s, svc_json):
@@ -310,6 +380,7 @@ class ServerAgent(ServerModule):
         :return:
         """
         logger.info('Agent host sync thread started %s %s %s' % (os.getpid(), os.getppid(), threading.current_thread()))
+        self.db.set_subsystem('agent')
         try:
             last_sync_check = 0
             while self.is_running():
@@ -345,15 +416,10 @@ class ServerAgent(ServerModule):
         :return:
         """
         logger.info('Agent publish thread started %s %s %s' % (os.getpid(), os.getppid(), threading.current_thread()))
+        self.db.set_subsystem('agent')
         try:
-            last_sync_check = 0
             while self.is_running():
                 try:
-                    time.sleep(0.25)
-                    cur_time = time.time()
-                    if last_sync_check + 5 > cur_time and not self.agent_publish_event.is_set():
-                        continue
-
                     s = None
                     try:
                         s = self.db.get_session()
@@ -362,16 +428,19 @@ class ServerAgent(ServerModule):
                     finally:
                         util.silent_close(s)
 
-                    last_sync_check = cur_time
-
                 except Exception as e:
                     logger.error('Exception in publish: %s' % e)
                     self.trace_logger.log(e)
+                    time.sleep(1)
 
         except Exception as e:
             logger.error('Exception: %s' % e)
             self.trace_logger.log(e)
 
+        finally:
+            self._agent_spool_batch()
+            util.silent_close(self.agent_spool)
+
         logger.info('Agent publish loop terminated')
 
     def agent_publish(self, s):
@@ -382,65 +451,120 @@ class ServerAgent(ServerModule):
         # TODO: fetch all last scans from the master, load all scans greater than those provided and publish
         # TODO    missing first. Then process queue with new scans - ignore those already being sent.
 
-        # Queue processing
+        # Queue processing - new scans are batched to the spool
         self._agent_publish_queue(s)
 
-    def _agent_publish_queue(self, s):
+        # Spool processing - batches are sent to the master
+        self._agent_publish_spool()
+
+    def _agent_publish_queue(self, s, timeout=0.25):
         """
-        Processes agents publish queue
+        Moves new scans from the publish queue to the current batch.
+        Batch is persisted to the spool when it is full or the oldest scan waits too long.
         :param s:
+        :param timeout: max time to wait for a new scan
         :return:
         """
-        self.agent_publish_event.clear()  # reset signal - we are processing already
-        job = None  # type: AgentResultPush
-        try:
-            job = self.agent_queue.get(True, timeout=1.0)
+        max_scans = self.config.agent_publish_batch
+        max_delay = self.config.agent_publish_delay / 1000.0
+
+        while len(self.agent_batch) < max_scans:
+            if self.agent_batch_started is not None:
+                timeout = min(timeout, max(0, self.agent_batch_started + max_delay - time.time()))
+
+            job = None  # type: AgentResultPush
+            try:
+                job = self.agent_queue.get(timeout > 0, timeout=timeout if timeout > 0 else None)
+            except QEmpty:
+                break
+
             try:
-                self._agent_queue_job(s, job)
+                scan = self._agent_queue_job(s, job)
+                if scan is not None:
+                    self.agent_batch.append(scan)
+                    if self.agent_batch_started is None:
+                        self.agent_batch_started = time.time()
+
             except Exception as e:
                 logger.error('Uncaught exception in publish queue process: %s' % e)
                 self.trace_logger.log(e, custom_msg='Publish queue process')
-                time.sleep(5)  # prevent submitting too fast in case of an error
+
             finally:
                 self.agent_queue.task_done()
-        except QEmpty:
+
+        if len(self.agent_batch) == 0:
+            return
+        if len(self.agent_batch) < max_scans and self.agent_batch_started + max_delay > time.time():
             return
+        self._agent_spool_batch()
+
+    def _agent_spool_batch(self):
+        """
+        Persists the current batch to the spool
+        :return:
+        """
+        if len(self.agent_batch) == 0:
+            return
+
+        req = util.jsonify({'scans': self.agent_batch})
+        self.agent_spool.append(encode_results_payload(req))
+        self.agent_batch = []
+        self.agent_batch_started = None
 
     def _agent_queue_job(self, s, job):
         """
-        Processes one agent job for publish
+        Converts one agent job to the publish record
         :param s:
         :param job:
         :type job: AgentResultPush
-        :return:
+        :return: scan record or None if not published
         """
         if job is None:
-            return
+            return None
 
-        try:
-            new_scan = job.new_scan
-            old_scan = job.old_scan
-            if not isinstance(new_scan, (DbDnsResolve, DbHandshakeScanJob)):
-                return
+        new_scan = job.new_scan
+        old_scan = job.old_scan
+        if not isinstance(new_scan, (DbDnsResolve, DbHandshakeScanJob)):
+            return None
 
-            new_scan_dict = self.agent_dictize_scan(s, new_scan)
-            if new_scan_dict is None:
-                return
+        new_scan_dict = self.agent_dictize_scan(s, new_scan)
+        if new_scan_dict is None:
+            return None
 
-            scans = [{'new_scan': new_scan_dict, 'prev_scan_id': None}]
-            if old_scan is not None and hasattr(old_scan, 'id'):
-                scans['prev_scan_id'] = old_scan.id
+        scan = {'new_scan': new_scan_dict, 'prev_scan_id': None}
+        if old_scan is not None and hasattr(old_scan, 'id'):
+            scan['prev_scan_id'] = old_scan.id
+        return scan
 
-            req = {'scans': scans}
-            req_json = util.jsonify(req)
+    def _agent_publish_spool(self):
+        """
+        Sends pending spooled batches to the master in the order, backs off on a failure
+        :return:
+        """
+        if self.agent_publish_next > time.time():
+            return
 
-            resp = self._agent_request_post(url='/api/v1.0/new_results', json=req_json)
-            logger.debug(resp)
+        for batch_id in self.agent_spool.pending_ids():
+            if not self.is_running():
+                return
 
-        except Exception as e:
-            logger.warning('Could not push, reenqueue: %s' % e)
-            self.trace_logger.log(e, custom_msg='publish reenqueue')
-            self.agent_queue.put(job)
+            try:
+                resp = self._agent_request_post(url='/api/v1.0/new_results', data=self.agent_spool.read(batch_id),
+                                                headers={'Content-Encoding': 'gzip',
+                                                         'Content-Type': 'application/json'},
+                                                attempts=1)
+                logger.debug(resp)
+
+            except Exception as e:
+                self.agent_publish_backoff = min(self.PUBLISH_BACKOFF_MAX,
+                                                 max(self.PUBLISH_BACKOFF_MIN, self.agent_publish_backoff * 2))
+                self.agent_publish_next = time.time() + self.agent_publish_backoff * random.uniform(0.5, 1.0)
+                logger.warning('Could not push batch %s, %s pending, retry in %.1f s: %s'
+                               % (batch_id, len(self.agent_spool), self.agent_publish_backoff, e))
+                return
+
+            self.agent_spool.ack(batch_id)
+            self.agent_publish_backoff = 0
 
     def agent_dictize_scan(self, s, obj):
         """
@@ -510,6 +634,84 @@ class ServerAgent(ServerModule):
 
         return ret
 
+    def agent_targets_version(self, s, agent_id):
+        """
+        Master: version of the agent host list - number of targets, sum of IDs and the updated_at cursor.
+        Changes, additions and removals change the version.
+        :param s:
+        :param agent_id:
+        :return:
+        """
+        row = s.query(salch.func.count(DbWatchTarget.id), salch.func.sum(DbWatchTarget.id),
+                      salch.func.max(DbWatchTarget.updated_at), salch.func.max(DbWatchService.updated_at)) \
+            .outerjoin(DbWatchService, DbWatchService.id == DbWatchTarget.service_id) \
+            .filter(DbWatchTarget.agent_id == agent_id).one()
+
+        updates = [util.unix_time(x) for x in row[2:] if x is not None]
+        return {'count': int(row[0]), 'id_sum': int(util.defval(row[1], 0)), 'cursor': max(updates + [0])}
+
+    def agent_load_targets(self, s, agent_id, since=None):
+        """
+        Master: watch targets of the agent with services and top domains
+        :param s:
+        :param agent_id:
+        :param since: if set, only targets updated at the cursor or later are returned
+        :return: list of dicts
+        """
+        q = s.query(DbWatchTarget, DbWatchService, DbBaseDomain)\
+            .outerjoin(DbWatchService, DbWatchService.id == DbWatchTarget.service_id)\
+            .outerjoin(DbBaseDomain, DbBaseDomain.id == DbWatchTarget.top_domain_id)\
+            .filter(DbWatchTarget.agent_id == agent_id)
+
+        if since is not None:
+            since_dt = datetime.datetime.utcfromtimestamp(since)
+            q = q.filter(salch.or_(DbWatchTarget.updated_at >= since_dt, DbWatchService.updated_at >= since_dt))
+
+        def sub_proc(rec):
+            rec[0].trans_service = rec[1]
+            rec[0].trans_top_domain = rec[2]
+            return rec[0]
+
+        recs_proc = [sub_proc(rec) for rec in q.all()]
+        cols = DbWatchTarget.__table__.columns + [
+            dbutil.ColTransformWrapper(dbutil.TransientCol(name='trans_service'), DbHelper.to_dict),
+            dbutil.ColTransformWrapper(dbutil.TransientCol(name='trans_top_domain'), DbHelper.to_dict)
+        ]
+        dicts = [DbHelper.to_dict(x, cols=cols) for x in recs_proc]
+        return [util.jsonify(x) for x in dicts]
+
+    def agent_on_get_targets(self, s, r, request):
+        """
+        Master: processes get targets request from the agent.
+        Returns 304 if the host list version matches If-None-Match,
+        only targets changed since the cursor if `since` is given.
+        :param s:
+        :param r:
+        :param request:
+        :return:
+        """
+        version = self.agent_targets_version(s, r.agent.id)
+        etag = '%(count)d-%(id_sum)d-%(cursor).3f' % version
+        if request.if_none_match.contains(etag):
+            resp = make_response('', 304)
+            resp.set_etag(etag)
+            return resp
+
+        since = request.args.get('since', type=float)
+        targets = self.agent_load_targets(s, r.agent.id, since=since)
+        resp = jsonify({'result': True, 'targets': targets, 'delta': since is not None, 'version': version})
+        resp.set_etag(etag)
+        return resp
+
+    def agent_send_command(self, agent_id, command):
+        """
+        Master: sends the command to the agent, delivered to its wait_command long poll via Redis pub/sub
+        :param agent_id:
+        :param command:
+        :return:
+        """
+        return publish_agent_command(self.server.redis_queue, agent_id, command)
+
     def agent_on_new_results(self, s, r, results):
         """
         Processes new results from the agent
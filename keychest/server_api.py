@@ -15,13 +15,15 @@ from functools import wraps
 import sqlalchemy as salch
 import eventlet
 from eventlet import wsgi
+from eventlet.green import threading as green_threading
 from flask import Flask, jsonify, request, abort
 from flask_socketio import SocketIO, send as ws_send, emit as ws_emit
 
-from . import dbutil
 from . import util
+from .agent import decode_results_payload
+from .agent_commands import AgentCommandRegistry
 from .consts import DbLastScanCacheType, DbScanType
-from .dbutil import DbKeychestAgent, DbWatchTarget, DbLastScanCache, DbWatchService, DbBaseDomain, DbHelper
+from .dbutil import DbKeychestAgent, DbWatchTarget, DbLastScanCache, DbHelper
 from .trace_logger import Tracelogger
 
 eventlet.monkey_patch(socket=True)
@@ -63,6 +65,7 @@ class RestAPI(object):
     HTTP_PORT = 33080
     HTTPS_PORT = 33443
     API_HEADER = 'X-Auth-API'
+    WAIT_COMMAND_TIMEOUT = 10.0
 
     def __init__(self):
         self.running = True
@@ -81,6 +84,7 @@ class RestAPI(object):
 
         self.flask = Flask(__name__)
         self.socket_io = None
+        self.commands = None  # type: AgentCommandRegistry
 
     #
     # Management
@@ -103,6 +107,8 @@ class RestAPI(object):
         """
         self.running = False
         self.stop_event.set()
+        if self.commands is not None:
+            self.commands.shutdown()
 
     def wsgi_options(self):
         """
@@ -122,6 +128,12 @@ class RestAPI(object):
         self.flask.config['REDIS_URL'] = LOCAL_REDIS
         self.flask.config['SECRET_KEY'] = util.random_alphanum(16)
 
+        # werkzeug debug server uses real threads (in-process commands only), eventlet green threads otherwise
+        use_green = self.use_websockets or not self.debug
+        self.commands = AgentCommandRegistry(threading_module=green_threading if use_green else threading)
+        if use_green:
+            eventlet.spawn(self.commands_listen_main)
+
         if self.use_sse:
             sse = ServerSentEventsBlueprint('sse', __name__)
             sse.add_url_rule(rule="", endpoint="stream", view_func=sse.stream)
@@ -195,6 +207,23 @@ class RestAPI(object):
         self.run_thread.setDaemon(True)
         self.run_thread.start()
 
+    def commands_listen_main(self):
+        """
+        Agent commands Redis pub/sub listener, green thread
+        :return:
+        """
+        logger.info('Agent commands listener started')
+        while self.running:
+            try:
+                self.commands.listen_redis(redis.StrictRedis(host=self.config.redis_host,
+                                                             port=self.config.redis_port))
+            except Exception as e:
+                logger.error('Exception in agent commands listener: %s' % e)
+                self.trace_logger.log(e)
+                eventlet.sleep(5)
+
+        logger.info('Agent commands listener terminated')
+
     #
     # REST interface
     #
@@ -293,6 +322,7 @@ class RestAPI(object):
             abort(400)
 
         r.api_key = request.headers[self.API_HEADER]
+        self.db.set_subsystem('api')
         r.s = s = self.db.get_session()
 
         r.agent = s.query(DbKeychestAgent).filter(DbKeychestAgent.api_key == r.api_key).first()
@@ -374,49 +404,28 @@ class RestAPI(object):
     def on_get_targets(self, r=None, request=None):
         """
         Loads watch targets for sync.
+        Supports conditional requests (ETag) and `since` cursor for delta sync.
         :param r:
         :param request:
         :return:
         """
-        s = r.s
-        recs = s.query(DbWatchTarget, DbWatchService, DbBaseDomain)\
-            .outerjoin(DbWatchService, DbWatchService.id == DbWatchTarget.service_id)\
-            .outerjoin(DbBaseDomain, DbBaseDomain.id == DbWatchTarget.top_domain_id)\
-            .filter(DbWatchTarget.agent_id == r.agent.id).all()
-
-        def sub_proc(rec):
-            rec[0].trans_service = rec[1]
-            rec[0].trans_top_domain = rec[2]
-            return rec[0]
-
-        recs_proc = [sub_proc(rec) for rec in recs]
-        cols = DbWatchTarget.__table__.columns + [
-            dbutil.ColTransformWrapper(dbutil.TransientCol(name='trans_service'), DbHelper.to_dict),
-            dbutil.ColTransformWrapper(dbutil.TransientCol(name='trans_top_domain'), DbHelper.to_dict)
-        ]
-        dicts = [DbHelper.to_dict(x, cols=cols) for x in recs_proc]
-        dicts = [util.jsonify(x) for x in dicts]
-        return jsonify({'result': True, 'targets': dicts})
+        return self.server.mod_agent.agent_on_get_targets(r.s, r, request)
 
     @wrap_requests()
     def on_wait_command(self, r=None, request=None):
         """
-        Commet like command push
+        Commet like command push.
+        Waits for a command for the agent up to WAIT_COMMAND_TIMEOUT seconds,
+        the waiting request is blocked without consuming CPU or the DB connection.
         :param r:
         :param request:
         :return:
         """
-        cmds = []
+        agent_id = r.agent.id
+        util.silent_close(r.s)
 
-        # TODO: pull commands from the queue somehow
-        start_time = time.time()
-        thresh = start_time + 10.0
-        while True:
-            ctime = time.time()
-            if ctime >= thresh:
-                break
-
-        return jsonify({'result': True, 'commands': []})
+        cmds = self.commands.wait(agent_id, timeout=self.WAIT_COMMAND_TIMEOUT)
+        return jsonify({'result': True, 'commands': cmds})
 
     @wrap_requests()
     def on_get_latest_results(self, r=None, request=None):
@@ -450,6 +459,10 @@ class RestAPI(object):
         data.json = {scans:[ res ]}
         res = {new_scan: nr, prev_scan_id: lr}
 
+        Agents publish batches of scans as gzip compressed JSON of the same form (Content-Encoding: gzip),
+        plain JSON requests are accepted as well. Batch may be sent again if the response got lost,
+        already processed scans are skipped using the last scan cache.
+
         We might check for last results and if prev result does not match our result just reject this update.
         Client then should ask for last scan IDs and push all missing ones.
 
@@ -470,7 +483,7 @@ class RestAPI(object):
         # logger.debug(json.dumps(request.json, indent=2))
 
         # r.last_results = self._get_last_scans(r.s, r)
-        self.server.agent_on_new_results(r.s, r, request.json)
+        self.server.mod_agent.agent_on_new_results(r.s, r, decode_results_payload(request))
         return jsonify({'result': True})
 
 
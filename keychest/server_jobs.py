@@ -8,11 +8,12 @@ Server job classes
 from past.builtins import cmp
 import collections
 import logging
+from datetime import datetime, timedelta
 
-from .tls_domain_tools import TargetUrl
+from .tls_domain_tools import TargetUrl, TlsDomainTools
 from .dbutil import DbWatchService, DbWatchTarget, DbIpScanRecord, DbApiWaitingObjects, DbManagedTest, \
     DbManagedSolution, DbManagedService, DbManagedHost, DbManagedTestProfile, DbKeychestAgent, DbManagedCertIssue, \
-    DbManagedCertificate, Certificate
+    DbManagedCertificate, Certificate, DbDnsResolve, DbHandshakeScanJob, DbCrtShQuery, DbBaseDomain, DbWhoisCheck
 from . import util
 
 
@@ -55,6 +56,24 @@ class ScanResults(object):
                % (self.success, self.skipped, self.code, self.attempts, self.aux)
 
 
+class LastScanPrefetch(object):
+    """
+    Last scans prefetched by the feeder for the periodic job in a batch.
+    Used by the worker to decide whether the scan can be skipped without hitting the database.
+    Records are detached from the session.
+    """
+    def __init__(self):
+        self.dns = None  # type: DbDnsResolve
+        self.tls = {}  # ip -> DbHandshakeScanJob
+        self.crtsh = None  # type: DbCrtShQuery
+        self.top_domain = None  # type: DbBaseDomain
+        self.whois = None  # type: DbWhoisCheck
+
+    def __repr__(self):
+        return '<LastScanPrefetch(dns=%r, tls=%r, crtsh=%r, top_domain=%r, whois=%r)>' \
+               % (self.dns, self.tls, self.crtsh, self.top_domain, self.whois)
+
+
 class JobTypes(object):
     """
     Job types used to process by Keychest workers
@@ -240,10 +259,72 @@ class PeriodicJob(BaseJob):
         self.scan_tls = ScanResults()
         self.scan_crtsh = ScanResults()
         self.scan_whois = ScanResults()
+        self.prefetch = None  # type: LastScanPrefetch
+        self.scans_due = None  # set of DbScanType due to scan, None = undecided, all
 
     def key(self):
         return 'w%s' % self.target.id
 
+    def is_scan_due(self, scan_type):
+        """
+        Returns true if the sub-scan is due, determined by the feeder
+        :param scan_type:
+        :return:
+        """
+        return self.scans_due is None or scan_type in self.scans_due
+
+    def scan_delta(self, delta):
+        """
+        Effective scan delta - per-type delta bounded by the assoc minimal scan periodicity (seconds).
+        :param delta:
+        :type delta: timedelta
+        :return:
+        :rtype: timedelta
+        """
+        if not self.periodicity:
+            return delta
+        return min(delta, max(timedelta(seconds=int(self.periodicity)), timedelta(minutes=5)))
+
+    def is_scan_fresh(self, last_scan, delta, now=None):
+        """
+        Returns true if the last scan is recent enough w.r.t. the effective delta so the new scan can be skipped.
+        Same rule as the feeder uses to compute the due time, no randomization.
+        :param last_scan:
+        :param delta:
+        :type delta: timedelta
+        :param now:
+        :return:
+        """
+        if last_scan is None or not last_scan.last_scan_at:
+            return False
+        return last_scan.last_scan_at + self.scan_delta(delta) > util.defval(now, datetime.now())
+
+    def dns_scan_applicable(self):
+        """
+        Returns true if the DNS scan is performed for the target - not for IP hosts, manual DNS
+        and hosts not eligible for whois.
+        :return:
+        """
+        host = self.target.scan_host
+        return not TlsDomainTools.is_ip(host) \
+            and not self.target.manual_dns \
+            and TlsDomainTools.can_whois(host)
+
+    def scan_ips(self, last_dns=None):
+        """
+        IP addresses of the target to scan - the host itself if it is an IP address,
+        the IP addresses from the last DNS scan otherwise.
+        :param last_dns:
+        :type last_dns: DbDnsResolve
+        :return: (primary IP, list of IPs)
+        """
+        host = self.target.scan_host
+        if TlsDomainTools.is_ip(host):
+            return host, [host]
+        if last_dns is not None and last_dns.dns_res:
+            return sorted(last_dns.dns_res)[0][1], [x[1] for x in last_dns.dns_res]
+        return None, []
+
     def cmpval(self):
         return self.attempts, \
                self.later, \
@@ -166,6 +166,7 @@ class ManagementModule(ServerModule):
         :return:
         """
         logger.info('Test target sync started')
+        self.db.set_subsystem('modules')
         while self.is_running():
             self.server.interruptible_sleep(2)
 
@@ -263,6 +264,7 @@ class ManagementModule(ServerModule):
         :return:
         """
         logger.info('Managed cert sync started')
+        self.db.set_subsystem('modules')
         while self.is_running():
             self.server.interruptible_sleep(2)
 
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import resource
+import threading
+import time
+import unittest
+
+import redis
+
+from ..agent_commands import AgentCommandRegistry, publish_agent_command
+
+
+__author__ = 'dusanklinec'
+
+
+def cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+class AgentCommandRegistryTest(unittest.TestCase):
+    """Agent command long poll"""
+
+    def __init__(self, *args, **kwargs):
+        super(AgentCommandRegistryTest, self).__init__(*args, **kwargs)
+
+    def setUp(self):
+        self.registry = AgentCommandRegistry()
+
+    def tearDown(self):
+        self.registry.shutdown()
+
+    def _wait_async(self, agent_id, timeout, results):
+        def wait():
+            results.append((agent_id, self.registry.wait(agent_id, timeout=timeout)))
+
+        thread = threading.Thread(target=wait)
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _wait_waiters(self, num):
+        time_start = time.time()
+        while self.registry.num_waiters() < num and time.time() - time_start < 10:
+            time.sleep(0.01)
+        self.assertEqual(self.registry.num_waiters(), num)
+
+    def test_pending(self):
+        self.registry.push(1, {'cmd': 'a'})
+        self.registry.push(1, {'cmd': 'b'})
+        self.assertEqual(self.registry.wait(1, timeout=5), [{'cmd': 'a'}, {'cmd': 'b'}])
+        self.assertEqual(self.registry.wait(1, timeout=0), [])
+
+    def test_timeout(self):
+        time_start = time.time()
+        self.assertEqual(self.registry.wait(1, timeout=0.3), [])
+        self.assertAlmostEqual(time.time() - time_start, 0.3, delta=0.15)
+
+        # shorter deadline registered later wakes up first
+        results = []
+        threads = [self._wait_async(1, 1.0, results), self._wait_async(2, 0.2, results)]
+        time.sleep(0.4)
+        self.assertEqual(results, [(2, [])])
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.registry.num_waiters(), 0)
+        self.assertEqual(self.registry.num_timeouts, 3)
+
+    def test_wake(self):
+        results = []
+        threads = [self._wait_async(1, 10, results), self._wait_async(1, 10, results),
+                   self._wait_async(2, 10, results)]
+        self._wait_waiters(3)
+
+        time_start = time.time()
+        self.registry.push(1, 'scan')
+        threads[0].join()
+        threads[1].join()
+        self.assertLess(time.time() - time_start, 0.5)
+        self.assertEqual(sorted([str(x) for x in results]), sorted([str((1, ['scan'])), str((1, []))]))
+        self.assertEqual(self.registry.num_waiters(), 1)
+
+        self.registry.shutdown()
+        threads[2].join()
+        self.assertEqual(results[-1], (2, []))
+
+    def test_redis(self):
+        client = redis.StrictRedis(host=os.environ.get('REDIS_HOST', '127.0.0.1'),
+                                   port=int(os.environ.get('REDIS_PORT', 6379)))
+        try:
+            client.ping()
+        except redis.exceptions.ConnectionError:
+            self.skipTest('Redis not available')
+
+        channel = 'keychest:agent-commands-test-%s' % os.getpid()
+        listener = threading.Thread(target=self.registry.listen_redis, args=(client, channel))
+        listener.daemon = True
+        listener.start()
+
+        time_start = time.time()
+        while client.pubsub_numsub(channel)[0][1] == 0 and time.time() - time_start < 5:
+            time.sleep(0.01)
+
+        self.assertEqual(publish_agent_command(client, 7, {'cmd': 'rescan'}, channel=channel), 1)
+        self.assertEqual(self.registry.wait(7, timeout=5), [{'cmd': 'rescan'}])
+
+    @unittest.skipUnless(os.environ.get('AGENT_BENCH_STRICT'), 'CPU usage bench, depends on the machine load')
+    def test_bench_idle_waiters(self):
+        num_waiters = 500
+        results = []
+        threads = [self._wait_async(x, 30, results) for x in range(num_waiters)]
+        self._wait_waiters(num_waiters)
+
+        cpu_start = cpu_time()
+        time.sleep(2)
+        cpu_idle = cpu_time() - cpu_start
+
+        for idx in range(num_waiters):
+            self.registry.push(idx, idx)
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(results), [(x, [x]) for x in range(num_waiters)])
+        self.assertLess(cpu_idle, 0.05)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    unittest.main()  # pragma: no cover
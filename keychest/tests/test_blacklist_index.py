@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import random
+import time
+import unittest
+
+from ..blacklist_index import BlacklistIndex
+from ..consts import BlacklistRuleType
+from . import MicroMock
+
+
+__author__ = 'dusanklinec'
+
+
+def linear_blacklisted(rules, domain):
+    """
+    Original linear blacklist scan
+    """
+    for rule in rules:
+        if rule.rule_type == BlacklistRuleType.SUFFIX:
+            if domain.endswith(rule.rule):
+                return rule
+        elif rule.rule_type == BlacklistRuleType.MATCH:
+            if domain == rule.rule:
+                return rule
+    return None
+
+
+class BlacklistIndexTest(unittest.TestCase):
+    """Compiled blacklist"""
+
+    def __init__(self, *args, **kwargs):
+        super(BlacklistIndexTest, self).__init__(*args, **kwargs)
+
+    def _rule(self, rule, rule_type=BlacklistRuleType.SUFFIX):
+        return MicroMock(rule=rule, rule_type=rule_type)
+
+    def _gen_rules(self, rnd, num):
+        tlds = ['com', 'net', 'org', 'io', 'cz']
+        rules = []
+        for idx in range(num):
+            name = '%s%d.%s' % (rnd.choice(['cdn', 'app', 'le', 'google', 'fb']), idx, rnd.choice(tlds))
+            rule_type = rnd.choice([BlacklistRuleType.SUFFIX, BlacklistRuleType.SUFFIX, BlacklistRuleType.MATCH])
+            prefix = rnd.choice(['', '', '.', 'www.'])
+            rules.append(self._rule(prefix + name, rule_type))
+        return rules
+
+    def _gen_domains(self, rnd, rules, num):
+        domains = []
+        for _ in range(num):
+            rule = rnd.choice(rules).rule.lstrip('.')
+            domains.append(rnd.choice(['', 'a.', 'x', 'www.', 'sub.www.', 'no%d.' % rnd.randint(0, 100)]) + rule)
+            domains.append('miss%d.example.com' % rnd.randint(0, 1000))
+        return domains
+
+    def test_suffix(self):
+        rules = [self._rule('le.com'), self._rule('.fb.com'), self._rule('fb.com', BlacklistRuleType.MATCH),
+                 self._rule('.google.com')]
+        index = BlacklistIndex(rules)
+
+        self.assertIs(index.find('google.com'), rules[0])
+        self.assertIs(index.find('www.google.com'), rules[0])
+        self.assertIs(index.find('le.com'), rules[0])
+        self.assertIs(index.find('fb.com'), rules[2])
+        self.assertIs(index.find('www.fb.com'), rules[1])
+        self.assertIsNone(index.find('com'))
+        self.assertIsNone(index.find('fb.com.cz'))
+        self.assertIs(index.find('example.com'), rules[0])
+        self.assertIsNone(index.find('example.org'))
+        self.assertIsNone(BlacklistIndex().find('google.com'))
+
+    def test_cidr(self):
+        rules = [self._rule('10.1.2.0/24', BlacklistRuleType.CIDR),
+                 self._rule('10.0.0.0/8', BlacklistRuleType.CIDR),
+                 self._rule('10.1.0.0/16', BlacklistRuleType.CIDR),
+                 self._rule('192.168.1.1', BlacklistRuleType.CIDR),
+                 self._rule('2001:db8::/32', BlacklistRuleType.CIDR),
+                 self._rule('invalid', BlacklistRuleType.CIDR)]
+        index = BlacklistIndex(rules)
+
+        self.assertIs(index.find('10.1.2.3'), rules[0])
+        self.assertIs(index.find('10.1.3.1'), rules[1])
+        self.assertIs(index.find('10.0.0.0'), rules[1])
+        self.assertIs(index.find('10.255.255.255'), rules[1])
+        self.assertIs(index.find('192.168.1.1'), rules[3])
+        self.assertIs(index.find('2001:db8::1'), rules[4])
+        self.assertIsNone(index.find('11.0.0.0'))
+        self.assertIsNone(index.find('192.168.1.2'))
+        self.assertIsNone(index.find('2001:db9::1'))
+        self.assertIsNone(index.find('invalid'))
+
+    def test_equivalence(self):
+        rnd = random.Random(42)
+        rules = self._gen_rules(rnd, 500)
+        index = BlacklistIndex(rules)
+        for domain in self._gen_domains(rnd, rules, 2000):
+            self.assertIs(index.find(domain), linear_blacklisted(rules, domain), domain)
+
+    def test_bench(self):
+        rnd = random.Random(1)
+        rules = self._gen_rules(rnd, 5000)
+        domains = self._gen_domains(rnd, rules, 1000)
+
+        index = BlacklistIndex(rules)
+
+        time_start = time.time()
+        res_index = [index.find(x) for x in domains]
+        time_index = time.time() - time_start
+
+        time_start = time.time()
+        res_linear = [linear_blacklisted(rules, x) for x in domains]
+        time_linear = time.time() - time_start
+
+        self.assertEqual(res_index, res_linear)
+
+        # timing depends on the machine load, checked only on request
+        if os.environ.get('BLACKLIST_BENCH_STRICT'):
+            self.assertLess(time_index, time_linear)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    unittest.main()  # pragma: no cover
@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import unittest
+import pkg_resources
+
+from ..cert_cache import CertParseCache
+from ..cert_path_validator import PathValidator
+from ..certificate_manager import CertificateManager
+from ..dbutil import Certificate
+from ..tls_record_parser import TlsRecordParser
+
+
+__author__ = 'dusanklinec'
+
+
+class CertCacheTest(unittest.TestCase):
+    """Parsed certificate cache tests"""
+
+    def __init__(self, *args, **kwargs):
+        super(CertCacheTest, self).__init__(*args, **kwargs)
+
+    def setUp(self):
+        self.chains = []
+        for name in ['enigmabridge.com.resp.bin', 'keychest.net.resp.bin']:
+            parser = TlsRecordParser()
+            parser.feed(self._get_res(name))
+            self.chains.append(parser.certificates)
+
+    def _get_res(self, name):
+        resource_package = __name__
+        resource_path = '/'.join(('data', name))
+        return pkg_resources.resource_string(resource_package, resource_path)
+
+    def _fields(self, cert_db):
+        return dict([(x, getattr(cert_db, x)) for x in
+                     ['cname', 'fprint_sha1', 'fprint_sha256', 'valid_from', 'issuer', 'is_ca', 'key_type',
+                      'alt_names', 'alt_names_cnt', 'alt_names_arr', 'is_cloudflare', 'authority_key_info']])
+
+    def test_cached_fields(self):
+        cert_manager = CertificateManager()
+        for chain in self.chains:
+            for der in chain:
+                cert_db1, cert_db2 = Certificate(), Certificate()
+                cert1 = cert_manager.parse_certificate(cert_db1, der=der)
+                cert2 = cert_manager.parse_certificate(cert_db2, der=der)
+                self.assertIs(cert1, cert2)
+                self.assertEqual(self._fields(cert_db1), self._fields(cert_db2))
+                self.assertIsNot(cert_db1.alt_names_arr, cert_db2.alt_names_arr)
+                self.assertIsNotNone(cert_db1.fprint_sha1)
+
+        num_certs = sum([len(x) for x in self.chains])
+        self.assertEqual(cert_manager.cert_cache.misses, num_certs)
+        self.assertEqual(cert_manager.cert_cache.hits, num_certs)
+
+    def test_pem(self):
+        cache = CertParseCache()
+        pem = self._get_res('cert01.pem')
+        parsed = cache.get_pem(pem)
+        self.assertIs(cache.get(parsed.der), parsed)
+        self.assertEqual(cache.hits, 1)
+        self.assertIsNotNone(parsed.ossl)
+
+    def test_bounded(self):
+        cache = CertParseCache(size=2)
+        for chain in self.chains:
+            for der in chain:
+                cache.get(der)
+        self.assertEqual(len(cache.cache), 2)
+        self.assertEqual(cache.hits, 0)
+
+    def test_bench(self):
+        """
+        Replays handshake chains as a periodic scan would - DB fields and path validation parsing
+        :return:
+        """
+        num_scans = 200
+        corpus = [self.chains[x % len(self.chains)] for x in range(num_scans)]
+
+        def replay(shared_cache):
+            cert_manager = CertificateManager()
+            validator = PathValidator()
+            time_start = time.time()
+            for chain in corpus:
+                cache = shared_cache if shared_cache is not None else CertParseCache()
+                cert_manager.cert_cache = validator.cert_cache = cache
+                validator._load_chain(chain, is_der=True)
+                for der in chain:
+                    cert_manager.parse_certificate(Certificate(), der=der)
+            return time.time() - time_start
+
+        time_nocache = replay(None)
+        cache = CertParseCache()
+        time_cache = replay(cache)
+
+        self.assertGreater(cache.hit_ratio(), 0.9)
+
+        # timing depends on the machine load, checked only on request
+        if os.environ.get('CERT_CACHE_BENCH_STRICT'):
+            self.assertLess(time_cache, time_nocache)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    unittest.main()  # pragma: no cover
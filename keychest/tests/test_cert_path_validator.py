@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import datetime
+import unittest
+
+from cryptography import x509
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import hashes, serialization
+from cryptography.hazmat.primitives.asymmetric import ec
+from cryptography.x509.oid import NameOID
+from OpenSSL.crypto import load_certificate, FILETYPE_ASN1
+
+from ..cert_path_validator import PathValidator
+
+
+__author__ = 'dusanklinec'
+
+
+class PathValidatorTest(unittest.TestCase):
+    """Path validation with cached intermediate verdicts"""
+
+    def __init__(self, *args, **kwargs):
+        super(PathValidatorTest, self).__init__(*args, **kwargs)
+
+    def setUp(self):
+        self.root, self.root_key = self._gen_cert(u'Test Root', None, None, ca=True)
+        self.interm, self.interm_key = self._gen_cert(u'Test Intermediate', self.root, self.root_key, ca=True)
+
+        self.validator = PathValidator()
+        root_ossl = load_certificate(FILETYPE_ASN1, self.root)
+        self.validator.root_store.add_cert(root_ossl)
+        self.validator.root_certs.append(root_ossl)
+        self.validator.root_fprints.add(self.validator.cert_cache.get(self.root).fprint_sha256)
+
+    def _gen_cert(self, cname, issuer, issuer_key, ca=False):
+        """
+        Generates a DER certificate signed by the issuer, self-signed if issuer is None
+        :return: (der, private key)
+        """
+        key = ec.generate_private_key(ec.SECP256R1(), default_backend())
+        subject = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, cname)])
+        issuer_name = subject if issuer is None else x509.load_der_x509_certificate(issuer, default_backend()).subject
+        now = datetime.datetime.utcnow()
+
+        builder = x509.CertificateBuilder() \
+            .subject_name(subject) \
+            .issuer_name(issuer_name) \
+            .public_key(key.public_key()) \
+            .serial_number(x509.random_serial_number()) \
+            .not_valid_before(now - datetime.timedelta(days=1)) \
+            .not_valid_after(now + datetime.timedelta(days=30)) \
+            .add_extension(x509.BasicConstraints(ca=ca, path_length=None), critical=True)
+
+        if not ca:
+            builder = builder.add_extension(x509.SubjectAlternativeName([x509.DNSName(cname)]), critical=False)
+
+        cert = builder.sign(issuer_key if issuer_key is not None else key, hashes.SHA256(), default_backend())
+        return cert.public_bytes(serialization.Encoding.DER), key
+
+    def _leaf(self, cname):
+        return self._gen_cert(cname, self.interm, self.interm_key)[0]
+
+    def test_cached_intermediate(self):
+        res = self.validator.validate([self._leaf(u'a.keychest.net'), self.interm], is_der=True)
+        self.assertTrue(res.valid)
+        self.assertEqual(res.ca_validation.certs_valid, 1)
+        self.assertEqual(self.validator.num_verifications, 2)
+
+        # intermediate seen before - single leaf verification
+        res = self.validator.validate([self.interm, self._leaf(u'b.keychest.net')], is_der=True)
+        self.assertTrue(res.valid)
+        self.assertEqual(res.ca_validation.certs_valid, 1)
+        self.assertEqual(self.validator.num_verifications, 3)
+        self.assertEqual(self.validator.num_verdict_hits, 1)
+
+    def test_verdict_expiry(self):
+        self.validator.validate([self._leaf(u'a.keychest.net'), self.interm], is_der=True)
+        self.validator.verdict_ttl = 0
+        res = self.validator.validate([self._leaf(u'b.keychest.net'), self.interm], is_der=True)
+        self.assertTrue(res.valid)
+        self.assertEqual(self.validator.num_verifications, 4)
+        self.assertEqual(self.validator.num_verdict_hits, 0)
+
+    def test_untrusted(self):
+        other_root, other_key = self._gen_cert(u'Other Root', None, None, ca=True)
+        other_interm, other_interm_key = self._gen_cert(u'Test Intermediate', other_root, other_key, ca=True)
+        leaf = self._gen_cert(u'a.keychest.net', other_interm, other_interm_key)[0]
+
+        # valid chain first, verdict for the trusted intermediate is cached
+        self.assertTrue(self.validator.validate([self._leaf(u'b.keychest.net'), self.interm], is_der=True).valid)
+
+        res = self.validator.validate([leaf, other_interm], is_der=True)
+        self.assertFalse(res.valid)
+        self.assertEqual(res.ca_validation.certs_valid, 0)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    unittest.main()  # pragma: no cover
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import unittest
+import pkg_resources
+
+import sqlalchemy as salch
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.schema import CreateTable
+
+from ..certificate_manager import CertificateManager
+from ..database_manager import DatabaseManager
+from ..dbutil import Certificate, CertificateAltName, DbBaseDomain, DbDomainName
+from ..tls_record_parser import TlsRecordParser
+
+
+__author__ = 'dusanklinec'
+
+
+class CertificateManagerTest(unittest.TestCase):
+    """Bulk certificate ingest tests"""
+
+    def __init__(self, *args, **kwargs):
+        super(CertificateManagerTest, self).__init__(*args, **kwargs)
+
+    def setUp(self):
+        self.engine = salch.create_engine('sqlite://')
+        for model in [Certificate, CertificateAltName, DbBaseDomain, DbDomainName]:
+            # sqlite does not autoincrement BigInteger primary keys
+            ddl = str(CreateTable(model.__table__).compile(self.engine))
+            self.engine.execute(ddl.replace('id BIGINT NOT NULL', 'id INTEGER NOT NULL'))
+
+        self.session_maker = sessionmaker(bind=self.engine)
+        self.cert_manager = CertificateManager()
+        self.cert_manager.init(db_manager=DatabaseManager())
+
+        self.statements = []
+        salch.event.listen(self.engine, 'before_cursor_execute',
+                           lambda *args, **kwargs: self.statements.append(args[2]))
+
+        parser = TlsRecordParser()
+        parser.feed(self._get_res('keychest.net.resp.bin'))
+        self.chain = parser.certificates
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def _get_res(self, name):
+        resource_package = __name__
+        resource_path = '/'.join(('data', name))
+        return pkg_resources.resource_string(resource_package, resource_path)
+
+    def _parsed(self, der):
+        cert_db = Certificate()
+        self.cert_manager.parse_certificate(cert_db, der=der)
+        cert_db.source = 'test'
+        return cert_db
+
+    def test_full_chain(self):
+        s = self.session_maker()
+        all_certs, existing, leaf_id, num_new = self.cert_manager.process_full_chain(s, self.chain, is_der=True)
+        s.commit()
+        self.assertEqual(num_new, len(self.chain))
+        self.assertEqual(len(all_certs), len(self.chain))
+        self.assertEqual(len(existing), 0)
+        self.assertEqual(leaf_id, all_certs[0].id)
+        self.assertEqual(all_certs[1].id, all_certs[0].parent_id)
+
+        # certificates, alt names, domains - constant number of statements
+        self.assertLessEqual(len([x for x in self.statements if x.startswith('INSERT')]), 4)
+
+        leaf = all_certs[0]
+        alts = s.query(CertificateAltName).filter(CertificateAltName.cert_id == leaf.id).all()
+        self.assertEqual(sorted([x.alt_name for x in alts]), sorted(set(leaf.alt_names_arr)))
+
+        domains = s.query(DbDomainName).all()
+        self.assertTrue(len(domains) > 0)
+        self.assertTrue(all([x.top_domain_id is not None for x in domains]))
+
+        all_certs, existing, leaf_id, num_new = self.cert_manager.process_full_chain(s, self.chain, is_der=True)
+        self.assertEqual(num_new, 0)
+        self.assertEqual(len(existing), len(self.chain))
+        s.close()
+
+    def test_dedup(self):
+        s = self.session_maker()
+        certs = [self._parsed(der) for der in self.chain + self.chain]
+        stored = self.cert_manager.add_certs_bulk(s, certs)
+        self.assertEqual(len(stored), len(self.chain))
+        self.assertTrue(all([x.trans_is_new for x in stored.values()]))
+        self.assertEqual(s.query(Certificate).count(), len(self.chain))
+
+        # existing ones are loaded, inserts are skipped
+        stored2 = self.cert_manager.add_certs_bulk(s, [self._parsed(der) for der in self.chain])
+        self.assertEqual(sorted([x.id for x in stored2.values()]), sorted([x.id for x in stored.values()]))
+        self.assertFalse(any([x.trans_is_new for x in stored2.values()]))
+        s.close()
+
+    def _insert_concurrent(self, der):
+        s = self.session_maker()
+        self.cert_manager.add_cert_or_fetch(s, self._parsed(der), fetch_first=True, add_alts=False)
+        s.commit()
+        s.close()
+
+    def test_concurrent_insert(self):
+        # certificate inserted by another worker after the fetch, skipped by INSERT IGNORE
+        self._insert_concurrent(self.chain[0])
+        self.cert_manager.BULK_SIZE = 1
+
+        s = self.session_maker()
+        stored = self.cert_manager.add_certs_bulk(s, [self._parsed(der) for der in self.chain], fetch_first=False)
+        self.assertEqual(len(stored), len(self.chain))
+        fprint = self._parsed(self.chain[0]).fprint_sha1.lower()
+        self.assertEqual(stored[fprint].trans_is_new, 0)
+        self.assertEqual(sorted([x.trans_is_new for x in stored.values()]), [0] + [1] * (len(self.chain) - 1))
+        self.assertEqual(s.query(Certificate).count(), len(self.chain))
+        s.close()
+
+    def test_concurrent_insert_chunk(self):
+        # partially inserted chunk, inserted rows are not distinguishable - reported as existing
+        self._insert_concurrent(self.chain[0])
+
+        s = self.session_maker()
+        stored = self.cert_manager.add_certs_bulk(s, [self._parsed(der) for der in self.chain], fetch_first=False)
+        self.assertEqual(len(stored), len(self.chain))
+        self.assertFalse(any([x.trans_is_new for x in stored.values()]))
+        s.close()
+
+
+if __name__ == "__main__":  # pragma: no cover
+    unittest.main()  # pragma: no cover
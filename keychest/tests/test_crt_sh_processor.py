@@ -0,0 +1,258 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import datetime
+import gzip
+import io
+import json
+import os
+import threading
+import time
+import unittest
+
+import pkg_resources
+from lxml import html
+from six.moves import BaseHTTPServer, socketserver
+from six.moves.urllib.parse import urlparse, parse_qs
+
+from .. import util
+from ..crt_sh_processor import CrtProcessor, RateLimiter, CrtShIndexParser, CrtShIndexResponse
+
+
+__author__ = 'dusanklinec'
+
+
+class CrtShHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves fake certificate downloads"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        params = parse_qs(urlparse(self.path).query)
+        self.server.connections.add(self.client_address)
+        if 'q' in params:
+            return self.do_index(params)
+
+        crt_id = params['d'][0]
+        time.sleep(self.server.delay)
+
+        code = 404 if crt_id == '0' else 200
+        body = ('-----BEGIN CERTIFICATE-----\n%s\n-----END CERTIFICATE-----' % crt_id).encode('ascii')
+        self.send_response(code)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_index(self, params):
+        is_json = params.get('output') == ['json']
+        body = self.server.index_json if is_json else self.server.index_page
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json' if is_json else 'text/html; charset=UTF-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class CrtShServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, delay=0.05):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), CrtShHandler)
+        self.delay = delay
+        self.connections = set()
+        self.index_page = b''
+        self.index_json = b'[]'
+
+
+class CrtProcessorTest(unittest.TestCase):
+    """crt.sh downloads"""
+
+    def __init__(self, *args, **kwargs):
+        super(CrtProcessorTest, self).__init__(*args, **kwargs)
+
+    def setUp(self):
+        self.server = CrtShServer()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+        self.proc = CrtProcessor(timeout=3, attempts=1, download_workers=4)
+        self.proc.BASE_URL = 'http://127.0.0.1:%s/' % self.server.server_address[1]
+        self.proc.rate_limiter = RateLimiter()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_parallel_download(self):
+        crt_ids = list(range(1, 17))
+        time_start = time.time()
+        res = dict(self.proc.download_crts(crt_ids))
+        elapsed = time.time() - time_start
+
+        self.assertEqual(sorted(res.keys()), crt_ids)
+        self.assertTrue(all([x.success for x in res.values()]))
+        self.assertTrue(str(res[5].result).startswith('-----BEGIN CERTIFICATE-----'))
+        self.assertLess(elapsed, len(crt_ids) * self.server.delay)
+
+        # keep-alive, connections reused by the workers
+        self.assertLessEqual(len(self.server.connections), 4)
+        num_requests, num_connections, num_reused = self.proc.http_pool.stats()
+        self.assertEqual(num_requests, len(crt_ids))
+        self.assertEqual(num_connections, len(self.server.connections))
+        self.assertEqual(num_reused, num_requests - num_connections)
+
+    def test_pool_disabled(self):
+        self.proc.http_pool.enabled = False
+        res = dict(self.proc.download_crts(list(range(1, 9)), workers=2))
+        self.assertTrue(all([x.success for x in res.values()]))
+        self.assertEqual(len(self.server.connections), 8)
+        self.assertEqual(self.proc.http_pool.stats(), (0, 0, 0))
+        self.assertEqual(self.proc.http_pool.num_requests, 8)
+
+    def test_failed_download(self):
+        res = dict(self.proc.download_crts([0, 1]))
+        self.assertFalse(res[0].success)
+        self.assertTrue(res[1].success)
+
+    def test_rate_limit(self):
+        limiter = RateLimiter(rate=50, burst=1)
+        time_start = time.time()
+        for _ in range(11):
+            limiter.acquire()
+        self.assertGreaterEqual(time.time() - time_start, 0.18)
+
+        self.proc.rate_limiter = RateLimiter(rate=40, burst=1)
+        time_start = time.time()
+        res = dict(self.proc.download_crts(list(range(1, 9))))
+        self.assertEqual(len(res), 8)
+        self.assertGreaterEqual(time.time() - time_start, 7 / 40.0)
+
+
+class CrtShIndexParserTest(unittest.TestCase):
+    """crt.sh index page parsing"""
+
+    def __init__(self, *args, **kwargs):
+        super(CrtShIndexParserTest, self).__init__(*args, **kwargs)
+
+    def _get_res(self, name):
+        resource_package = __name__
+        resource_path = '/'.join(('data', name))
+        return pkg_resources.resource_string(resource_package, resource_path)
+
+    def _get_index_page(self):
+        with gzip.GzipFile(fileobj=io.BytesIO(self._get_res('crtsh_index.html.gz'))) as fh:
+            return fh.read()
+
+    def _parse_dom(self, data):
+        """Former DOM + XPath parser, reference"""
+        ret = []
+        res_table = html.fromstring(data).xpath('//table//table')[0]
+        for row in res_table[1:]:
+            rec = [util.strip(row[0].text_content())]
+            rec += [util.unix_time(datetime.datetime.strptime(util.strip(row[x].text_content()), '%Y-%m-%d'))
+                    for x in (1, 2)]
+            rec += [util.strip(row[3].text_content()) if len(row) >= 5 else None]
+            ca_col = row[4] if len(row) >= 5 else row[3]
+            rec += [util.strip(ca_col.text_content()), int(ca_col[0].attrib['href'].rsplit('=', 1)[1])]
+            ret.append(tuple(rec))
+        return ret
+
+    def _rec_tuples(self, recs):
+        return [(x.id, x.logged_at, x.not_before, x.identity, x.ca_dn, x.ca_id) for x in recs]
+
+    def test_dom_equivalence(self):
+        data = self._get_index_page()
+        expected = self._parse_dom(data)
+        self.assertEqual(len(expected), 20000)
+
+        chunks = [data[i:i + 4096] for i in range(0, len(data), 4096)]
+        parser = CrtShIndexParser(encoding='utf-8')
+        self.assertEqual(self._rec_tuples(parser.parse(chunks)), expected)
+        self.assertLess(len(parser.days), 1000)
+
+        ret = CrtProcessor().parse_index_page(CrtShIndexResponse(), data)
+        self.assertEqual(self._rec_tuples(ret.results), expected)
+
+    def test_small_page(self):
+        data = '<html><body><table><tr><td><table>' \
+               '<tr><th>crt.sh ID</th><th>Logged At</th><th>Not Before</th><th>Issuer Name</th></tr>' \
+               '<tr><td><a href="?id=12">12</a></td><td>2017-08-01</td><td>2017-07-31</td>' \
+               '<td><a href="?caid=16418">C=US, O=Let&#39;s Encrypt</a></td></tr>' \
+               '</table></td></tr></table><table><tr><td><table><tr><th>x</th></tr><tr><td>1</td></tr>' \
+               '</table></td></tr></table></body></html>'
+        recs = list(CrtShIndexParser().parse([data]))
+        self.assertEqual(len(recs), 1)
+        self.assertEqual(recs[0].id, '12')
+        self.assertEqual(recs[0].logged_at, 1501545600)
+        self.assertEqual(recs[0].not_before, 1501545600 - 86400)
+        self.assertIsNone(recs[0].identity)
+        self.assertEqual(recs[0].ca_dn, "C=US, O=Let's Encrypt")
+        self.assertEqual(recs[0].ca_id, 16418)
+
+        self.assertEqual(list(CrtShIndexParser().parse(['<html><body>No results</body></html>'])), [])
+
+    def test_json(self):
+        data = json.dumps([
+            {'issuer_ca_id': 16418, 'issuer_name': "C=US, O=Let's Encrypt", 'name_value': 'keychest.net',
+             'min_cert_id': 12, 'min_entry_timestamp': '2017-08-01T10:20:30.123', 'not_before': '2017-07-31T09:00:00'},
+            {'issuer_ca_id': 16418, 'issuer_name': "C=US, O=Let's Encrypt", 'name_value': 'www.keychest.net',
+             'min_cert_id': 12, 'min_entry_timestamp': '2017-08-01T10:20:30.123', 'not_before': '2017-07-31T09:00:00'},
+            {'issuer_ca_id': 1449, 'issuer_name': 'CN=COMODO', 'name_value': 'keychest.net', 'id': 13,
+             'entry_timestamp': '2017-08-02T10:20:30.123', 'not_before': '2017-08-02T09:00:00'},
+        ])
+        ret = CrtProcessor().parse_index_json(CrtShIndexResponse(), data)
+        self.assertEqual(self._rec_tuples(ret.results),
+                         [('12', 1501545600, 1501459200, 'keychest.net', "C=US, O=Let's Encrypt", 16418),
+                          ('13', 1501632000, 1501632000, 'keychest.net', 'CN=COMODO', 1449)])
+
+    def test_query(self):
+        server = CrtShServer()
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        try:
+            server.index_page = self._get_index_page()
+            server.index_json = json.dumps([{'id': 5, 'issuer_ca_id': 1, 'issuer_name': 'CN=CA', 'name_value': 'a.b',
+                                             'entry_timestamp': '2017-08-01T10:20:30', 'not_before': '2017-08-01'}])\
+                .encode('utf8')
+
+            proc = CrtProcessor(timeout=10, attempts=1)
+            proc.BASE_URL = 'http://127.0.0.1:%s/' % server.server_address[1]
+            proc.rate_limiter = RateLimiter()
+
+            ret = proc.query('%.example.com')
+            self.assertTrue(ret.success)
+            self.assertEqual(len(ret.results), 20000)
+            self.assertEqual(ret.results[0].ca_id, 16418)
+
+            ret = proc.query('a.b', output_json=True)
+            self.assertTrue(ret.success)
+            self.assertEqual(self._rec_tuples(ret.results), [('5', 1501545600, 1501545600, 'a.b', 'CN=CA', 1)])
+
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_bench(self):
+        data = self._get_index_page()
+        time_start = time.time()
+        expected = self._parse_dom(data)
+        time_dom = time.time() - time_start
+
+        time_start = time.time()
+        recs = list(CrtShIndexParser().parse([data[i:i + 65536] for i in range(0, len(data), 65536)]))
+        time_stream = time.time() - time_start
+
+        print('Index page with %s rows: DOM + XPath %.4f s, streaming %.4f s' % (len(recs), time_dom, time_stream))
+        self.assertEqual(self._rec_tuples(recs), expected)
+
+        # timing depends on the machine load, checked only on request
+        if os.environ.get('CRTSH_BENCH_STRICT'):
+            self.assertLess(time_stream, time_dom)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    unittest.main()  # pragma: no cover
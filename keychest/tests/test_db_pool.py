@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+import sqlalchemy as salch
+from sqlalchemy import exc as sa_exc
+from sqlalchemy.orm import sessionmaker
+
+from ..dbutil import DbHelper, DbBaseDomain
+from ..db_pool import InstrumentedQueuePool, DbPoolQuotas, set_subsystem, get_subsystem, DEFAULT_SUBSYSTEM
+
+
+__author__ = 'dusanklinec'
+
+
+class DbPoolTest(unittest.TestCase):
+    """Instrumented pool with subsystem quotas"""
+
+    def __init__(self, *args, **kwargs):
+        super(DbPoolTest, self).__init__(*args, **kwargs)
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.engine = salch.create_engine('sqlite:///%s' % os.path.join(self.tmpdir, 'test.db'),
+                                          poolclass=InstrumentedQueuePool, pool_size=2, max_overflow=1,
+                                          pool_timeout=0.2)
+        self.pool = self.engine.pool
+        self.pool.quotas = DbPoolQuotas({'limited': 1})
+
+    def tearDown(self):
+        set_subsystem(None)
+        self.engine.dispose()
+        shutil.rmtree(self.tmpdir)
+
+    def test_subsystem(self):
+        set_subsystem(None)
+        self.assertEqual(get_subsystem(), DEFAULT_SUBSYSTEM)
+        set_subsystem('limited')
+        self.assertEqual(get_subsystem(), 'limited')
+
+    def test_quota(self):
+        set_subsystem('limited')
+        conn = self.engine.connect()
+        self.assertEqual(self.pool.quotas.usage()['limited'], 1)
+
+        with self.assertRaises(sa_exc.TimeoutError):
+            self.engine.connect()
+        self.assertEqual(self.pool.metrics.num_quota_timeouts, 1)
+
+        # other subsystems are not affected
+        set_subsystem('other')
+        conn2 = self.engine.connect()
+        conn2.close()
+
+        conn.close()
+        self.assertEqual(self.pool.quotas.usage()['limited'], 0)
+
+        set_subsystem('limited')
+        self.engine.connect().close()
+        self.assertEqual(self.pool.metrics.num_checkouts, 3)
+
+    def test_overflow_and_timeout(self):
+        conns = [self.engine.connect() for _ in range(3)]
+        self.assertEqual(self.pool.metrics.num_overflows, 1)
+        self.assertEqual(self.pool.quotas.usage()[DEFAULT_SUBSYSTEM], 3)
+
+        with self.assertRaises(sa_exc.TimeoutError):
+            self.engine.connect()
+        self.assertEqual(self.pool.metrics.num_timeouts, 1)
+
+        for conn in conns:
+            conn.close()
+        self.assertEqual(self.pool.quotas.usage()[DEFAULT_SUBSYSTEM], 0)
+        self.assertEqual(self.pool.checkedout(), 0)
+        self.assertTrue('in_use=0' in self.pool.state())
+
+    def test_long_held(self):
+        self.pool.metrics.held_warn_time = 0.05
+        conn = self.engine.connect()
+        time.sleep(0.1)
+        held = self.pool.metrics.long_held()
+        self.assertEqual(len(held), 1)
+        self.assertEqual(held[0][0], DEFAULT_SUBSYSTEM)
+
+        conn.close()
+        self.assertEqual(self.pool.metrics.num_long_held, 1)
+        self.assertEqual(len(self.pool.metrics.long_held()), 0)
+
+    def test_release_session(self):
+        DbBaseDomain.__table__.create(self.engine)
+        s = sessionmaker(bind=self.engine)()
+        s.add(DbBaseDomain(id=1, domain_name='keychest.net'))
+        s.commit()
+
+        domain = s.query(DbBaseDomain).first()
+        self.assertEqual(self.pool.checkedout(), 1)
+
+        DbHelper.release_session(s, detach=True)
+        self.assertEqual(self.pool.checkedout(), 0)
+        self.assertEqual(domain.domain_name, 'keychest.net')  # loaded state kept
+
+        domain.domain_name = 'keychest.io'
+        s.merge(domain)
+        s.commit()
+        self.assertEqual(s.query(DbBaseDomain).first().domain_name, 'keychest.io')
+        s.close()
+        self.assertEqual(self.pool.checkedout(), 0)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    unittest.main()  # pragma: no cover
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from keychest.db_write_sink import DbWriteSink
+from keychest.dbutil import DbScanHistory, DbLastScanCache
+import sqlalchemy as salch
+import sqlalchemy.exc as sa_exc
+from sqlalchemy.dialects import mysql
+from sqlalchemy.orm import sessionmaker
+import unittest
+from . import MicroMock
+
+
+__author__ = 'dusanklinec'
+
+
+class DbWriteSinkTest(unittest.TestCase):
+    """DB write-behind sink tests"""
+
+    def __init__(self, *args, **kwargs):
+        super(DbWriteSinkTest, self).__init__(*args, **kwargs)
+
+    def setUp(self):
+        self.engine = salch.create_engine('sqlite://')
+        # sqlite does not autoincrement BigInteger primary keys
+        self.engine.execute('CREATE TABLE scan_history (id INTEGER PRIMARY KEY AUTOINCREMENT, '
+                            'watch_id INTEGER, scan_code SMALLINT NOT NULL, scan_type SMALLINT, '
+                            'created_at DATETIME)')
+        self.session_maker = sessionmaker(bind=self.engine)
+
+        self.down = False
+        self.sink = DbWriteSink(batch_size=4)
+        self.sink.init(db=MicroMock(get_session=self.session_maker))
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def _cache(self, scan_id, aux_key='1.2.3.4'):
+        cache = DbLastScanCache()
+        cache.cache_type = 0
+        cache.obj_id = 1
+        cache.scan_type = 2
+        cache.scan_sub_type = 0
+        cache.aux_key = aux_key
+        cache.scan_id = scan_id
+        return cache
+
+    def test_history_flush(self):
+        for idx in range(10):
+            self.sink.add_history(idx, scan_type=1)
+
+        self.assertEqual(self.sink.backlog(), 10)
+        self.assertTrue(self.sink.flush_event.is_set())
+        self.assertEqual(self.sink.flush(), 10)
+        self.assertEqual(self.sink.backlog(), 0)
+        self.assertEqual(self.sink.stats.num_rows, 10)
+        self.assertEqual(self.sink.stats.num_flushes, 1)
+
+        s = self.session_maker()
+        self.assertEqual(s.query(DbScanHistory).count(), 10)
+        self.assertEqual(sorted([x.watch_id for x in s.query(DbScanHistory).all()]), list(range(10)))
+        s.close()
+
+    def test_cache_coalesce(self):
+        self.sink.add_cache(self._cache(1))
+        self.sink.add_cache(self._cache(2))
+        self.sink.add_cache(self._cache(3, aux_key='1.2.3.5'))
+        self.assertEqual(self.sink.backlog(), 2)
+
+        rows = sorted(self.sink.caches.values(), key=lambda x: x['aux_key'])
+        self.assertEqual([x['scan_id'] for x in rows], [2, 3])
+
+    def _get_session(self):
+        if self.down:
+            raise sa_exc.OperationalError('SELECT 1', {}, Exception('Lost connection to MySQL server'))
+        return self.session_maker()
+
+    def test_outage_requeue(self):
+        self.down = True
+        self.sink.init(db=MicroMock(get_session=self._get_session))
+        for idx in range(6):
+            self.sink.add_history(idx, scan_type=1)
+
+        self.assertEqual(self.sink.flush(), 0)
+        self.assertEqual(self.sink.backlog(), 6)
+        self.assertEqual(self.sink.stats.num_failed_rows, 0)
+        self.assertEqual(self.sink.stats.num_retries, 1)
+        self.assertEqual(self.sink.retry_backoff, DbWriteSink.RETRY_BACKOFF_MIN)
+
+        # backoff postpones the next attempt, repeated failure doubles it
+        self.assertEqual(self.sink.flush(), 0)
+        self.assertEqual(self.sink.stats.num_retries, 1)
+        self.assertEqual(self.sink.flush(force=True), 0)
+        self.assertEqual(self.sink.retry_backoff, 2 * DbWriteSink.RETRY_BACKOFF_MIN)
+
+        self.down = False
+        self.sink.retry_at = 0
+        self.assertEqual(self.sink.flush(), 6)
+        self.assertEqual(self.sink.backlog(), 0)
+        self.assertEqual(self.sink.retry_backoff, 0)
+
+        s = self.session_maker()
+        self.assertEqual(sorted([x.watch_id for x in s.query(DbScanHistory).all()]), list(range(6)))
+        s.close()
+
+    def test_outage_cache_requeue(self):
+        self.down = True
+        self.sink.init(db=MicroMock(get_session=self._get_session))
+        self.sink.add_cache(self._cache(1))
+        self.sink.add_cache(self._cache(1, aux_key='1.2.3.5'))
+        self.assertEqual(self.sink.flush(), 0)
+
+        # update enqueued during the outage wins over the requeued one
+        self.sink.add_cache(self._cache(2))
+        self.assertEqual(self.sink.flush(force=True), 0)
+        self.assertEqual(self.sink.backlog(), 2)
+        rows = sorted(self.sink.caches.values(), key=lambda x: x['aux_key'])
+        self.assertEqual([x['scan_id'] for x in rows], [2, 1])
+
+    def test_integrity_drop(self):
+        self.sink.add_history(1, scan_type=1)
+        self.sink.add_history(2, scan_type=1, scan_code=None)
+        self.sink.add_history(3, scan_type=1)
+
+        self.assertEqual(self.sink.flush(), 2)
+        self.assertEqual(self.sink.backlog(), 0)
+        self.assertEqual(self.sink.stats.num_failed_rows, 1)
+        self.assertEqual(self.sink.retry_backoff, 0)
+
+        s = self.session_maker()
+        self.assertEqual(sorted([x.watch_id for x in s.query(DbScanHistory).all()]), [1, 3])
+        s.close()
+
+    def test_cache_upsert(self):
+        executed = []
+        session = MicroMock(execute=executed.append, commit=lambda: None, close=lambda: None)
+        self.sink.init(db=MicroMock(get_session=lambda: session))
+
+        self.sink.add_cache(self._cache(1))
+        self.sink.add_cache(self._cache(2))
+        self.sink.add_cache(self._cache(3, aux_key='1.2.3.5'))
+        self.assertEqual(self.sink.flush(), 2)
+        self.assertEqual(len(executed), 1)
+
+        compiled = executed[0].compile(dialect=mysql.dialect())
+        sql = ' '.join(str(compiled).split())
+        self.assertIn('INSERT INTO last_scan_cache', sql)
+        self.assertIn('ON DUPLICATE KEY UPDATE scan_id = VALUES(scan_id), scan_aux = VALUES(scan_aux), '
+                      'updated_at = VALUES(updated_at)', sql)
+        self.assertNotIn('created_at = VALUES', sql)
+
+        scan_ids = [v for k, v in compiled.params.items() if k.startswith('scan_id')]
+        self.assertEqual(sorted(scan_ids), [2, 3])
+
+    def test_empty_flush(self):
+        self.assertEqual(self.sink.flush(), 0)
+        self.assertEqual(self.sink.stats.num_flushes, 0)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    unittest.main()  # pragma: no cover
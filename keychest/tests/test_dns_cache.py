@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import socket
+import threading
+import time
+import unittest
+
+import dns.message
+import dns.rcode
+import dns.rdatatype
+import dns.resolver
+import dns.rrset
+from six.moves import socketserver
+
+from ..dns_cache import DnsCache
+
+
+__author__ = 'dusanklinec'
+
+
+class DnsHandler(socketserver.BaseRequestHandler):
+    """Answers from the server zone dict"""
+
+    def handle(self):
+        data, sock = self.request
+        query = dns.message.from_wire(data)
+        question = query.question[0]
+        name = question.name.to_text().lower()
+        rdtype = dns.rdatatype.to_text(question.rdtype)
+        self.server.queries.append((name, rdtype))
+        time.sleep(self.server.delay)
+
+        response = dns.message.make_response(query)
+        records = [x for x in self.server.zone if x[0] == name]
+        if len(records) == 0:
+            response.set_rcode(dns.rcode.NXDOMAIN)
+            response.authority.append(dns.rrset.from_text(
+                'example.com.', 600, 'IN', 'SOA', 'ns.example.com. admin.example.com. 1 7200 900 1209600 120'))
+
+        for rec in [x for x in records if x[1] == rdtype]:
+            response.answer.append(dns.rrset.from_text(rec[0], rec[2], 'IN', rec[1], *rec[3]))
+        sock.sendto(response.to_wire(), self.client_address)
+
+
+class DnsServer(socketserver.ThreadingMixIn, socketserver.UDPServer):
+    daemon_threads = True
+
+    def __init__(self, zone, delay=0.0):
+        socketserver.UDPServer.__init__(self, ('127.0.0.1', 0), DnsHandler)
+        self.zone = zone
+        self.delay = delay
+        self.queries = []
+
+
+class DnsCacheTest(unittest.TestCase):
+    """DNS cache over a local DNS server"""
+
+    def __init__(self, *args, **kwargs):
+        super(DnsCacheTest, self).__init__(*args, **kwargs)
+
+    def setUp(self):
+        self.server = DnsServer([
+            ('www.example.com.', 'A', 300, ['10.0.0.1', '10.0.0.2']),
+            ('www.example.com.', 'AAAA', 60, ['2001:db8::1']),
+            ('shop.example.com.', 'CNAME', 3600, ['shop.cdn.cloudflare.net.']),
+            ('short.example.com.', 'A', 1, ['10.0.0.3']),
+        ] + [('h%d.example.com.' % x, 'A', 300, ['10.1.0.%d' % x]) for x in range(20)])
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.cache = DnsCache(nameservers=['127.0.0.1'], port=self.server.server_address[1], timeout=2, min_ttl=0)
+
+    def tearDown(self):
+        self.cache.shutdown()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_positive(self):
+        addrs = self.cache.resolve_addrs('www.example.com')
+        self.assertEqual(sorted(addrs[:2]), [(socket.AF_INET, '10.0.0.1'), (socket.AF_INET, '10.0.0.2')])
+        self.assertEqual(addrs[2], (socket.AF_INET6, '2001:db8::1'))
+        self.assertEqual(self.cache.resolve_addrs('WWW.example.com'), addrs)
+        self.assertEqual(len(self.server.queries), 2)
+        self.assertEqual(self.cache.hits, 2)
+
+        self.assertEqual(self.cache.cname('shop.example.com'), 'shop.cdn.cloudflare.net')
+        self.assertIsNone(self.cache.cname('www.example.com'))
+        self.assertIsNone(self.cache.cname('www.example.com'))
+        self.assertEqual(len(self.server.queries), 4)
+
+    def test_ttl(self):
+        self.cache.resolve_addrs('short.example.com')
+        self.cache.resolve_addrs('short.example.com')
+        self.assertEqual(self.server.queries.count(('short.example.com.', 'A')), 1)
+
+        time.sleep(1.1)
+        self.cache.resolve_addrs('short.example.com')
+        self.assertEqual(self.server.queries.count(('short.example.com.', 'A')), 2)
+
+        self.cache.min_ttl = 30
+        self.cache.clear()
+        self.cache.resolve_addrs('short.example.com')
+        time.sleep(1.1)
+        self.cache.resolve_addrs('short.example.com')
+        self.assertEqual(self.server.queries.count(('short.example.com.', 'A')), 3)
+
+    def test_negative(self):
+        for _ in range(3):
+            with self.assertRaises(socket.gaierror):
+                self.cache.resolve_addrs('missing.example.com')
+            with self.assertRaises(dns.resolver.NXDOMAIN):
+                self.cache.query('missing.example.com', 'A')
+            self.assertIsNone(self.cache.cname('missing.example.com'))
+
+        self.assertEqual(sorted(self.server.queries), [('missing.example.com.', 'A'), ('missing.example.com.', 'AAAA'),
+                                                       ('missing.example.com.', 'CNAME')])
+        self.assertEqual(self.cache.negative_hits, 9)
+
+        # SOA negative TTL
+        key = ('q', 'missing.example.com', 'A')
+        self.assertAlmostEqual(self.cache.cache[key][0] - time.time(), 120, delta=2)
+
+    def test_concurrent(self):
+        self.server.delay = 0.3
+        time_start = time.time()
+        addrs, cname = self.cache.resolve_host('shop.example.com')
+        self.assertLess(time.time() - time_start, 2 * self.server.delay)
+        self.assertTrue(isinstance(addrs, socket.gaierror))
+        self.assertEqual(cname, 'shop.cdn.cloudflare.net')
+        self.assertEqual(len(self.server.queries), 3)
+
+        addrs, cname = self.cache.resolve_host('www.example.com')
+        self.assertEqual(len(addrs), 3)
+        self.assertIsNone(cname)
+
+    def test_herror(self):
+        calls = []
+
+        def gethostbyaddr(ip):
+            calls.append(ip)
+            raise socket.herror(2 if ip == '10.0.0.2' else 1, 'error')
+
+        orig = socket.gethostbyaddr
+        socket.gethostbyaddr = gethostbyaddr
+        try:
+            for _ in range(2):
+                for ip in ['10.0.0.1', '10.0.0.2']:
+                    with self.assertRaises(socket.herror):
+                        self.cache.gethostbyaddr(ip)
+        finally:
+            socket.gethostbyaddr = orig
+
+        # host not found cached, try again is not
+        self.assertEqual(calls, ['10.0.0.1', '10.0.0.2', '10.0.0.2'])
+
+    def test_disabled(self):
+        self.cache.enabled = False
+        self.cache.resolve_addrs('h1.example.com')
+        self.cache.resolve_addrs('h1.example.com')
+        self.assertEqual(len(self.server.queries), 4)
+
+    def test_urllib3(self):
+        from six.moves import BaseHTTPServer
+        from urllib3.util import connection
+        import requests
+
+        http_server = BaseHTTPServer.HTTPServer(('127.0.0.1', 0), BaseHTTPServer.BaseHTTPRequestHandler)
+        http_thread = threading.Thread(target=http_server.serve_forever)
+        http_thread.daemon = True
+        http_thread.start()
+
+        create_connection = connection.create_connection
+        try:
+            self.cache.install_urllib3()
+            for _ in range(2):
+                r = requests.get('http://localhost:%s/' % http_server.server_address[1], timeout=5)
+                self.assertEqual(r.status_code, 501)
+            self.assertEqual(self.cache.hits, 1)
+
+        finally:
+            connection.create_connection = create_connection
+            http_server.shutdown()
+            http_server.server_close()
+
+    def test_resolve_many(self):
+        self.server.delay = 0.05
+        names = ['h%d.example.com' % x for x in range(20)] + ['missing.example.com']
+        time_start = time.time()
+        res = self.cache.resolve_many(names, workers=10)
+        elapsed = time.time() - time_start
+
+        self.assertEqual(res['h7.example.com'], [(socket.AF_INET, '10.1.0.7')])
+        self.assertTrue(isinstance(res['missing.example.com'], socket.gaierror))
+        self.assertLess(elapsed, 20 * 2 * self.server.delay)
+
+        num_queries = len(self.server.queries)
+        self.cache.resolve_many(names)
+        self.assertEqual(len(self.server.queries), num_queries)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    unittest.main()  # pragma: no cover
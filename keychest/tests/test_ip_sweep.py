@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+from keychest.ip_sweep import IpSweeper
+from keychest.tls_domain_tools import TlsDomainTools
+import socket
+import unittest
+
+
+__author__ = 'dusanklinec'
+
+
+class IpSweepTest(unittest.TestCase):
+    """IP range sweep engine tests"""
+
+    def __init__(self, *args, **kwargs):
+        super(IpSweepTest, self).__init__(*args, **kwargs)
+
+    def setUp(self):
+        self.sweeper = IpSweeper(max_workers=4, chunk_size=3)
+
+    def tearDown(self):
+        self.sweeper.shutdown()
+
+    def test_sweep_all(self):
+        self.sweeper.pre_probe = False
+        ips = list(TlsDomainTools.iter_ips('10.0.0.0', '10.0.0.99'))
+        res = self.sweeper.sweep(ips, 443, lambda ip: TlsDomainTools.ip_to_int(ip))
+
+        self.assertFalse(res.aborted)
+        self.assertEqual(res.num_ips, 100)
+        self.assertEqual(res.num_probed_alive, 100)
+        self.assertEqual(sorted(res.results), sorted([(ip, TlsDomainTools.ip_to_int(ip)) for ip in ips]))
+        self.assertIsNotNone(res.duration)
+
+    def test_sweep_scan_exception(self):
+        self.sweeper.pre_probe = False
+
+        def scan_fnc(ip):
+            if ip == '10.0.0.5':
+                raise ValueError('Scan failed')
+            return ip
+
+        res = self.sweeper.sweep(TlsDomainTools.iter_ips('10.0.0.0', '10.0.0.9'), 443, scan_fnc)
+        res_map = dict(res.results)
+        self.assertEqual(len(res_map), 10)
+        self.assertIsNone(res_map['10.0.0.5'])
+        self.assertEqual(res_map['10.0.0.6'], '10.0.0.6')
+
+    def test_sweep_abort(self):
+        self.sweeper.pre_probe = False
+        res = self.sweeper.sweep(TlsDomainTools.iter_ips('10.0.0.0', '10.0.0.9'), 443, lambda ip: ip,
+                                 is_running=lambda: False)
+        self.assertTrue(res.aborted)
+        self.assertEqual(len(res.results), 0)
+
+    def test_pre_probe(self):
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            listener.bind(('127.0.0.1', 0))
+            listener.listen(5)
+            port = listener.getsockname()[1]
+
+            self.sweeper.probe_timeout = 1.0
+            res = self.sweeper.sweep(['127.0.0.1', '127.0.0.2', '127.0.0.3'], port, lambda ip: ip)
+            self.assertEqual(res.num_ips, 3)
+            self.assertEqual(res.results, [('127.0.0.1', '127.0.0.1')])
+
+        finally:
+            listener.close()
+
+
+if __name__ == "__main__":  # pragma: no cover
+    unittest.main()  # pragma: no cover
@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import os
+import time
+import unittest
+
+import redis
+
+from ..redis_client import RedisClient
+from ..redis_queue import RedisQueue
+from . import MicroMock
+
+
+__author__ = 'dusanklinec'
+
+
+class RedisQueueTest(unittest.TestCase):
+    """Redis queue job intake, requires local Redis (REDIS_HOST, REDIS_PORT), skipped otherwise"""
+
+    def __init__(self, *args, **kwargs):
+        super(RedisQueueTest, self).__init__(*args, **kwargs)
+
+    def setUp(self):
+        config = MicroMock(redis_host=os.environ.get('REDIS_HOST', '127.0.0.1'),
+                           redis_port=int(os.environ.get('REDIS_PORT', 6379)))
+        self.client = RedisClient()
+        self.client.init(config)
+        try:
+            self.client.redis.ping()
+        except redis.exceptions.ConnectionError:
+            self.skipTest('Redis not available')
+
+        self.queue_name = 'queues:keychest-test-%s' % os.getpid()
+        self.queue = RedisQueue(self.client, default_queue=self.queue_name)
+        self._cleanup()
+
+    def tearDown(self):
+        if hasattr(self, 'queue'):
+            self._cleanup()
+
+    def _cleanup(self):
+        q = self.queue_name
+        self.client.redis.delete(q, '%s:delayed' % q, '%s:reserved' % q)
+
+    def _push(self, num, start=0):
+        pipe = self.client.redis.pipeline(transaction=False)
+        for idx in range(start, start + num):
+            pipe.rpush(self.queue_name, json.dumps({'id': 'job%s' % idx, 'attempts': 0, 'data': {'idx': idx}}))
+        pipe.execute()
+
+    def _push_delayed(self, job_id):
+        self.client.redis.execute_command('ZADD', '%s:delayed' % self.queue_name, int(time.time() * 1000) - 1,
+                                          json.dumps({'id': job_id, 'attempts': 0}))
+
+    def test_pop_batch(self):
+        self._push(10)
+        jobs = self.queue.pop_batch(count=4)
+        self.assertEqual(len(jobs), 4)
+        self.assertEqual([x.decoded['id'] for x in jobs], ['job0', 'job1', 'job2', 'job3'])
+        self.assertEqual([json.loads(x.reserved)['attempts'] for x in jobs], [1] * 4)
+        self.assertEqual(self.client.redis.zcard('%s:reserved' % self.queue_name), 4)
+        self.assertEqual(self.queue.size(), 10)
+
+        # same reservation as the single pop
+        job = self.queue.pop()
+        self.assertEqual(job.decoded['id'], 'job4')
+        self.assertEqual(json.loads(job.reserved)['attempts'], 1)
+
+        jobs[0].delete()
+        self.assertEqual(self.client.redis.zcard('%s:reserved' % self.queue_name), 4)
+        self.assertEqual(len(self.queue.pop_batch(count=100)), 5)
+        self.assertEqual(self.queue.pop_batch(count=100), [])
+
+    def test_pop_batch_blocking(self):
+        time_start = time.time()
+        self.assertEqual(self.queue.pop_batch(count=10, blocking=True, timeout=1), [])
+        self.assertGreaterEqual(time.time() - time_start, 0.9)
+
+        self._push(3)
+        jobs = self.queue.pop_batch(count=10, blocking=True, timeout=1)
+        self.assertEqual(len(jobs), 3)
+
+    def test_migration_timer(self):
+        self.queue.migrate_interval = 0.2
+        self._push_delayed('delayed')
+
+        self.assertTrue(self.queue.migrate_if_due(self.queue_name))
+        self.assertFalse(self.queue.migrate_if_due(self.queue_name))
+        self.assertEqual(self.queue.pop_batch(count=10)[0].decoded['id'], 'delayed')
+
+        self._push_delayed('delayed2')
+        self.assertEqual(self.queue.pop_batch(count=10), [])  # migrated on the next timer tick
+        time.sleep(0.25)
+        self.assertEqual(self.queue.pop_batch(count=10)[0].decoded['id'], 'delayed2')
+
+    def test_bench(self):
+        num_jobs = 2000
+        self._push(num_jobs)
+        self.queue.migrate_interval = 0
+        time_start = time.time()
+        while self.queue.pop() is not None:
+            pass
+        time_single = time.time() - time_start
+
+        self._cleanup()
+        self._push(num_jobs)
+        self.queue.migrate_interval = 1.0
+        time_start = time.time()
+        popped = 0
+        while True:
+            jobs = self.queue.pop_batch(count=50)
+            if not jobs:
+                break
+            popped += len(jobs)
+        time_batch = time.time() - time_start
+
+        self.assertEqual(popped, num_jobs)
+
+        # timing depends on the machine and Redis load, checked only on request
+        if os.environ.get('REDIS_BENCH_STRICT'):
+            self.assertLess(time_batch, time_single)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    unittest.main()  # pragma: no cover
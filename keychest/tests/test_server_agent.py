@@ -0,0 +1,418 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import sqlalchemy as salch
+from flask import Flask, jsonify, request, abort
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.schema import CreateTable
+from werkzeug.serving import make_server
+
+from .. import util
+from ..agent import AgentResultPush, AgentResultSpool, decode_results_payload, encode_results_payload
+from ..config import Config
+from ..consts import DbLastScanCacheType, DbScanType
+from ..database_manager import DatabaseManager
+from ..dbutil import DbDnsResolve, DbWatchTarget, DbWatchService, DbBaseDomain, DbWatchAssoc, DbKeychestAgent, \
+    DbDnsEntry, DbLastScanCache
+from ..server_agent import ServerAgent
+from . import MicroMock
+
+try:
+    from ..server_api import RestAPI
+except ImportError:  # pragma: no cover
+    RestAPI = None
+
+
+__author__ = 'dusanklinec'
+
+
+class StandInMaster(object):
+    """Local Flask master serving new_results and get_targets, can be switched down"""
+
+    def __init__(self):
+        self.requests = []  # (content encoding, decoded body)
+        self.target_requests = []  # (args, status, number of targets)
+        self.down = False
+        self.agent = None  # master ServerAgent
+        self.session_maker = None
+        self.app = Flask(__name__)
+        self.app.add_url_rule('/api/v1.0/new_results', 'new_results', self.on_new_results, methods=['POST'])
+        self.app.add_url_rule('/api/v1.0/get_targets', 'get_targets', self.on_get_targets, methods=['GET'])
+        self.http = make_server('127.0.0.1', 0, self.app, threaded=True)
+        self.thread = threading.Thread(target=self.http.serve_forever)
+        self.thread.daemon = True
+
+    @property
+    def endpoint(self):
+        return 'http://127.0.0.1:%s' % self.http.server_port
+
+    @property
+    def scan_ids(self):
+        return [x['new_scan']['id'] for _, req in self.requests for x in req['scans']]
+
+    def on_new_results(self):
+        if self.down:
+            abort(503)
+        self.requests.append((request.headers.get('Content-Encoding'), decode_results_payload(request)))
+        return jsonify({'result': True})
+
+    def on_get_targets(self):
+        s = self.session_maker()
+        try:
+            resp = self.agent.agent_on_get_targets(s, MicroMock(agent=MicroMock(id=1)), request)
+            num_targets = len(json.loads(resp.get_data().decode('utf8'))['targets']) if resp.status_code == 200 else 0
+            self.target_requests.append((dict(request.args), resp.status_code, num_targets))
+            return resp
+        finally:
+            s.close()
+
+
+def create_tables(models):
+    """
+    In-memory sqlite DB with the model tables
+    """
+    engine = salch.create_engine('sqlite://', connect_args={'check_same_thread': False},
+                                 poolclass=salch.pool.StaticPool)
+    for model in models:
+        # sqlite does not autoincrement BigInteger primary keys
+        ddl = str(CreateTable(model.__table__).compile(engine))
+        engine.execute(ddl.replace('id BIGINT NOT NULL', 'id INTEGER NOT NULL'))
+    return engine
+
+
+class ServerAgentTest(unittest.TestCase):
+    """Agent result publishing to the stand-in master"""
+
+    def __init__(self, *args, **kwargs):
+        super(ServerAgentTest, self).__init__(*args, **kwargs)
+
+    def setUp(self):
+        self.master = StandInMaster()
+        self.master.thread.start()
+        self.tmpdir = tempfile.mkdtemp()
+        self.agents = []
+
+    def tearDown(self):
+        for agent in self.agents:
+            agent.agent_spool.close()
+        self.master.http.shutdown()
+        shutil.rmtree(self.tmpdir)
+
+    def _agent(self, batch=3, delay=100):
+        config = Config()
+        config.master_endpoint = self.master.endpoint
+        config.master_apikey = 'test'
+        config.agent_publish_batch = batch
+        config.agent_publish_delay = delay
+        config.agent_spool = os.path.join(self.tmpdir, 'spool.log')
+
+        agent = ServerAgent()
+        agent.init(MicroMock(db=None, config=config, is_running=lambda: True))
+        agent.agent_init_spool()
+        self.agents.append(agent)
+        return agent
+
+    def _push(self, agent, scan_ids):
+        for scan_id in scan_ids:
+            scan = DbDnsResolve()
+            scan.id = scan_id
+            scan.watch_id = 1
+            scan.dns = json.dumps([[2, '10.0.0.%s' % scan_id]])
+            scan.last_scan_at = datetime.datetime.now()
+
+            psh = AgentResultPush()
+            psh.new_scan = scan
+            agent.agent_queue.put(psh)
+
+    def test_batch(self):
+        agent = self._agent(batch=3, delay=10000)
+        self._push(agent, range(1, 8))
+        agent.agent_publish(None)
+        agent.agent_publish(None)
+        agent.agent_publish(None)
+
+        self.assertEqual(self.master.scan_ids, [1, 2, 3, 4, 5, 6])
+        self.assertEqual([len(x[1]['scans']) for x in self.master.requests], [3, 3])
+        self.assertEqual(self.master.requests[0][0], 'gzip')
+        self.assertEqual(self.master.requests[0][1]['scans'][0]['new_scan']['dns_res'], [[2, '10.0.0.1']])
+        self.assertEqual(len(agent.agent_spool), 0)
+        self.assertEqual(os.path.getsize(agent.agent_spool.path), 0)
+
+    def test_delay(self):
+        agent = self._agent(batch=50, delay=100)
+        self._push(agent, [1, 2])
+        time_start = time.time()
+        while len(self.master.requests) == 0 and time.time() - time_start < 5:
+            agent.agent_publish(None)
+
+        self.assertEqual(self.master.scan_ids, [1, 2])
+        self.assertGreaterEqual(time.time() - time_start, 0.1)
+
+    def test_master_down_restart(self):
+        self.master.down = True
+        agent = self._agent(batch=2)
+        self._push(agent, [1, 2, 3, 4])
+        agent.agent_publish(None)
+        agent.agent_publish(None)
+
+        self.assertEqual(self.master.requests, [])
+        self.assertEqual(len(agent.agent_spool), 2)
+        self.assertEqual(agent.agent_publish_backoff, ServerAgent.PUBLISH_BACKOFF_MIN)
+        self.assertGreater(agent.agent_publish_next, time.time())
+
+        # agent restart, pending batches loaded from the spool
+        agent.agent_spool.close()
+        agent2 = self._agent(batch=2)
+        self.assertEqual(len(agent2.agent_spool), 2)
+
+        self.master.down = False
+        agent2.agent_publish(None)
+        self.assertEqual(self.master.scan_ids, [1, 2, 3, 4])
+        self.assertEqual(len(agent2.agent_spool), 0)
+
+    def test_legacy_form(self):
+        import requests
+        resp = requests.post(self.master.endpoint + '/api/v1.0/new_results',
+                             json={'scans': [{'new_scan': {'id': 9}, 'prev_scan_id': None}]})
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(self.master.requests, [(None, {'scans': [{'new_scan': {'id': 9}, 'prev_scan_id': None}]})])
+
+    def test_spool(self):
+        path = os.path.join(self.tmpdir, 'spool2.log')
+        spool = AgentResultSpool(path)
+        spool.open()
+        ids = [spool.append(b'payload%d' % x) for x in range(4)]
+        spool.ack(ids[1])
+        spool.compact()
+        self.assertEqual(spool.pending_ids(), [ids[0], ids[2], ids[3]])
+        self.assertEqual(spool.read(ids[2]), b'payload2')
+        spool.ack(ids[0])
+        spool.close()
+
+        # torn write at the end
+        with open(path, 'ab') as fh:
+            fh.write(b'{"t": "b", "id": 10, "da')
+
+        spool = AgentResultSpool(path)
+        spool.open()
+        self.assertEqual(spool.pending_ids(), [ids[2], ids[3]])
+        self.assertEqual(spool.read(ids[3]), b'payload3')
+        self.assertEqual(spool.append(b'next'), ids[3] + 1)
+        spool.ack(ids[2])
+        spool.ack(ids[3])
+        spool.ack(ids[3] + 1)
+        self.assertEqual(os.path.getsize(path), 0)
+        spool.close()
+
+
+class HostSyncTest(unittest.TestCase):
+    """Agent host sync from the stand-in master"""
+
+    def __init__(self, *args, **kwargs):
+        super(HostSyncTest, self).__init__(*args, **kwargs)
+
+    def setUp(self):
+        self.master_engine = create_tables([DbWatchService, DbBaseDomain, DbWatchTarget])
+        self.agent_engine = create_tables([DbWatchService, DbWatchTarget, DbWatchAssoc])
+        self.master_sm = sessionmaker(bind=self.master_engine)
+        self.agent_sm = sessionmaker(bind=self.agent_engine)
+        self.time = datetime.datetime(2018, 1, 1)
+
+        self.master = StandInMaster()
+        self.master.agent = ServerAgent()
+        self.master.session_maker = self.master_sm
+        self.master.thread.start()
+
+        config = Config()
+        config.master_endpoint = self.master.endpoint
+        config.master_apikey = 'test'
+        self.agent = ServerAgent()
+        self.agent.init(MicroMock(db=None, config=config, is_running=lambda: True))
+
+        s = self.master_sm()
+        svc = DbWatchService()
+        svc.id = 1
+        svc.service_name = 'example.com'
+        svc.created_at = svc.updated_at = self.time
+        s.add(svc)
+        s.commit()
+        s.close()
+        for idx in range(1, 6):
+            self._master_target(idx)
+
+    def tearDown(self):
+        self.master.http.shutdown()
+        self.master_engine.dispose()
+        self.agent_engine.dispose()
+
+    def _tick(self):
+        self.time += datetime.timedelta(seconds=10)
+        return self.time
+
+    def _master_target(self, idx, agent_id=1):
+        s = self.master_sm()
+        watch = DbWatchTarget()
+        watch.id = idx
+        watch.scan_host = 'h%d.example.com' % idx
+        watch.scan_port = '443'
+        watch.scan_scheme = 'https'
+        watch.scan_connect = 0
+        watch.service_id = 1
+        watch.agent_id = agent_id
+        watch.created_at = watch.updated_at = self._tick()
+        s.add(watch)
+        s.commit()
+        s.close()
+
+    def _sync(self):
+        s = self.agent_sm()
+        try:
+            self.agent.agent_sync_hosts(s)
+            return sorted([x.watch_id for x in s.query(DbWatchAssoc).all()])
+        finally:
+            s.close()
+
+    def test_delta_sync(self):
+        self.assertEqual(self._sync(), [1, 2, 3, 4, 5])
+        self.assertEqual(self.master.target_requests[-1], ({}, 200, 5))
+
+        # nothing changed
+        self.assertEqual(self._sync(), [1, 2, 3, 4, 5])
+        self.assertEqual(self.master.target_requests[-1][1:], (304, 0))
+
+        # new targets, only those are transferred (+ the last one at the cursor)
+        self._master_target(6)
+        self._master_target(7)
+        self._master_target(8, agent_id=2)
+        self.assertEqual(self._sync(), [1, 2, 3, 4, 5, 6, 7])
+        self.assertEqual(self.master.target_requests[-1][1:], (200, 3))
+        self.assertIn('since', self.master.target_requests[-1][0])
+
+        # update of the target
+        s = self.master_sm()
+        s.query(DbWatchTarget).filter(DbWatchTarget.id == 3).update({'scan_connect': 1, 'updated_at': self._tick()})
+        s.commit()
+        s.close()
+        self._sync()
+        self.assertEqual(self.master.target_requests[-1][1:], (200, 2))
+
+        # removal detected by the version, full sync
+        s = self.master_sm()
+        s.query(DbWatchTarget).filter(DbWatchTarget.id == 2).update({'agent_id': 2})
+        s.commit()
+        s.close()
+        num_requests = len(self.master.target_requests)
+        self.assertEqual(self._sync(), [1, 3, 4, 5, 6, 7])
+        self.assertEqual([x[1:] for x in self.master.target_requests[num_requests:]], [(200, 1), (200, 6)])
+        self.assertEqual(self.master.target_requests[-1][0], {})
+
+    def test_periodic_full_sync(self):
+        self._sync()
+        self.agent.agent_hosts_full_sync -= ServerAgent.HOSTS_FULL_SYNC + 1
+        self._sync()
+        self.assertEqual(self.master.target_requests[-1], ({}, 200, 5))
+
+
+@unittest.skipIf(RestAPI is None, 'REST API dependencies not available')
+class MasterNewResultsTest(unittest.TestCase):
+    """Master REST API processing of the results published by the agent"""
+
+    def __init__(self, *args, **kwargs):
+        super(MasterNewResultsTest, self).__init__(*args, **kwargs)
+
+    def setUp(self):
+        self.engine = create_tables([DbKeychestAgent, DbWatchTarget, DbDnsResolve, DbDnsEntry, DbLastScanCache])
+        self.sm = sessionmaker(bind=self.engine)
+
+        s = self.sm()
+        agent = DbKeychestAgent()
+        agent.id = 1
+        agent.name = 'agent'
+        agent.api_key = 'test'
+        agent.organization_id = 1
+        agent.owner_id = 1
+        s.add(agent)
+
+        watch = DbWatchTarget()
+        watch.id = 1
+        watch.scan_host = 'www.example.com'
+        watch.scan_port = '443'
+        watch.scan_scheme = 'https'
+        s.add(watch)
+        s.commit()
+        s.close()
+
+        master = ServerAgent()
+        master.init(MicroMock(db=None, config=Config(), db_manager=DatabaseManager()))
+
+        self.api = RestAPI()
+        self.api.db = MicroMock(set_subsystem=lambda x: None, get_session=self.sm)
+        self.api.server = MicroMock(mod_agent=master)
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def _results(self, scan_ids):
+        agent = ServerAgent()
+        scans = []
+        for scan_id in scan_ids:
+            scan = DbDnsResolve()
+            scan.id = scan_id
+            scan.watch_id = 1
+            scan.dns = json.dumps([[2, '10.0.0.%s' % scan_id]])
+            scan.last_scan_at = datetime.datetime.now()
+            scans.append({'new_scan': agent.agent_dictize_scan(None, scan), 'prev_scan_id': None})
+        return util.jsonify({'scans': scans})
+
+    def _post(self, data, headers):
+        headers = dict(headers)
+        headers[RestAPI.API_HEADER] = 'test'
+        with self.api.flask.test_request_context('/api/v1.0/new_results', method='POST', data=data,
+                                                 headers=headers, environ_base={'REMOTE_ADDR': '10.0.0.100'}):
+            resp = self.api.on_new_results(request=request)
+        self.assertEqual(resp.status_code, 200)
+        self.assertEqual(json.loads(resp.get_data().decode('utf8')), {'result': True})
+
+    def _stored(self):
+        s = self.sm()
+        try:
+            ips = sorted([x.ip for x in s.query(DbDnsEntry).all()])
+            last = s.query(DbLastScanCache)\
+                .filter(DbLastScanCache.cache_type == DbLastScanCacheType.AGENT_SCAN)\
+                .filter(DbLastScanCache.scan_type == DbScanType.DNS).one()
+            return ips, last.scan_id
+        finally:
+            s.close()
+
+    def test_gzip_batch(self):
+        self._post(encode_results_payload(self._results([1, 2])),
+                   {'Content-Encoding': 'gzip', 'Content-Type': 'application/json'})
+        self.assertEqual(self._stored(), (['10.0.0.1', '10.0.0.2'], 2))
+
+        s = self.sm()
+        agent = s.query(DbKeychestAgent).get(1)
+        self.assertEqual(agent.last_seen_ip, '10.0.0.100')
+        self.assertIsNotNone(s.query(DbWatchTarget).get(1).last_dns_scan_id)
+        s.close()
+
+        # batch sent again, processed scans are skipped
+        self._post(encode_results_payload(self._results([1, 2])),
+                   {'Content-Encoding': 'gzip', 'Content-Type': 'application/json'})
+        self.assertEqual(self._stored(), (['10.0.0.1', '10.0.0.2'], 2))
+
+    def test_legacy_form(self):
+        self._post(json.dumps(self._results([3])), {'Content-Type': 'application/json'})
+        self.assertEqual(self._stored(), (['10.0.0.3'], 3))
+
+
+if __name__ == "__main__":  # pragma: no cover
+    unittest.main()  # pragma: no cover
@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import datetime
+import json
+import unittest
+
+from sqlalchemy.orm import sessionmaker
+
+from ..config import Config
+from ..consts import DbScanType, DbLastScanCacheType
+from ..dbutil import DbWatchTarget, DbWatchService, DbWatchAssoc, DbDnsResolve, DbLastScanCache, \
+    DbHandshakeScanJob, DbCrtShQuery, DbBaseDomain, DbWhoisCheck, DbSubdomainWatchTarget, DbSubdomainWatchAssoc, \
+    DbIpScanRecord, DbIpScanRecordUser
+from . import MicroMock
+from .test_server_agent import create_tables
+
+try:
+    from ..server import Server
+except ImportError:  # pragma: no cover
+    Server = None
+
+
+__author__ = 'dusanklinec'
+
+
+@unittest.skipIf(Server is None, 'server dependencies not available')
+class PeriodicFeederTest(unittest.TestCase):
+    """Watch feeder hands over usable jobs"""
+
+    def __init__(self, *args, **kwargs):
+        super(PeriodicFeederTest, self).__init__(*args, **kwargs)
+
+    def setUp(self):
+        self.engine = create_tables([DbWatchService, DbBaseDomain, DbWatchTarget, DbWatchAssoc, DbDnsResolve,
+                                     DbLastScanCache, DbHandshakeScanJob, DbCrtShQuery, DbWhoisCheck,
+                                     DbSubdomainWatchTarget, DbSubdomainWatchAssoc, DbIpScanRecord,
+                                     DbIpScanRecordUser])
+        self.sm = sessionmaker(bind=self.engine)
+        self.now = datetime.datetime.now()
+
+        self.server = Server()
+        self.server.config = Config()
+        self.server.db = MicroMock(get_session=self.sm)
+
+        s = self.sm()
+        svc = DbWatchService()
+        svc.id = 1
+        svc.service_name = 'example.com'
+        s.add(svc)
+
+        # IP host, fresh TLS and crt.sh scans - nothing due
+        self._target(s, 1, '10.0.0.1')
+        self._add_scan(s, DbHandshakeScanJob, 10, 1, DbScanType.TLS, ip_scanned='10.0.0.1')
+        self._add_scan(s, DbCrtShQuery, 11, 1, DbScanType.CRTSH)
+
+        # host with a fresh DNS scan, other scans due
+        target = self._target(s, 2, 'www.example.com')
+        dns = self._add_scan(s, DbDnsResolve, 12, 2, None, dns=json.dumps([[2, '10.0.0.2']]))
+        target.last_dns_scan_id = dns.id
+        s.commit()
+        s.close()
+
+    def tearDown(self):
+        self.server.dns_cache.shutdown()
+        self.server.tls_scanner.shutdown()
+        self.engine.dispose()
+
+    def _target(self, s, watch_id, host):
+        target = DbWatchTarget()
+        target.id = watch_id
+        target.scan_host = host
+        target.scan_port = '443'
+        target.scan_scheme = 'https'
+        target.service_id = 1
+        s.add(target)
+
+        assoc = DbWatchAssoc()
+        assoc.id = watch_id
+        assoc.watch_id = watch_id
+        assoc.owner_id = 1
+        assoc.scan_periodicity = 86400
+        s.add(assoc)
+        return target
+
+    def _add_scan(self, s, model, scan_id, watch_id, scan_type, **kwargs):
+        scan = model()
+        scan.id = scan_id
+        scan.watch_id = watch_id
+        scan.last_scan_at = self.now
+        for key in kwargs:
+            setattr(scan, key, kwargs[key])
+        s.add(scan)
+
+        if scan_type is not None:
+            cache = DbLastScanCache()
+            cache.cache_type = DbLastScanCacheType.LOCAL_SCAN
+            cache.obj_id = watch_id
+            cache.scan_type = scan_type
+            cache.scan_id = scan_id
+            s.add(cache)
+        return scan
+
+    def test_jobs_usable(self):
+        self.server.periodic_feeder()
+
+        jobs = []
+        while not self.server.watcher_job_queue.empty():
+            jobs.append(self.server.watcher_job_queue.get())
+        self.assertEqual([x.watch_id() for x in jobs], [2])
+
+        # detached jobs are readable after the feeder session is closed
+        job = jobs[0]
+        self.assertEqual(job.target.scan_host, 'www.example.com')
+        self.assertEqual(job.service.service_name, 'example.com')
+        self.assertEqual(job.prefetch.dns.dns_res, [[2, '10.0.0.2']])
+        self.assertTrue(job.is_scan_fresh(job.prefetch.dns, self.server.delta_dns))
+        self.assertEqual(job.scans_due, set([DbScanType.TLS, DbScanType.CRTSH, DbScanType.WHOIS]))
+
+        # not due target moved to the future
+        s = self.sm()
+        self.assertGreater(s.query(DbWatchTarget).get(1).next_scan_at, self.now)
+        self.assertIsNone(s.query(DbWatchTarget).get(2).next_scan_at)
+        s.close()
+
+
+if __name__ == "__main__":  # pragma: no cover
+    unittest.main()  # pragma: no cover
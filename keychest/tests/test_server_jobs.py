@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import json
+import unittest
+from datetime import datetime, timedelta
+
+from ..dbutil import DbWatchTarget, DbDnsResolve
+from ..server_jobs import PeriodicJob
+from . import MicroMock
+
+
+__author__ = 'dusanklinec'
+
+
+class PeriodicJobTest(unittest.TestCase):
+    """Periodic watcher job scheduling helpers"""
+
+    def __init__(self, *args, **kwargs):
+        super(PeriodicJobTest, self).__init__(*args, **kwargs)
+
+    def _job(self, host, manual_dns=False, periodicity=None):
+        target = DbWatchTarget()
+        target.id = 1
+        target.scan_host = host
+        target.scan_port = 443
+        target.scan_scheme = 'https'
+        target.manual_dns = manual_dns
+        return PeriodicJob(target=target, periodicity=periodicity)
+
+    def _dns(self, ips):
+        dns = DbDnsResolve()
+        dns.dns = json.dumps([[2, x] for x in ips])
+        dns.init_on_load()
+        return dns
+
+    def test_ip_host(self):
+        job = self._job('10.0.0.2')
+        self.assertFalse(job.dns_scan_applicable())
+        self.assertEqual(job.scan_ips(None), ('10.0.0.2', ['10.0.0.2']))
+        self.assertEqual(job.scan_ips(self._dns(['10.0.0.9'])), ('10.0.0.2', ['10.0.0.2']))
+
+        job = self._job('2001:db8::1')
+        self.assertFalse(job.dns_scan_applicable())
+        self.assertEqual(job.scan_ips(None), ('2001:db8::1', ['2001:db8::1']))
+
+    def test_dns_host(self):
+        job = self._job('www.example.com')
+        self.assertTrue(job.dns_scan_applicable())
+        self.assertEqual(job.scan_ips(None), (None, []))
+        self.assertEqual(job.scan_ips(self._dns(['10.0.0.9', '10.0.0.3'])), ('10.0.0.3', ['10.0.0.9', '10.0.0.3']))
+
+        job = self._job('www.example.com', manual_dns=True)
+        self.assertFalse(job.dns_scan_applicable())
+        self.assertEqual(job.scan_ips(self._dns(['10.0.0.4'])), ('10.0.0.4', ['10.0.0.4']))
+
+    def test_scan_fresh(self):
+        now = datetime(2018, 1, 1, 12)
+        delta = timedelta(hours=2)
+        job = self._job('www.example.com')
+        self.assertFalse(job.is_scan_fresh(None, delta, now))
+        self.assertFalse(job.is_scan_fresh(MicroMock(last_scan_at=None), delta, now))
+        self.assertTrue(job.is_scan_fresh(MicroMock(last_scan_at=now - timedelta(minutes=119)), delta, now))
+        self.assertFalse(job.is_scan_fresh(MicroMock(last_scan_at=now - timedelta(minutes=120)), delta, now))
+
+        # bounded by the assoc periodicity, at least 5 minutes
+        job = self._job('www.example.com', periodicity=1800)
+        self.assertEqual(job.scan_delta(delta), timedelta(minutes=30))
+        self.assertFalse(job.is_scan_fresh(MicroMock(last_scan_at=now - timedelta(minutes=31)), delta, now))
+        self.assertEqual(self._job('a.example.com', periodicity=10).scan_delta(delta), timedelta(minutes=5))
+
+
+if __name__ == "__main__":  # pragma: no cover
+    unittest.main()  # pragma: no cover
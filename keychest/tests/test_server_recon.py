@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import datetime
+import json
+import time
+import unittest
+
+from sqlalchemy.orm import sessionmaker
+
+from ..config import Config
+from ..dbutil import DbSubdomainWatchTarget, DbSubdomainResultCache
+from ..server_jobs import PeriodicReconJob
+from . import MicroMock
+from .test_server_agent import create_tables
+
+try:
+    from ..server import Server
+except ImportError:  # pragma: no cover
+    Server = None
+
+
+__author__ = 'dusanklinec'
+
+
+@unittest.skipIf(Server is None, 'server dependencies not available')
+class WildcardReconTest(unittest.TestCase):
+    """Incremental crt.sh wildcard recon over the crt.sh ID watermark"""
+
+    # crt.sh id -> (certificate id, alt names)
+    CERTS = {
+        100: (1, ['example.com', 'www.example.com']),
+        101: (2, ['mail.example.com', 'mail.other.org']),
+        102: (3, ['api.example.com']),
+        103: (4, ['www.example.com']),
+    }
+
+    def __init__(self, *args, **kwargs):
+        super(WildcardReconTest, self).__init__(*args, **kwargs)
+
+    def setUp(self):
+        self.engine = create_tables([DbSubdomainWatchTarget, DbSubdomainResultCache])
+        self.sm = sessionmaker(bind=self.engine)
+        self.loaded = []
+
+        self.server = Server()
+        self.server.config = Config()
+        self.server.db = MicroMock(get_session=self.sm)
+        self.server.db_manager = MicroMock(get_crtsh_input=lambda s, host, itype: (MicroMock(iquery=host), False))
+        self.server.cert_manager = MicroMock(cert_load_by_id=self._cert_load_by_id)
+        self.server.db_sink = MicroMock(update_cache=lambda x: None)
+        self.server._create_job_spec = lambda job: {}
+        self.server.subs_sync_records = lambda s, job, db_sub: None
+        self.server.auto_fill_new_watches = lambda s, job, db_sub: None
+        self.server.on_new_scan = lambda s, old_scan, new_scan, job: None
+
+        s = self.sm()
+        target = DbSubdomainWatchTarget()
+        target.id = 1
+        target.scan_host = 'example.com'
+        target.top_domain_id = 1
+        s.add(target)
+        s.commit()
+        s.close()
+
+    def tearDown(self):
+        self.server.dns_cache.shutdown()
+        self.server.tls_scanner.shutdown()
+        self.engine.dispose()
+
+    def _cert_load_by_id(self, s, cert_ids):
+        self.loaded += cert_ids
+        by_id = dict([(x[0], x[1]) for x in self.CERTS.values()])
+        return dict([(x, MicroMock(all_names=by_id[x])) for x in cert_ids])
+
+    def _scan(self, crt_sh_ids):
+        """
+        Runs the wildcard recon with the crt.sh query returning given crt.sh ids
+        :param crt_sh_ids:
+        :return: list of results in the db, ordered by id
+        """
+        subs = [MicroMock(crt_id=self.CERTS[x][0], crt_sh_id=x, cert_db=None) for x in crt_sh_ids]
+        query_db = MicroMock(newest_cert_sh_id=max(crt_sh_ids))
+        self.server.wp_scan_wildcard_query = lambda s, **kwargs: (False, query_db, subs, None, [])
+
+        s = self.sm()
+        job = PeriodicReconJob(target=s.query(DbSubdomainWatchTarget).get(1))
+        self.server.wp_scan_crtsh_wildcard(s, job, None)
+        self.assertTrue(job.scan_crtsh_wildcard.success)
+        s.close()
+
+        s = self.sm()
+        res = s.query(DbSubdomainResultCache).order_by(DbSubdomainResultCache.id).all()
+        s.close()
+        return res
+
+    def _add_result(self, names, last_scan_idx):
+        s = self.sm()
+        res = DbSubdomainResultCache()
+        res.watch_id = 1
+        res.scan_type = 1
+        res.last_scan_at = datetime.datetime.now() - datetime.timedelta(days=1)
+        res.last_scan_idx = last_scan_idx
+        res.num_scans = 1
+        res.trans_result = sorted(names)
+        res.result_size = len(names)
+        res.result = json.dumps(res.trans_result)
+        s.add(res)
+        s.commit()
+        s.close()
+
+    def test_first_full_recon(self):
+        res = self._scan([100, 101])
+        self.assertEqual(sorted(self.loaded), [1, 2])
+        self.assertEqual(len(res), 1)
+        self.assertEqual(res[0].trans_result, ['example.com', 'mail.example.com', 'www.example.com'])
+        self.assertEqual(res[0].last_scan_idx, 101)
+        self.assertIn(1, self.server.wildcard_full_recon)
+
+    def test_incremental(self):
+        self._add_result(['example.com', 'mail.example.com', 'www.example.com'], 101)
+        self.server.wildcard_full_recon[1] = last_full = time.time()
+
+        # only certificates above the watermark loaded, merged to the previous result
+        res = self._scan([100, 101, 102])
+        self.assertEqual(self.loaded, [3])
+        self.assertEqual(len(res), 2)
+        self.assertEqual(res[1].trans_result, ['api.example.com', 'example.com', 'mail.example.com',
+                                               'www.example.com'])
+        self.assertEqual(res[1].last_scan_idx, 102)
+        self.assertEqual(self.server.wildcard_full_recon[1], last_full)
+
+    def test_unchanged_advances_watermark(self):
+        self._add_result(['example.com', 'mail.example.com', 'www.example.com'], 101)
+        self.server.wildcard_full_recon[1] = time.time()
+
+        # new certificate without new names, the same result keeps the row, moves the watermark
+        res = self._scan([100, 101, 103])
+        self.assertEqual(self.loaded, [4])
+        self.assertEqual(len(res), 1)
+        self.assertEqual(res[0].last_scan_idx, 103)
+        self.assertEqual(res[0].num_scans, 2)
+
+    def test_forced_full_recon(self):
+        self._add_result(['stale.example.com', 'www.example.com'], 101)
+        self.server.wildcard_full_recon[1] = \
+            time.time() - self.server.delta_wildcard_full.total_seconds() - 10
+
+        # periodic reconciliation loads everything, names of removed certificates dropped
+        res = self._scan([100, 101, 102])
+        self.assertEqual(sorted(self.loaded), [1, 2, 3])
+        self.assertEqual(len(res), 2)
+        self.assertEqual(res[1].trans_result, ['api.example.com', 'example.com', 'mail.example.com',
+                                               'www.example.com'])
+        self.assertEqual(res[1].last_scan_idx, 102)
+        self.assertGreater(self.server.wildcard_full_recon[1], time.time() - 60)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    unittest.main()  # pragma: no cover
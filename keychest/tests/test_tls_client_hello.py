@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import unittest
+
+from ..tls_handshake import TlsHandshaker, ClientHelloTemplate
+
+
+__author__ = 'dusanklinec'
+
+
+class TlsClientHelloTest(unittest.TestCase):
+    """ClientHello template cache tests"""
+
+    def __init__(self, *args, **kwargs):
+        super(TlsClientHelloTest, self).__init__(*args, **kwargs)
+
+    def setUp(self):
+        self.tester = TlsHandshaker()
+
+    def _scapy_hello(self, hostname, tls_ver='TLS_1_2', ecc=None):
+        return bytes(self.tester._build_client_hello(hostname, tls_ver, ecc=ecc))
+
+    def _random(self, raw):
+        off = ClientHelloTemplate.OFF_RANDOM
+        return raw[off:off + ClientHelloTemplate.RANDOM_LEN]
+
+    def test_template_equals_scapy(self):
+        for ecc in [None, True, False]:
+            for tls_ver in ['TLS_1_0', 'TLS_1_2']:
+                for hostname in ['a.io', 'keychest.net', 'very-long-subdomain-name.' * 8 + 'com',
+                                 ['keychest.net', 'www.keychest.net']]:
+                    expected = self._scapy_hello(hostname, tls_ver, ecc=ecc)
+                    template = self.tester._get_hello_template(tls_ver, ecc=ecc)
+                    names = hostname if isinstance(hostname, list) else [hostname]
+                    self.assertEqual(template.build(names, client_random=self._random(expected)), expected)
+
+    def test_fresh_random(self):
+        hello1 = self.tester._build_client_hello_bytes('keychest.net', 'TLS_1_2')
+        hello2 = self.tester._build_client_hello_bytes('keychest.net', 'TLS_1_2')
+        self.assertEqual(len(hello1), len(hello2))
+        self.assertNotEqual(self._random(hello1), self._random(hello2))
+
+    def test_template_cached(self):
+        template = self.tester._get_hello_template('TLS_1_2', ecc=None)
+        self.assertIs(TlsHandshaker()._get_hello_template('TLS_1_2', ecc=None), template)
+
+    def test_bench(self):
+        num = 20
+        hostnames = ['host%d.keychest.net' % x for x in range(num)]
+        self.tester._get_hello_template('TLS_1_2')
+
+        time_start = time.time()
+        for host in hostnames:
+            bytes(self.tester._build_client_hello(host, 'TLS_1_2'))
+        time_scapy = time.time() - time_start
+
+        time_start = time.time()
+        for host in hostnames:
+            self.tester._build_client_hello_bytes(host, 'TLS_1_2')
+        time_template = time.time() - time_start
+
+        # timing depends on the machine load, checked only on request
+        if os.environ.get('TLS_HELLO_BENCH_STRICT'):
+            self.assertLess(time_template, time_scapy)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    unittest.main()  # pragma: no cover
@@ -1,7 +1,10 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
-from keychest.tls_domain_tools import TlsDomainTools, CnameCDNClassifier, CdnProviders
+from keychest.tls_domain_tools import TlsDomainTools, CnameCDNClassifier, CdnProviders, SubstringAutomaton
+from keychest import util
+import os
 import random
+import time
 import unittest
 from . import MicroMock
 
@@ -112,6 +115,81 @@ class TlsDomainToolsTest(unittest.TestCase):
         self.assertEqual(None, classif.classify_cname('keychest.net'))
         self.assertEqual(None, classif.classify_cname(None))
 
+    def _classify_linear(self, classif, cname):
+        """
+        Original linear substring scan
+        """
+        for subs, cdn in classif.db:
+            if util.contains(cname, subs):
+                return cdn
+        return None
+
+    def _gen_cnames(self, rnd, patterns, num):
+        cnames = []
+        for idx in range(num):
+            if rnd.random() < 0.3:
+                cnames.append('h%d%s%s%s' % (idx, rnd.choice(patterns), rnd.choice(['', 'com', '.edgekey.net']),
+                                             rnd.choice(['', rnd.choice(patterns)])))
+            else:
+                cnames.append('host%d.customer%d.example.com' % (idx, rnd.randint(0, 1000)))
+        return cnames
+
+    def test_substring_automaton(self):
+        """
+        Aho-Corasick, lowest pattern index wins
+        :return:
+        """
+        automaton = SubstringAutomaton(['he', 'she', 'his', 'hers', 'e'])
+        self.assertEqual(0, automaton.search('ushers'))
+        self.assertEqual(0, automaton.search('ushe'))
+        self.assertEqual(1, SubstringAutomaton(['hers', 'she']).search('ushe'))
+        self.assertEqual(2, automaton.search('ahisx'))
+        self.assertEqual(4, automaton.search('xes'))
+        self.assertEqual(None, automaton.search('xyz'))
+        self.assertEqual(None, automaton.search(''))
+        self.assertEqual(1, SubstringAutomaton(['abcd', 'bc']).search('abce'))
+        self.assertEqual(0, SubstringAutomaton(['', 'a']).search('a'))
+
+    def test_cname_classif_equivalence(self):
+        """
+        Automaton classification equals the linear scan over the bundled pattern file
+        :return:
+        """
+        classif = CnameCDNClassifier()
+        classif.load_data()
+        patterns = [x[0] for x in classif.db]
+
+        rnd = random.Random(42)
+        cnames = self._gen_cnames(rnd, patterns, 5000)
+        cnames += [x + y for x in patterns for y in patterns]  # overlapping matches, tie-breaking
+        cnames += patterns + [x[1:] for x in patterns] + [x[:-1] for x in patterns]
+        for cname in cnames:
+            self.assertEqual(self._classify_linear(classif, cname), classif.classify_cname(cname), cname)
+
+    def test_cname_classif_bench(self):
+        """
+        Classification benchmark, corpus size via CNAME_BENCH_SIZE, timing checked with CNAME_BENCH_STRICT
+        :return:
+        """
+        classif = CnameCDNClassifier()
+        classif.load_data()
+        rnd = random.Random(1)
+        cnames = self._gen_cnames(rnd, [x[0] for x in classif.db], int(os.environ.get('CNAME_BENCH_SIZE', 20000)))
+
+        time_start = time.time()
+        res_automaton = [classif.classify_cname(x) for x in cnames]
+        time_automaton = time.time() - time_start
+
+        time_start = time.time()
+        res_linear = [self._classify_linear(classif, x) for x in cnames]
+        time_linear = time.time() - time_start
+
+        self.assertEqual(res_automaton, res_linear)
+
+        # timing depends on the machine load, checked only on request
+        if os.environ.get('CNAME_BENCH_STRICT'):
+            self.assertLess(time_automaton, time_linear)
+
     def test_hdr_cdn(self):
         """
         Headers -> CDN classif
@@ -0,0 +1,82 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import socket
+import unittest
+
+from .. import util
+from ..tls_bench import TlsReplayServer
+from ..tls_handshake import TlsHandshaker, TlsHandshakeErrors, TlsTimeout
+from ..tls_handshake_async import AsyncTlsHandshaker, asyncio
+
+
+__author__ = 'dusanklinec'
+
+
+class TlsHandshakeAsyncTest(unittest.TestCase):
+    """Handshakes against the loopback replay server"""
+
+    def __init__(self, *args, **kwargs):
+        super(TlsHandshakeAsyncTest, self).__init__(*args, **kwargs)
+
+    def setUp(self):
+        self.server = TlsReplayServer().start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def _free_port(self):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        s.bind(('127.0.0.1', 0))
+        port = s.getsockname()[1]
+        s.close()
+        return port
+
+    def test_replay_threaded(self):
+        tester = TlsHandshaker(timeout=3, attempts=1)
+        ret = tester.handshake('127.0.0.1', self.server.port, domain='keychest.net')
+        self._test_resp(ret)
+
+    @unittest.skipIf(asyncio is None, 'asyncio not available')
+    def test_replay_async(self):
+        tester = AsyncTlsHandshaker(timeout=3, attempts=1)
+        rets = tester.run_many([('127.0.0.1', self.server.port)] * 20, max_concurrency=8, domain='keychest.net')
+        self.assertEqual(len(rets), 20)
+
+        sync_ret = TlsHandshaker(timeout=3, attempts=1).handshake('127.0.0.1', self.server.port, domain='keychest.net')
+        for ret in rets:
+            self._test_resp(ret)
+            self.assertEqual(ret.certificates, sync_ret.certificates)
+            self.assertEqual(ret.resp_bin, sync_ret.resp_bin)
+
+    @unittest.skipIf(asyncio is None, 'asyncio not available')
+    def test_resolve_async(self):
+        addrs = socket.getaddrinfo('localhost', self.server.port, 0, socket.SOCK_STREAM, socket.IPPROTO_TCP)
+        if addrs[0][4][0] != '127.0.0.1':
+            self.skipTest('localhost does not resolve to 127.0.0.1 first')
+
+        tester = AsyncTlsHandshaker(timeout=3, attempts=1)
+        rets = tester.run_many([('localhost', self.server.port)], domain='keychest.net')
+        self._test_resp(rets[0])
+
+    @unittest.skipIf(asyncio is None, 'asyncio not available')
+    def test_conn_error_async(self):
+        tester = AsyncTlsHandshaker(timeout=3, attempts=1)
+        rets = tester.run_many([('127.0.0.1', self._free_port())])
+        self.assertIsInstance(rets[0], TlsTimeout)
+        self.assertEqual(rets[0].scan_result.handshake_failure, TlsHandshakeErrors.CONN_ERR)
+
+    def _test_resp(self, ret):
+        self.assertIsNotNone(ret)
+        self.assertIsNotNone(ret.resp_record)
+        self.assertFalse(ret.handshake_failure)
+        self.assertEqual(ret.ip, '127.0.0.1')
+        self.assertTrue(len(ret.certificates) > 1)
+        for x in ret.certificates:
+            crt = util.load_x509_der(x)
+            self.assertIsNotNone(crt)
+            self.assertIsNotNone(util.try_get_cname(crt))
+
+
+if __name__ == "__main__":  # pragma: no cover
+    unittest.main()  # pragma: no cover
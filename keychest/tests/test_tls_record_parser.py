@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import struct
+import unittest
+import pkg_resources
+
+from ..tls_handshake import TlsHandshaker, TlsHandshakeAbort, TlsHandshakeErrors, TLS
+from ..tls_record_parser import TlsRecordParser
+from . import MicroMock
+
+
+__author__ = 'dusanklinec'
+
+
+class TlsRecordParserTest(unittest.TestCase):
+    """Streaming TLS record parser tests"""
+
+    def __init__(self, *args, **kwargs):
+        super(TlsRecordParserTest, self).__init__(*args, **kwargs)
+
+    def _get_res(self, name):
+        resource_package = __name__
+        resource_path = '/'.join(('data', name))
+        return pkg_resources.resource_string(resource_package, resource_path)
+
+    def _feed_chunks(self, data, size):
+        parser = TlsRecordParser()
+        for idx in range(0, len(data), size):
+            parser.feed(data[idx:idx + size])
+        return parser
+
+    def test_scapy_equivalence(self):
+        tester = TlsHandshaker()
+        for name in ['enigmabridge.com.resp.bin', 'keychest.net.resp.bin']:
+            data = self._get_res(name)
+            expected = tester._extract_certificates(TLS(data))
+            self.assertTrue(len(expected) > 1)
+
+            for size in [1, 7, 512, len(data)]:
+                parser = self._feed_chunks(data, size)
+                self.assertTrue(parser.hello_done)
+                self.assertIsNone(parser.alert)
+                self.assertFalse(parser.pending)
+                self.assertEqual(parser.certificates, expected)
+                self.assertIsNotNone(parser.cipher_suite)
+
+    def test_fragmented_handshake(self):
+        data = self._get_res('keychest.net.resp.bin')
+        parser = TlsRecordParser()
+        parser.feed(data)
+
+        # re-frame all handshake messages into 100 B records
+        hs_data = b''
+        pos = 0
+        while pos < len(data):
+            length = struct.unpack('!H', data[pos + 3:pos + 5])[0]
+            hs_data += data[pos + 5:pos + 5 + length]
+            pos += 5 + length
+
+        framed = b''.join([b'\x16\x03\x03' + struct.pack('!H', len(hs_data[i:i + 100])) + hs_data[i:i + 100]
+                           for i in range(0, len(hs_data), 100)])
+        parser2 = self._feed_chunks(framed, 33)
+        self.assertTrue(parser2.hello_done)
+        self.assertEqual(parser2.certificates, parser.certificates)
+
+    def test_alert(self):
+        parser = TlsRecordParser()
+        self.assertTrue(parser.feed(b'\x15\x03\x03\x00\x02\x02\x28'))
+        self.assertEqual(parser.alert, (2, 40))
+
+        parser = TlsRecordParser()
+        self.assertFalse(parser.feed(b'\x15\x03\x03\x00\x02\x01\x00'))
+        self.assertIsNone(parser.alert)
+
+        tester = TlsHandshaker()
+        ret = MicroMock(handshake_failure=False, time_failed=None, alert=None)
+        with self.assertRaises(TlsHandshakeAbort):
+            tester._process_response(ret, TlsRecordParser(), b'\x15\x03\x03\x00\x02\x02\x28')
+        self.assertEqual(ret.handshake_failure, TlsHandshakeErrors.HANDSHAKE_ERR)
+        self.assertEqual(ret.alert.desc, 40)
+
+    def test_invalid(self):
+        parser = TlsRecordParser()
+        self.assertTrue(parser.feed(b'HTTP/1.1 400 Bad Request\r\n'))
+        self.assertTrue(parser.invalid)
+        self.assertFalse(parser.hello_done)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    unittest.main()  # pragma: no cover
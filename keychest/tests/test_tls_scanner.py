@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import socket
+import threading
+import time
+import unittest
+
+from six.moves import BaseHTTPServer, socketserver
+
+from ..tls_scanner import TlsScanner, RequestErrorCode
+
+
+__author__ = 'dusanklinec'
+
+
+class ProbeHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Redirect chains and slow pages"""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests.append(self.path)
+        if self.path.startswith('/slow'):
+            time.sleep(self.server.delay)
+
+        if self.path in self.server.redirects:
+            self.send_response(301)
+            self.send_header('Location', self.server.redirects[self.path])
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        body = b'ok'
+        self.send_response(200)
+        self.send_header('Strict-Transport-Security', 'max-age=31536000; includeSubDomains')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ProbeServer(socketserver.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, delay=0.5):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0), ProbeHandler)
+        self.delay = delay
+        self.requests = []
+        self.redirects = {'/': '/a', '/a': '/b', '/slow': '/slow2'}
+
+
+class TlsScannerTest(unittest.TestCase):
+    """Connect analysis probes"""
+
+    def __init__(self, *args, **kwargs):
+        super(TlsScannerTest, self).__init__(*args, **kwargs)
+
+    def setUp(self):
+        self.server = ProbeServer()
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.base_url = 'http://127.0.0.1:%s' % self.server.server_address[1]
+        self.scanner = TlsScanner()
+
+    def tearDown(self):
+        self.scanner.shutdown()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_redirect_chain(self):
+        probe = self.scanner.probe_chain(self.base_url + '/', timeout=5)
+        self.assertIsNone(probe.first_error)
+        self.assertIsNone(probe.follow_error)
+        self.assertEqual(probe.first.status_code, 301)
+        self.assertEqual(probe.follow_url, self.base_url + '/b')
+
+        # first response loaded once, reused for the redirect following
+        self.assertEqual(self.server.requests, ['/', '/a', '/b'])
+
+    def test_concurrent(self):
+        urls = [self.base_url + '/slow', self.base_url + '/slow3']
+        time_start = time.time()
+        probes = self.scanner.connect_probes(urls, timeout=5, max_duration=10)
+        elapsed = time.time() - time_start
+
+        self.assertEqual(probes[0].follow_url, self.base_url + '/slow2')
+        self.assertEqual(probes[1].follow_url, self.base_url + '/slow3')
+        self.assertLess(elapsed, 3 * self.server.delay)
+
+    def test_deadline(self):
+        time_start = time.time()
+        probes = self.scanner.connect_probes([self.base_url + '/slow', self.base_url + '/a'],
+                                             timeout=5, max_duration=0.7)
+        self.assertLess(time.time() - time_start, 1.5)
+
+        self.assertIn(probes[0].follow_error, [RequestErrorCode.CONNECTION_TIMEOUT, RequestErrorCode.READ_TIMEOUT])
+        self.assertIsNone(probes[0].follow_url)
+        self.assertEqual(probes[1].follow_url, self.base_url + '/b')
+
+    def test_queued(self):
+        # busy executor, probe waiting in the queue does not time out
+        scanner = TlsScanner(probe_workers=1)
+        try:
+            scanner.get_probe_executor().submit(time.sleep, 0.6)
+            probes = scanner.connect_probes([self.base_url + '/a', self.base_url + '/'], timeout=5, max_duration=0.3)
+            self.assertEqual(probes[0].follow_url, self.base_url + '/b')
+            self.assertEqual(probes[1].follow_url, self.base_url + '/b')
+        finally:
+            scanner.shutdown()
+
+    def test_connection_error(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+
+        probe = self.scanner.probe_chain('http://127.0.0.1:%s/' % port, timeout=2)
+        self.assertEqual(probe.first_error, RequestErrorCode.CONNECTION)
+        self.assertEqual(probe.follow_error, RequestErrorCode.CONNECTION)
+        self.assertIsNone(probe.first)
+        self.assertIsNone(probe.follow_url)
+
+
+if __name__ == "__main__":  # pragma: no cover
+    unittest.main()  # pragma: no cover
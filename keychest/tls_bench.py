@@ -0,0 +1,191 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Loopback TLS test server and handshake benchmark.
+
+TlsReplayServer listens on the loopback, reads the ClientHello and replays a recorded server
+response (ServerHello ... ServerHelloDone), so handshakes complete without network access.
+
+Benchmark compares handshakes/sec of the threaded TlsHandshaker path with the asyncio engine:
+
+    python -m keychest.tls_bench --num 2000 --workers 64 --concurrency 1000
+"""
+
+import argparse
+import logging
+import threading
+import time
+
+import concurrent.futures
+import pkg_resources
+from six.moves import socketserver
+
+from keychest.tls_handshake import TlsHandshaker
+from keychest import tls_handshake_async
+
+
+__author__ = 'dusanklinec'
+logger = logging.getLogger(__name__)
+
+
+DEFAULT_RESPONSE = 'keychest.net.resp.bin'
+
+
+def load_test_response(name=DEFAULT_RESPONSE):
+    """
+    Loads recorded server response from the test data
+    :param name:
+    :return:
+    """
+    return pkg_resources.resource_string('keychest.tests', '/'.join(('data', name)))
+
+
+class TlsReplayHandler(socketserver.BaseRequestHandler):
+    """
+    Reads the ClientHello record, replays the response, waits for the client to close
+    """
+
+    def handle(self):
+        self.request.settimeout(self.server.timeout)
+        try:
+            data = b''
+            while len(data) < 5 or len(data) < 5 + ((bytearray(data)[3] << 8) | bytearray(data)[4]):
+                chunk = self.request.recv(8192)
+                if not chunk:
+                    return
+                data += chunk
+
+            self.request.sendall(self.server.response)
+            while self.request.recv(8192):
+                pass
+
+        except Exception as e:
+            logger.debug('Replay server exception: %s' % e)
+
+
+class TlsReplayServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    """
+    Loopback server replaying recorded TLS handshake response
+    """
+    allow_reuse_address = True
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, response=None, host='127.0.0.1', port=0, timeout=10):
+        socketserver.TCPServer.__init__(self, (host, port), TlsReplayHandler)
+        self.response = response if response is not None else load_test_response()
+        self.timeout = timeout
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server_address[1]
+
+    def start(self):
+        """
+        Starts serving in the background thread
+        :return:
+        """
+        self.thread = threading.Thread(target=self.serve_forever, args=())
+        self.thread.setDaemon(True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stops the server
+        :return:
+        """
+        self.shutdown()
+        self.server_close()
+
+
+def bench_threaded(port, num, workers, domain='keychest.net', host='127.0.0.1'):
+    """
+    Threaded handshakes, one OS thread per in-flight handshake
+    :param port:
+    :param num:
+    :param workers:
+    :param domain:
+    :param host:
+    :return: (num of successful handshakes, duration)
+    """
+    tester = TlsHandshaker(timeout=10, attempts=1)
+    time_start = time.time()
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(tester.handshake, host, port, domain=domain) for _ in range(num)]
+        num_ok = 0
+        for future in futures:
+            try:
+                num_ok += 1 if len(future.result().certificates) > 0 else 0
+            except Exception as e:
+                logger.debug('Handshake failed: %s' % e)
+
+    return num_ok, time.time() - time_start
+
+
+def bench_async(port, num, concurrency, domain='keychest.net', host='127.0.0.1'):
+    """
+    Async handshakes on the single event loop
+    :param port:
+    :param num:
+    :param concurrency:
+    :param domain:
+    :param host:
+    :return: (num of successful handshakes, duration)
+    """
+    tester = tls_handshake_async.AsyncTlsHandshaker(timeout=10, attempts=1)
+    time_start = time.time()
+    results = tester.run_many([(host, port)] * num, max_concurrency=concurrency, domain=domain)
+    num_ok = len([x for x in results if not isinstance(x, Exception) and len(x.certificates) > 0])
+    return num_ok, time.time() - time_start
+
+
+def bench_main():
+    """
+    Benchmark entry point
+    :return:
+    """
+    parser = argparse.ArgumentParser(description='TLS handshake benchmark on the loopback replay server')
+
+    parser.add_argument('--num', dest='num', default=1000, type=int,
+                        help='Number of handshakes')
+
+    parser.add_argument('--workers', dest='workers', default=32, type=int,
+                        help='Number of threads for the threaded handshaker')
+
+    parser.add_argument('--concurrency', dest='concurrency', default=500, type=int,
+                        help='Number of in-flight handshakes for the async handshaker')
+
+    parser.add_argument('--response', dest='response', default=None,
+                        help='File with recorded server response to replay')
+
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    response = None
+    if args.response:
+        with open(args.response, 'rb') as fh:
+            response = fh.read()
+
+    server = TlsReplayServer(response=response).start()
+    try:
+        num_ok, duration = bench_threaded(server.port, args.num, args.workers)
+        print('Threaded: %d/%d handshakes in %.3f s, %.1f handshakes/sec'
+              % (num_ok, args.num, duration, num_ok / duration))
+
+        if tls_handshake_async.asyncio is None:
+            print('Async: asyncio not available')
+            return
+
+        num_ok, duration = bench_async(server.port, args.num, args.concurrency)
+        print('Async:    %d/%d handshakes in %.3f s, %.1f handshakes/sec'
+              % (num_ok, args.num, duration, num_ok / duration))
+
+    finally:
+        server.stop()
+
+
+if __name__ == '__main__':
+    bench_main()
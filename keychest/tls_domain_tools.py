@@ -100,6 +100,87 @@ class TargetUrl(object):
         return TlsDomainTools.assemble_url(self.scheme, self.host, self.port)
 
 
+class SubstringAutomaton(object):
+    """
+    Aho-Corasick automaton for the substring search of a fixed pattern set.
+    Compiled to the DFA, the text is scanned once regardless of the number of patterns.
+    Returns the index of the first pattern (in the input order) occurring in the text.
+    """
+    def __init__(self, patterns=None):
+        """
+        :param patterns: list of substrings, the list order is the match priority
+        """
+        self.goto = [{}]  # state -> {char: state}, complete DFA transitions, missing char -> root
+        self.out = [None]  # state -> lowest pattern index ending in the state or its suffix states
+        if patterns is not None:
+            self.build(patterns)
+
+    def build(self, patterns):
+        """
+        Builds the automaton
+        :param patterns:
+        :return:
+        """
+        trie = [{}]
+        out = [None]
+        for idx, pattern in enumerate(patterns):
+            state = 0
+            for ch in pattern:
+                nxt = trie[state].get(ch)
+                if nxt is None:
+                    nxt = len(trie)
+                    trie[state][ch] = nxt
+                    trie.append({})
+                    out.append(None)
+                state = nxt
+            if out[state] is None:
+                out[state] = idx
+
+        # BFS, failure links, output merging and DFA transitions
+        fail = [0] * len(trie)
+        goto = [None] * len(trie)
+        goto[0] = dict(trie[0])
+        queue = [0]
+        pos = 0
+        while pos < len(queue):
+            state = queue[pos]
+            pos += 1
+
+            if goto[state] is None:
+                goto[state] = dict(goto[fail[state]])
+                goto[state].update(trie[state])
+
+            for ch, nxt in trie[state].items():
+                fail[nxt] = goto[fail[state]].get(ch, 0) if state != 0 else 0
+                fail_out = out[fail[nxt]]
+                if fail_out is not None and (out[nxt] is None or fail_out < out[nxt]):
+                    out[nxt] = fail_out
+                queue.append(nxt)
+
+        # transitions to the root are implicit
+        self.goto = [dict((ch, nxt) for ch, nxt in x.items() if nxt != 0) for x in goto]
+        self.out = out
+
+    def search(self, text):
+        """
+        Returns the lowest index of the pattern occurring in the text, None if there is none
+        :param text:
+        :return:
+        """
+        goto = self.goto
+        out = self.out
+        best = out[0]
+        state = 0
+        for ch in text:
+            state = goto[state].get(ch, 0)
+            found = out[state]
+            if found is not None and (best is None or found < best):
+                best = found
+                if best == 0:
+                    break
+        return best
+
+
 class CnameCDNClassifier(object):
     """
     Cname -> CDN classifier.
@@ -109,6 +190,7 @@ class CnameCDNClassifier(object):
         Init
         """
         self.db = None
+        self.automaton = None
 
     def init(self):
         """
@@ -128,6 +210,7 @@ class CnameCDNClassifier(object):
 
         self.db = json.loads(util.to_string(data_file))
         self.db = sorted(self.db, key=lambda x: -1*len(x[1]))  # sort by the longest substring (longest match first)
+        self.automaton = SubstringAutomaton([util.to_string(x[0]) for x in self.db])
 
     def classify_cname(self, cname):
         """
@@ -141,11 +224,8 @@ class CnameCDNClassifier(object):
         if self.db is None:
             raise ValueError('Database not initialized')
 
-        for subs, cdn in self.db:
-            if util.contains(cname, subs):
-                return cdn
-
-        return None
+        idx = self.automaton.search(util.to_string(cname))
+        return self.db[idx][1] if idx is not None else None
 
 
 class TlsDomainTools(object):
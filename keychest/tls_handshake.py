@@ -4,8 +4,12 @@
 import base64
 import json
 import logging
+import os
+import struct
+import threading
 
 import coloredlogs
+import pylru
 
 try:
     import scapy.all as scapy
@@ -23,6 +27,7 @@ from keychest import errors
 from keychest import trace_logger
 from keychest import util
 from keychest.tls_domain_tools import TlsDomainTools
+from keychest.tls_record_parser import TlsRecordParser
 
 logger = logging.getLogger(__name__)
 
@@ -117,9 +122,9 @@ class TlsHandshakeResult(object):
         self.time_failed = None
         self.tls_version = None
 
-        self.cl_hello = None
+        self.cl_hello = None  # raw ClientHello record
         self.resp_bin = None
-        self.resp_record = None
+        self._resp_record = None
 
         self.dns_failure = False
         self.handshake_failure = False
@@ -127,6 +132,20 @@ class TlsHandshakeResult(object):
         self.cipher_suite = None
         self.certificates = []
 
+    @property
+    def resp_record(self):
+        """
+        Scapy dissection of the response, parsed lazily - not needed on the scanning path
+        :return:
+        """
+        if self._resp_record is None and self.resp_bin:
+            self._resp_record = TLS(self.resp_bin)
+        return self._resp_record
+
+    @resp_record.setter
+    def resp_record(self, val):
+        self._resp_record = val
+
     def __repr__(self):
         return '<TlsHandshakeResult(time_start=%r, time_connected=%r, time_sent=%r, time_finished=%r, failure=%r, ' \
                'dns_failure=%r, cipher_suite=%r, certificates_len=%r, ip=%r, socket=%r)>' \
@@ -181,12 +200,78 @@ bind_layers(TLSExtension, TLSExt4a4a, {'type': 0x4a4a})
 bind_layers(TLSExtension, TLSExtExtendedMasterSecret, {'type': 0x0017})
 
 
+class ClientHelloTemplate(object):
+    """
+    Serialized ClientHello record split around the SNI extension.
+    Builds the raw hello for a new SNI and client random by byte patching, without scapy.
+    """
+    OFF_RECORD_LEN = 3
+    OFF_HANDSHAKE_LEN = 6
+    OFF_RANDOM = 11
+    RANDOM_LEN = 32
+    EXT_SNI = 0
+
+    def __init__(self, raw):
+        self.raw = bytes(raw)
+        self.prefix = None
+        self.suffix = None
+        self.ext_len_off = None
+        self._split()
+
+    def _split(self):
+        """
+        Finds the extensions block and the SNI extension in the serialized record
+        :return:
+        """
+        data = bytearray(self.raw)
+        pos = self.OFF_RANDOM + self.RANDOM_LEN
+        pos += 1 + data[pos]  # session id
+        pos += 2 + struct.unpack('!H', self.raw[pos:pos + 2])[0]  # cipher suites
+        pos += 1 + data[pos]  # compression methods
+
+        self.ext_len_off = pos
+        pos += 2
+        while pos + 4 <= len(data):
+            ext_type, ext_len = struct.unpack('!HH', self.raw[pos:pos + 4])
+            if ext_type == self.EXT_SNI:
+                self.prefix = self.raw[:pos]
+                self.suffix = self.raw[pos + 4 + ext_len:]
+                return
+            pos += 4 + ext_len
+
+        raise ValueError('SNI extension not found in the ClientHello')
+
+    def build(self, hostnames, client_random=None):
+        """
+        Builds the raw ClientHello record for the given SNI names
+        :param hostnames: list of server names
+        :param client_random: 32 B client random, generated if None
+        :return:
+        """
+        names = b''.join([struct.pack('!BH', 0, len(x)) + x for x in [util.to_bytes(x) for x in hostnames]])
+        sni = struct.pack('!HHH', self.EXT_SNI, len(names) + 2, len(names)) + names
+        if client_random is None:
+            client_random = struct.pack('!I', int(time.time())) + os.urandom(self.RANDOM_LEN - 4)
+
+        data = bytearray(self.prefix + sni + self.suffix)
+        data[self.OFF_RANDOM:self.OFF_RANDOM + self.RANDOM_LEN] = client_random
+        data[self.OFF_RECORD_LEN:self.OFF_RECORD_LEN + 2] = struct.pack('!H', len(data) - 5)
+        data[self.OFF_HANDSHAKE_LEN:self.OFF_HANDSHAKE_LEN + 3] = struct.pack('!I', len(data) - 9)[1:]
+        data[self.ext_len_off:self.ext_len_off + 2] = struct.pack('!H', len(data) - self.ext_len_off - 2)
+        return bytes(data)
+
+
 class TlsHandshaker(object):
     """
     Object performing simple TLS handshake, parsing the results
     """
     DEFAULT_TLS = "TLS_1_2"
     DEFAULT_ATTEMPTS = 3
+    HELLO_CACHE_SIZE = 32
+
+    # ClientHello templates shared by all handshakers, (tls_ver, ecc) -> ClientHelloTemplate
+    hello_cache = pylru.lrucache(HELLO_CACHE_SIZE)
+    hello_cache_lock = threading.Lock()
 
     def __init__(self, timeout=10, tls_version=None, attempts=None, **kwargs):
         self.timeout = timeout
@@ -324,6 +409,39 @@ class TlsHandshaker(object):
             p = TLSRecord(content_type=TLSContentType.HANDSHAKE) / TLSHandshake() / cl_hello
         return p
 
+    def _get_hello_template(self, tls_ver, ecc=None):
+        """
+        Returns cached ClientHello template for the TLS version and cipher profile
+        :param tls_ver:
+        :param ecc:
+        :return:
+        :rtype ClientHelloTemplate
+        """
+        key = (tls_ver, ecc)
+        with self.hello_cache_lock:
+            if key in self.hello_cache:
+                return self.hello_cache[key]
+
+        # build outside the lock, scapy is slow. Concurrent build of the same template is harmless.
+        template = ClientHelloTemplate(bytes(self._build_client_hello('localhost', tls_ver, ecc=ecc)))
+        with self.hello_cache_lock:
+            self.hello_cache[key] = template
+        return template
+
+    def _build_client_hello_bytes(self, hostname, tls_ver, ecc=None, **kwargs):
+        """
+        Builds serialized client hello record from the cached template.
+        Fresh client random is generated for each hello.
+        :param hostname:
+        :param tls_ver:
+        :param ecc:
+        :param kwargs:
+        :return:
+        """
+        if not isinstance(hostname, list):
+            hostname = [hostname]
+        return self._get_hello_template(tls_ver, ecc=ecc).build(hostname)
+
     def try_handshake(self, host, port=443, attempts=None, sleep_fnc=None, **kwargs):
         """
         Attempts for handshake
@@ -357,24 +475,12 @@ class TlsHandshaker(object):
         :return:
         :rtype TlsHandshakeResult
         """
-        return_obj = TlsHandshakeResult()
-        return_obj.connect_target = (host, port)
-        tls_ver = kwargs.get('tls_version', self.tls_version)
-        domain_sni = util.defval(kwargs.get('domain', host), host)
+        return_obj = self._init_result(host, port, **kwargs)
+        tls_ver = return_obj.tls_version
+        domain_sni = return_obj.domain
         timeout = float(kwargs.get('timeout', self.timeout))
 
-        return_obj.tls_version = tls_ver
-        return_obj.host = host
-        return_obj.port = port
-        return_obj.domain = domain_sni
-        return_obj.socket_family = socket.AF_INET
-
-        if TlsDomainTools.is_ip(host):
-            return_obj.ip = host
-
-            if TlsDomainTools.is_valid_ipv6_address(host):
-                return_obj.socket_family = socket.AF_INET6
-        else:
+        if return_obj.ip is None:
             self._resolve_ip(return_obj)
 
         # create simple tcp socket
@@ -399,17 +505,13 @@ class TlsHandshaker(object):
 
                 raise TlsTimeout('Connect timeout on %s - %s' % (return_obj.connect_target, domain_sni), e, scan_result=return_obj)
 
-            cl_hello = self._build_client_hello(domain_sni, tls_ver, **kwargs)
-            return_obj.cl_hello = cl_hello
+            hello_packet = self._build_client_hello_bytes(domain_sni, tls_ver, **kwargs)
+            return_obj.cl_hello = hello_packet
 
-            hello_packet = bytes(cl_hello)
             s.sendall(hello_packet)
             return_obj.time_sent = time.time()
 
             self._read_while_finished(return_obj, s, timeout)
-
-            return_obj.certificates = self._extract_certificates(return_obj.resp_record)
-
             return return_obj
 
         except TlsTimeout:
@@ -425,6 +527,32 @@ class TlsHandshaker(object):
         finally:
             util.silent_close(s)
 
+    def _init_result(self, host, port=443, **kwargs):
+        """
+        Creates the handshake result object for the target.
+        IP is set only if the host is an IP address, otherwise it has to be resolved.
+        :param host:
+        :param port:
+        :param kwargs:
+        :return:
+        :rtype TlsHandshakeResult
+        """
+        return_obj = TlsHandshakeResult()
+        return_obj.connect_target = (host, port)
+        return_obj.tls_version = kwargs.get('tls_version', self.tls_version)
+        return_obj.host = host
+        return_obj.port = port
+        return_obj.domain = util.defval(kwargs.get('domain', host), host)
+        return_obj.socket_family = socket.AF_INET
+
+        if TlsDomainTools.is_ip(host):
+            return_obj.ip = host
+
+            if TlsDomainTools.is_valid_ipv6_address(host):
+                return_obj.socket_family = socket.AF_INET6
+
+        return return_obj
+
     def _resolve_ip(self, res):
         """
         Resolves IP address of the target
@@ -433,20 +561,38 @@ class TlsHandshaker(object):
         """
         try:
             results = socket.getaddrinfo(res.host, res.port, 0, socket.SOCK_STREAM, socket.IPPROTO_TCP)
-            if len(results) == 0:
-                raise errors.Error('DNS returned empty result')
-
-            res.dns_results = results
-            res.connect_target = results[0][4]
-            res.socket_family = results[0][0]
+            self._set_resolved(res, results)
 
         except Exception as e:
-            res.dns_failure = e
-            res.handshake_failure = TlsHandshakeErrors.GAI_ERROR
-            res.socket_family = None
-            res.connect_target = None
+            self._set_resolution_error(res, e)
+
+    def _set_resolved(self, res, results):
+        """
+        Sets the connect target from the getaddrinfo results
+        :param res:
+        :param results:
+        :return:
+        """
+        if len(results) == 0:
+            raise errors.Error('DNS returned empty result')
+
+        res.dns_results = results
+        res.connect_target = results[0][4]
+        res.socket_family = results[0][0]
 
-            raise TlsResolutionError('DNS resolution error on %s - %s' % (res.host, res.domain), e, scan_result=res)
+    def _set_resolution_error(self, res, e):
+        """
+        Marks the result as DNS failed, raises TlsResolutionError
+        :param res:
+        :param e:
+        :return:
+        """
+        res.dns_failure = e
+        res.handshake_failure = TlsHandshakeErrors.GAI_ERROR
+        res.socket_family = None
+        res.connect_target = None
+
+        raise TlsResolutionError('DNS resolution error on %s - %s' % (res.host, res.domain), e, scan_result=res)
 
     def _try_get_peer_ip(self, s):
         """
@@ -466,57 +612,81 @@ class TlsHandshaker(object):
         :param s: 
         :return: 
         """
+        parser = TlsRecordParser()
         resp_bin_acc = []
-        resp_bin_tot = ''
         read_more = True
         while read_more:
             resp_bin = self._recv_timeout(s, timeout=timeout, single_read=True)
             if len(resp_bin) == 0:
                 read_more = False
 
-            if not read_more and len(resp_bin_tot) == 0:  # no data received at all -> timeout
-                    return_obj.handshake_failure = TlsHandshakeErrors.READ_TO
-                    return_obj.time_failed = time.time()
-                    raise TlsTimeout('Could not read any data', scan_result=return_obj)
+            if not read_more and parser.num_bytes == 0:  # no data received at all -> timeout
+                self._set_read_timeout(return_obj)
 
             resp_bin_acc.append(resp_bin)
-            # resp_bin_tot = util.join_buff(resp_bin_acc)
-            resp_bin_tot = b''.join(resp_bin_acc)
-
-            try:
-                # rec = SSL(resp_bin_tot)
-                rec = TLS(resp_bin_tot)
-
-                return_obj.resp_record = rec
-
-                alert_record = self._get_failure(rec)
-                if alert_record is not None:
-                    return_obj.handshake_failure = TlsHandshakeErrors.HANDSHAKE_ERR
-                    return_obj.time_failed = time.time()
-                    return_obj.alert = TlsHandshakeAlert(level=alert_record.level, desc=alert_record.description, alert=alert_record)
-                    raise TlsHandshakeAbort('Handshake alert received: %s' % return_obj.alert, scan_result=return_obj)
-
-                if self._test_hello_done(rec):
-                    break
-                elif not read_more:
-                    return_obj.handshake_failure = TlsHandshakeErrors.NO_TLS
-                    return_obj.time_failed = time.time()
-                    raise TlsHandshakeFailure('No TLS termination', scan_result=return_obj)
-
-            except TlsIncomplete as e:
-                logger.debug(e)
-                if not read_more:
-                    raise
+            if self._process_response(return_obj, parser, resp_bin, final=not read_more):
+                break
 
-            except TlsHandshakeAbort:
-                raise
+        self._set_finished(return_obj, parser, b''.join(resp_bin_acc))
+        return return_obj
 
-            except TlsHandshakeFailure:
-                raise
+    def _set_read_timeout(self, return_obj):
+        """
+        Marks the result as read timeouted - no data received at all, raises TlsTimeout
+        :param return_obj:
+        :return:
+        """
+        return_obj.handshake_failure = TlsHandshakeErrors.READ_TO
+        return_obj.time_failed = time.time()
+        raise TlsTimeout('Could not read any data', scan_result=return_obj)
 
+    def _set_finished(self, return_obj, parser, resp_bin_tot):
+        """
+        Marks the result as finished with the complete response
+        :param return_obj:
+        :param parser:
+        :type parser: TlsRecordParser
+        :param resp_bin_tot:
+        :return:
+        """
         return_obj.resp_bin = resp_bin_tot
         return_obj.time_finished = time.time()
-        return return_obj
+        return_obj.cipher_suite = parser.cipher_suite
+        return_obj.certificates = list(parser.certificates)
+
+    def _process_response(self, return_obj, parser, data, final=False):
+        """
+        Feeds next chunk of the response to the streaming parser.
+        Raises TlsHandshakeAbort on fatal alert, TlsHandshakeFailure / TlsIncomplete
+        if the response is not TLS or is not complete and no more data is coming.
+
+        :param return_obj:
+        :param parser:
+        :type parser: TlsRecordParser
+        :param data: newly received data
+        :param final: True if no more data will be received
+        :return: True if the server hello is done
+        """
+        parser.feed(data)
+
+        if parser.alert is not None:
+            return_obj.handshake_failure = TlsHandshakeErrors.HANDSHAKE_ERR
+            return_obj.time_failed = time.time()
+            return_obj.alert = TlsHandshakeAlert(level=parser.alert[0], desc=parser.alert[1])
+            raise TlsHandshakeAbort('Handshake alert received: %s' % return_obj.alert, scan_result=return_obj)
+
+        if parser.hello_done:
+            return True
+
+        if parser.invalid or final:
+            if not parser.invalid and parser.pending:
+                raise TlsIncomplete('Incomplete TLS record', scan_result=return_obj)
+
+            return_obj.handshake_failure = TlsHandshakeErrors.NO_TLS
+            return_obj.time_failed = time.time()
+            raise TlsHandshakeFailure('No TLS termination', scan_result=return_obj)
+
+        return False
 
     def _search_payload(self, payload):
         """
@@ -632,8 +802,17 @@ class TlsHandshaker(object):
         Reading data from the socket with timeout (multiple packet read)
         :param the_socket: 
         :param timeout: 
+        :param single_read: returns the first chunk received, empty on timeout or closed connection
         :return: 
         """
+        if single_read:
+            # blocking read with timeout, no polling
+            try:
+                the_socket.settimeout(timeout)
+                return the_socket.recv(8192)
+            except (socket.timeout, socket.error):
+                return b''
+
         # make socket non blocking
         the_socket.setblocking(0)
 
@@ -0,0 +1,370 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Asynchronous TLS handshake engine.
+
+Performs the same handshake as TlsHandshaker - same ClientHello, same streaming response parsing
+and certificate extraction, same TlsHandshakeResult and TlsHandshakeErrors - but on the asyncio
+event loop, so thousands of handshakes can be in flight on a single thread.
+
+Written with callbacks (no async / yield from syntax) so the module works on Python 2 with trollius.
+"""
+
+import logging
+import socket
+import time
+
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+
+# ensure_future was called async before Python 3.4.4 / trollius 2.0
+_ensure_future = getattr(asyncio, 'ensure_future', None) or getattr(asyncio, 'async', None)
+
+from keychest import errors
+from keychest import util
+from keychest.tls_handshake import TlsHandshaker, TlsHandshakeErrors, TlsTimeout, TlsIncomplete, TlsException
+from keychest.tls_record_parser import TlsRecordParser
+
+
+__author__ = 'dusanklinec'
+logger = logging.getLogger(__name__)
+
+
+_ProtocolBase = asyncio.Protocol if asyncio is not None else object
+
+
+class TlsHandshakeProtocol(_ProtocolBase):
+    """
+    Protocol performing one handshake on the established connection.
+    Sends the ClientHello, accumulates the response until the server hello is done.
+    Read timeout is reset with each received chunk, as in TlsHandshaker._recv_timeout.
+    """
+
+    def __init__(self, handshaker, return_obj, hello_packet, timeout, future, loop):
+        self.handshaker = handshaker  # type: AsyncTlsHandshaker
+        self.return_obj = return_obj
+        self.hello_packet = hello_packet
+        self.timeout = timeout
+        self.future = future
+        self.loop = loop
+
+        self.transport = None
+        self.timer = None
+        self.parser = TlsRecordParser()
+        self.resp_bin_acc = []
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.return_obj.time_connected = time.time()
+        peer = transport.get_extra_info('peername')
+        if peer:
+            self.return_obj.ip = util.defval(peer[0], self.return_obj.ip)
+
+        transport.write(self.hello_packet)
+        self.return_obj.time_sent = time.time()
+        self._reset_timer()
+
+    def data_received(self, data):
+        if self.future.done():
+            return
+
+        self.resp_bin_acc.append(data)
+        self._reset_timer()
+        self._process(data, final=False)
+
+    def eof_received(self):
+        self._finish_read()
+        return False
+
+    def connection_lost(self, exc):
+        self._finish_read()
+
+    def _reset_timer(self):
+        """
+        Restarts read timeout timer
+        :return:
+        """
+        if self.timer is not None:
+            self.timer.cancel()
+        self.timer = self.loop.call_later(self.timeout, self._finish_read)
+
+    def _finish_read(self):
+        """
+        No more data is coming - timeout or EOF.
+        :return:
+        """
+        if self.future.done():
+            return
+
+        if len(self.resp_bin_acc) == 0:
+            try:
+                self.handshaker._set_read_timeout(self.return_obj)
+            except Exception as e:
+                self._done(exc=e)
+            return
+
+        self._process(b'', final=True)
+
+    def _process(self, data, final=False):
+        """
+        Feeds the received data to the parser, resolves the future when done
+        :param data:
+        :param final:
+        :return:
+        """
+        try:
+            if not self.handshaker._process_response(self.return_obj, self.parser, data, final=final):
+                return
+
+            self.handshaker._set_finished(self.return_obj, self.parser, b''.join(self.resp_bin_acc))
+            self._done(result=self.return_obj)
+
+        except Exception as e:
+            self._done(exc=self.handshaker._wrap_exception(self.return_obj, e))
+
+    def _done(self, result=None, exc=None):
+        """
+        Resolves the handshake future, closes the connection
+        :param result:
+        :param exc:
+        :return:
+        """
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        if self.transport is not None:
+            self.transport.close()
+
+        if self.future.done():
+            return
+
+        if exc is not None:
+            self.future.set_exception(exc)
+        else:
+            self.future.set_result(result)
+
+
+class AsyncTlsHandshaker(TlsHandshaker):
+    """
+    TLS handshaker running on the asyncio event loop.
+    Handshake methods return futures resolving to TlsHandshakeResult or failing with
+    the same exceptions as TlsHandshaker.handshake.
+    """
+
+    def __init__(self, timeout=10, tls_version=None, attempts=None, loop=None, **kwargs):
+        super(AsyncTlsHandshaker, self).__init__(timeout=timeout, tls_version=tls_version, attempts=attempts, **kwargs)
+        if asyncio is None:
+            raise errors.Error('asyncio is not available')
+        self.loop = loop
+
+    def _get_loop(self, loop=None):
+        """
+        Returns the loop to use
+        :param loop:
+        :return:
+        """
+        if loop is not None:
+            return loop
+        if self.loop is not None:
+            return self.loop
+        return asyncio.get_event_loop()
+
+    def _wrap_exception(self, return_obj, e):
+        """
+        Maps exception to the one TlsHandshaker.handshake would raise
+        :param return_obj:
+        :param e:
+        :return:
+        """
+        if isinstance(e, (TlsTimeout, TlsIncomplete)):
+            return e
+
+        logger.debug('Generic exception on tls scan %s' % e)
+        self.trace_logger.log(e)
+        return TlsException('Generic exception', e, scan_result=return_obj)
+
+    def handshake_async(self, host, port=443, loop=None, **kwargs):
+        """
+        Starts the handshake on the event loop
+        :param host:
+        :param port:
+        :param loop:
+        :param kwargs:
+        :return: future of TlsHandshakeResult
+        """
+        loop = self._get_loop(loop)
+        future = asyncio.Future(loop=loop)
+        timeout = float(kwargs.get('timeout', self.timeout))
+
+        try:
+            return_obj = self._init_result(host, port, **kwargs)
+            hello_packet = self._build_client_hello_bytes(return_obj.domain, return_obj.tls_version, **kwargs)
+            return_obj.cl_hello = hello_packet
+
+        except Exception as e:
+            future.set_exception(self._wrap_exception(None, e))
+            return future
+
+        def on_resolved(res_future):
+            try:
+                self._set_resolved(return_obj, res_future.result())
+            except Exception as e:
+                try:
+                    self._set_resolution_error(return_obj, e)
+                except Exception as ex:
+                    future.set_exception(ex)
+                return
+
+            self._connect(loop, future, return_obj, hello_packet, timeout)
+
+        if return_obj.ip is None:
+            res_future = _ensure_future(
+                loop.getaddrinfo(host, port, proto=socket.IPPROTO_TCP, type=socket.SOCK_STREAM), loop=loop)
+            res_future.add_done_callback(on_resolved)
+        else:
+            self._connect(loop, future, return_obj, hello_packet, timeout)
+
+        return future
+
+    def _connect(self, loop, future, return_obj, hello_packet, timeout):
+        """
+        Connects to the resolved target, protocol takes over after connect
+        :param loop:
+        :param future:
+        :param return_obj:
+        :param hello_packet:
+        :param timeout:
+        :return:
+        """
+        host, port = return_obj.connect_target[0], return_obj.connect_target[1]
+        logger.debug('Connecting to: %s, %s, %s' % (return_obj.connect_target, return_obj.host, return_obj.domain))
+
+        return_obj.time_start = time.time()
+        conn_future = _ensure_future(
+            loop.create_connection(
+                lambda: TlsHandshakeProtocol(self, return_obj, hello_packet, timeout, future, loop),
+                host=host, port=port, family=return_obj.socket_family), loop=loop)
+        conn_timer = loop.call_later(timeout, conn_future.cancel)
+
+        def on_connected(conn_future):
+            conn_timer.cancel()
+            if not conn_future.cancelled() and conn_future.exception() is None:
+                return
+
+            e = conn_future.exception() if not conn_future.cancelled() else socket.timeout('timed out')
+            logger.debug('Exception during connect %s - %s: %s' % (return_obj.connect_target, return_obj.domain, e))
+            self.trace_logger.log(e)
+            return_obj.handshake_failure = TlsHandshakeErrors.CONN_ERR
+            return_obj.time_failed = time.time()
+
+            if not future.done():
+                future.set_exception(TlsTimeout('Connect timeout on %s - %s'
+                                                % (return_obj.connect_target, return_obj.domain),
+                                                e, scan_result=return_obj))
+
+        conn_future.add_done_callback(on_connected)
+
+    def try_handshake_async(self, host, port=443, attempts=None, sleep_fnc=None, loop=None, **kwargs):
+        """
+        Attempts for handshake, retries with a delay on failure
+        :param host:
+        :param port:
+        :param attempts:
+        :param sleep_fnc:
+        :param loop:
+        :param kwargs:
+        :return: future of TlsHandshakeResult
+        """
+        loop = self._get_loop(loop)
+        attempts = util.defval(attempts, self.attempts)
+        future = asyncio.Future(loop=loop)
+
+        def attempt_start(attempt):
+            sub = self.handshake_async(host=host, port=port, loop=loop, **kwargs)
+            sub.add_done_callback(lambda x: attempt_done(attempt, x))
+
+        def attempt_done(attempt, sub):
+            e = sub.exception()
+            if e is None:
+                future.set_result(sub.result())
+                return
+
+            logger.debug('Exception on handshake[%s]: %s' % (attempt, e))
+            if attempt + 1 >= attempts:
+                future.set_exception(e)
+                return
+
+            delay = sleep_fnc(attempt) if sleep_fnc is not None else 0.5
+            loop.call_later(delay, attempt_start, attempt + 1)
+
+        attempt_start(0)
+        return future
+
+    def handshake_many(self, targets, max_concurrency=1000, loop=None, **kwargs):
+        """
+        Runs handshakes for all targets with bounded concurrency.
+        :param targets: list of (host, port) or (host, port, kwargs)
+        :param max_concurrency: maximum number of handshakes in flight
+        :param loop:
+        :param kwargs: common handshake arguments
+        :return: future of list, TlsHandshakeResult or exception for each target, in order
+        """
+        loop = self._get_loop(loop)
+        future = asyncio.Future(loop=loop)
+        targets = list(targets)
+        results = [None] * len(targets)
+        state = {'next': 0, 'pending': 0}
+
+        if len(targets) == 0:
+            future.set_result(results)
+            return future
+
+        def start_next():
+            while state['next'] < len(targets) and state['pending'] < max_concurrency:
+                idx = state['next']
+                state['next'] += 1
+                state['pending'] += 1
+
+                target = targets[idx]
+                cur_kwargs = dict(kwargs)
+                if len(target) > 2:
+                    cur_kwargs.update(target[2])
+
+                sub = self.try_handshake_async(target[0], target[1], loop=loop, **cur_kwargs)
+                sub.add_done_callback(lambda x, idx=idx: on_done(idx, x))
+
+        def on_done(idx, sub):
+            state['pending'] -= 1
+            e = sub.exception()
+            results[idx] = e if e is not None else sub.result()
+
+            if state['next'] >= len(targets) and state['pending'] == 0:
+                future.set_result(results)
+            else:
+                start_next()
+
+        start_next()
+        return future
+
+    def run_many(self, targets, max_concurrency=1000, **kwargs):
+        """
+        Runs handshakes for all targets on a new event loop, blocks until done.
+        Callable from a worker thread.
+        :param targets:
+        :param max_concurrency:
+        :param kwargs:
+        :return: list of TlsHandshakeResult or exceptions
+        """
+        loop = asyncio.new_event_loop()
+        try:
+            return loop.run_until_complete(
+                self.handshake_many(targets, max_concurrency=max_concurrency, loop=loop, **kwargs))
+        finally:
+            loop.close()
@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Incremental TLS record and handshake message parser for the server handshake flight.
+
+Consumes the response bytes as they arrive, reassembles handshake messages spanning
+multiple records and stops at ServerHelloDone or a fatal alert.
+Certificates are extracted as raw DER without scapy dissection.
+"""
+
+import logging
+import struct
+
+
+__author__ = 'dusanklinec'
+logger = logging.getLogger(__name__)
+
+
+class TlsRecordParser(object):
+    """
+    Streaming parser of the server response to the ClientHello
+    """
+    CT_CHANGE_CIPHER_SPEC = 20
+    CT_ALERT = 21
+    CT_HANDSHAKE = 22
+    CT_APPLICATION_DATA = 23
+    CT_HEARTBEAT = 24
+
+    HS_SERVER_HELLO = 2
+    HS_CERTIFICATE = 11
+    HS_SERVER_HELLO_DONE = 14
+
+    ALERT_FATAL = 2
+    RECORD_HEADER_LEN = 5
+    MAX_RECORD_LEN = 2**14 + 2048
+
+    def __init__(self):
+        self.buffer = bytearray()  # unprocessed record bytes
+        self.hs_buffer = bytearray()  # handshake messages reassembly
+        self.num_records = 0
+        self.num_bytes = 0
+
+        self.invalid = False  # not a TLS stream
+        self.hello_done = False
+        self.alert = None  # (level, description) of the fatal alert
+        self.server_version = None
+        self.cipher_suite = None
+        self.certificates = []
+
+    @property
+    def done(self):
+        """
+        True if no more data is needed
+        :return:
+        """
+        return self.hello_done or self.alert is not None or self.invalid
+
+    @property
+    def pending(self):
+        """
+        True if there is a partially received record or handshake message
+        :return:
+        """
+        return len(self.buffer) > 0 or len(self.hs_buffer) > 0
+
+    def feed(self, data):
+        """
+        Consumes next chunk of the response
+        :param data:
+        :return: True if done
+        """
+        if self.done:
+            return True
+
+        self.num_bytes += len(data)
+        self.buffer += data
+
+        while not self.done and len(self.buffer) >= self.RECORD_HEADER_LEN:
+            content_type = self.buffer[0]
+            major = self.buffer[1]
+            length = (self.buffer[3] << 8) | self.buffer[4]
+
+            if content_type < self.CT_CHANGE_CIPHER_SPEC or content_type > self.CT_HEARTBEAT \
+                    or major != 3 or length > self.MAX_RECORD_LEN:
+                self.invalid = True
+                break
+
+            end = self.RECORD_HEADER_LEN + length
+            if len(self.buffer) < end:
+                break
+
+            fragment = self.buffer[self.RECORD_HEADER_LEN:end]
+            del self.buffer[:end]
+            self.num_records += 1
+            self._process_record(content_type, fragment)
+
+        return self.done
+
+    def _process_record(self, content_type, fragment):
+        """
+        Processes one complete record
+        :param content_type:
+        :param fragment:
+        :return:
+        """
+        if content_type == self.CT_ALERT:
+            # alert is 2 B, level, description. Only fatal alerts terminate the handshake.
+            for idx in range(0, len(fragment) - 1, 2):
+                if fragment[idx] == self.ALERT_FATAL:
+                    self.alert = (fragment[idx], fragment[idx + 1])
+                    return
+
+        elif content_type == self.CT_HANDSHAKE:
+            self.hs_buffer += fragment
+            self._process_handshakes()
+
+    def _process_handshakes(self):
+        """
+        Processes all complete handshake messages in the reassembly buffer
+        :return:
+        """
+        while not self.done and len(self.hs_buffer) >= 4:
+            hs_type = self.hs_buffer[0]
+            length = (self.hs_buffer[1] << 16) | (self.hs_buffer[2] << 8) | self.hs_buffer[3]
+            if len(self.hs_buffer) < 4 + length:
+                return
+
+            body = bytes(self.hs_buffer[4:4 + length])
+            del self.hs_buffer[:4 + length]
+
+            if hs_type == self.HS_SERVER_HELLO:
+                self._process_server_hello(body)
+            elif hs_type == self.HS_CERTIFICATE:
+                self._process_certificate(body)
+            elif hs_type == self.HS_SERVER_HELLO_DONE:
+                self.hello_done = True
+
+    def _process_server_hello(self, body):
+        """
+        Server version and the selected cipher suite
+        :param body:
+        :return:
+        """
+        try:
+            self.server_version = struct.unpack('!H', body[0:2])[0]
+            sid_len = bytearray(body[34:35])[0]
+            self.cipher_suite = struct.unpack('!H', body[35 + sid_len:37 + sid_len])[0]
+
+        except Exception as e:
+            logger.debug('Invalid ServerHello: %s' % e)
+
+    def _process_certificate(self, body):
+        """
+        Certificate chain, list of DER certificates prefixed with 3 B lengths
+        :param body:
+        :return:
+        """
+        data = bytearray(body)
+        if len(data) < 3:
+            return
+
+        total = (data[0] << 16) | (data[1] << 8) | data[2]
+        pos = 3
+        end = min(len(data), 3 + total)
+        while pos + 3 <= end:
+            cert_len = (data[pos] << 16) | (data[pos + 1] << 8) | data[pos + 2]
+            pos += 3
+            if pos + cert_len > end:
+                logger.debug('Truncated certificate in the chain')
+                break
+
+            self.certificates.append(body[pos:pos + cert_len])
+            pos += cert_len
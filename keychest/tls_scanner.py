@@ -16,9 +16,14 @@ from .tls_handshake import TlsHandshaker, TlsHandshakeResult, TlsIncomplete, Tls
 from .cert_path_validator import PathValidator, ValidationException
 from .tls_domain_tools import TlsDomainTools
 from .errors import RequestError
+from .http_pool import HttpSessionPool
 
 import logging
+import threading
+import time
 from functools import wraps
+
+import concurrent.futures
 import requests
 import sqlalchemy as salch
 
@@ -68,6 +73,22 @@ class RequestErrorWrapper(object):
         return str(self.code)
 
 
+class ConnectProbeResult(object):
+    """
+    Result of one redirect chain probe
+    """
+    def __init__(self, url=None):
+        self.url = url
+        self.first = None  # first response, before any redirect - header analysis
+        self.first_error = None  # error of the first request, certificate verified
+        self.follow_error = None  # error of the whole redirect chain, certificate verified
+        self.follow_url = None  # final URL of the redirect chain, certificate not verified on SSL error
+
+    def __repr__(self):
+        return '<ConnectProbeResult(url=%r, first=%r, first_error=%r, follow_error=%r, follow_url=%r)>' \
+               % (self.url, self.first, self.first_error, self.follow_error, self.follow_url)
+
+
 class TlsScanner(object):
     """
     Extended TLS scanner for Keychest
@@ -75,12 +96,23 @@ class TlsScanner(object):
     if problem -> http GET, follow redirect.
     """
 
-    def __init__(self):
+    PROBE_WORKERS = 32
+    PROBE_QUEUE_POLL = 0.1
+
+    def __init__(self, http_pool=None, probe_workers=None):
         self.trace_logger = Tracelogger(logger)
         self.tls_handshaker = TlsHandshaker(timeout=5, tls_version='TLS_1_2', attempts=3)
         self.crt_validator = PathValidator()
         self.domain_tools = TlsDomainTools()
 
+        # target probes use fresh connections by default, each probe measures the connection setup
+        self.http_pool = http_pool if http_pool is not None else HttpSessionPool(thread_local=True, enabled=False)
+
+        # concurrent connect analysis probes
+        self.probe_workers = probe_workers if probe_workers is not None else self.PROBE_WORKERS
+        self.probe_executor = None
+        self.probe_lock = threading.Lock()
+
     def scan(self, domain, port=443):
         """
         TODO: implement
@@ -160,7 +192,180 @@ class TlsScanner(object):
         :param kwargs: 
         :return: result, error
         """
-        return requests.get(url, **kwargs)
+        return self.http_pool.get(url, **kwargs)
+
+    @wrap_requests()
+    def req_follow(self, response, **kwargs):
+        """
+        Follows redirects of the already loaded response
+        :param response: response loaded with allow_redirects=False
+        :param kwargs: requests arguments (timeout, verify)
+        :return: result, error; final response of the redirect chain
+        """
+        session = self.http_pool.get_session() if self.http_pool.enabled else requests.Session()
+        try:
+            last = response
+            for last in session.resolve_redirects(response, response.request, **kwargs):
+                pass
+            return last
+
+        finally:
+            if not self.http_pool.enabled:
+                session.close()
+
+    def get_probe_executor(self):
+        """
+        Executor for the connect probes, created on the first use
+        :return:
+        """
+        with self.probe_lock:
+            if self.probe_executor is None:
+                self.probe_executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.probe_workers)
+            return self.probe_executor
+
+    def deadline_error(self, url):
+        return RequestErrorWrapper(RequestErrorCode.CONNECTION_TIMEOUT,
+                                   RequestError('Probe deadline exceeded: %s' % url))
+
+    def probe_timeout(self, timeout, deadline):
+        """
+        Request timeout bounded by the deadline, None if the deadline passed
+        :param timeout:
+        :param deadline:
+        :return:
+        """
+        if deadline is None:
+            return timeout
+
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return None
+        return remaining if timeout is None else min(timeout, remaining)
+
+    def probe_chain(self, url, timeout=None, deadline=None):
+        """
+        Loads the URL, follows the redirect chain. The first response is loaded once and reused
+        for the header analysis and for the redirect following.
+        On SSL error the chain is loaded again without certificate verification to get the final URL.
+        :param url:
+        :param timeout: request timeout
+        :param deadline: absolute time the probe has to finish by
+        :return:
+        :rtype: ConnectProbeResult
+        """
+        ret = ConnectProbeResult(url)
+
+        req_timeout = self.probe_timeout(timeout, deadline)
+        if req_timeout is None:
+            ret.first_error = ret.follow_error = self.deadline_error(url)
+            return ret
+
+        first, ret.first_error = self.req_connect(url, timeout=req_timeout, allow_redirects=False)
+        ret.first = first
+        if ret.first_error is None:
+            req_timeout = self.probe_timeout(timeout, deadline)
+            if req_timeout is None:
+                ret.follow_error = self.deadline_error(url)
+                return ret
+
+            final, ret.follow_error = self.req_follow(first, timeout=req_timeout)
+            if ret.follow_error is None:
+                ret.follow_url = final.url
+                return ret
+
+        elif ret.first_error == RequestErrorCode.SSL:
+            ret.follow_error = ret.first_error
+            req_timeout = self.probe_timeout(timeout, deadline)
+            if req_timeout is None:
+                return ret
+
+            first, error = self.req_connect(url, timeout=req_timeout, allow_redirects=False, verify=False)
+            ret.first = first
+            if error is not None:
+                return ret
+
+        else:
+            ret.follow_error = ret.first_error
+            return ret
+
+        # Load follow URL if there was a SSL error.
+        req_timeout = self.probe_timeout(timeout, deadline)
+        if ret.follow_error == RequestErrorCode.SSL and req_timeout is not None:
+            final, error = self.req_follow(ret.first, timeout=req_timeout, verify=False)
+            ret.follow_url = final.url if error is None else None
+        return ret
+
+    def connect_probes(self, urls, timeout=None, max_duration=None):
+        """
+        Runs the redirect chain probes concurrently. The first probe runs in the calling thread,
+        the rest in the probe executor.
+        Each probe has max_duration seconds from the moment it starts executing, so waiting in the
+        executor queue under load does not count. Probes not finished in time report the connection timeout.
+        :param urls:
+        :param timeout: request timeout
+        :param max_duration: time limit of one probe in seconds
+        :return: list of ConnectProbeResult, in the order of urls
+        :rtype: list[ConnectProbeResult]
+        """
+        if len(urls) == 0:
+            return []
+
+        starts = [None] * len(urls)  # probe execution start times
+
+        def run_probe(idx):
+            starts[idx] = time.time()
+            deadline = None if max_duration is None else starts[idx] + max_duration
+            return self.probe_chain(urls[idx], timeout, deadline)
+
+        executor = self.get_probe_executor()
+        futures = [None] + [executor.submit(run_probe, idx) for idx in range(1, len(urls))]
+
+        ret = []
+        for idx, url in enumerate(urls):
+            try:
+                if futures[idx] is None:
+                    ret.append(run_probe(idx))
+                elif self._wait_probe(futures[idx], starts, idx, max_duration):
+                    ret.append(futures[idx].result())
+                else:
+                    res = ConnectProbeResult(url)
+                    res.first_error = res.follow_error = self.deadline_error(url)
+                    ret.append(res)
+
+            except Exception as e:
+                logger.debug('Connect probe exception %s: %s' % (url, e))
+                self.trace_logger.log(e)
+                res = ConnectProbeResult(url)
+                res.first_error = res.follow_error = RequestErrorWrapper(RequestErrorCode.GENERIC, e)
+                ret.append(res)
+        return ret
+
+    def _wait_probe(self, future, starts, idx, max_duration):
+        """
+        Waits for the probe future, at most max_duration after the probe started executing
+        :param future:
+        :param starts: probe start times, None if not started yet
+        :param idx:
+        :param max_duration:
+        :return: True if the probe finished
+        """
+        while not future.done():
+            if max_duration is None:
+                concurrent.futures.wait([future])
+            elif starts[idx] is None:
+                concurrent.futures.wait([future], timeout=self.PROBE_QUEUE_POLL)  # still queued
+            else:
+                remaining = starts[idx] + max_duration - time.time()
+                if remaining <= 0:
+                    return False
+                concurrent.futures.wait([future], timeout=remaining)
+        return True
+
+    def shutdown(self):
+        with self.probe_lock:
+            if self.probe_executor is not None:
+                self.probe_executor.shutdown(wait=False)
+                self.probe_executor = None
 
     def err2status(self, err):
         """
@@ -18,7 +18,7 @@ install_requires = [
     'coloredlogs',
     'six',
     'future',
-    'SQLAlchemy>=1.1',
+    'SQLAlchemy>=1.2',
     'shellescape',
     'flask>=0.12',
     'lxml',
@@ -48,6 +48,8 @@ install_requires = [
 
 if sys.version_info < (3,):
     install_requires.append('scapy-ssl_tls')
+    install_requires.append('futures')
+    install_requires.append('trollius')
 else:
     install_requires.append('scapy-python3')
 